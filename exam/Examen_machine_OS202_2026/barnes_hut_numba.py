@@ -1,23 +1,25 @@
 # Simulation d'un problème à N corps utilisant l'algorithme de Barnes-Hut :
-#     - Construction d'un quadtree divisant récursivement sur le plan OXY en quatre quadrants (On ne découpe jamais selon Z car la galaxie est principalement plate)
+#     - Construction d'un octree linéaire à partir des corps triés selon leur code de Morton : chaque nœud est un cube
+#       dont les corps sont contigus dans l'ordre de Morton, et l'arbre est stocké dans des tableaux plats
+#       (les niveaux plus fins que l'épaisseur de la galaxie, qui est principalement plate, se réduisent à un découpage selon OXY)
 #     - Calcul du centre de masse et de la masse totale pour chaque nœud de l'arbre
 #     - Utilisation d'un critère θ (theta) pour décider si on approxime une région par son centre de masse
 #     - Le calcul de l'accélération pour chaque corps se fait :
 #          - Si s/d < θ (où s = taille du nœud, d = distance), on utilise le centre de masse du nœud
 #          - Sinon, on descend récursivement dans les enfants du nœud
 import numpy as np
-import visualizer3d
 import sys
-from numba import njit, prange, deferred_type, optional,int64,float64
-from numba.experimental import jitclass
+from numba import njit, prange, int64
 from math import sqrt
+import morton
+import integrators
+import snapshot
+from morton import MORTON_BITS
+from precision import make_precision
+from precision_kernels import FASTMATH_FLAGS, accumulate
 
 # Constante gravitationnelle en unités [ly^3 / (M_sun * an^2)]
 G = 1.560339e-13
-NW = 0
-NE = 1
-SW = 2
-SE = 3
 
 def generate_star_color(mass):
     """
@@ -47,316 +49,402 @@ def generate_star_color(mass):
         # Étoiles de faible masse: rouge-orange
         return (255, 150, 100)
 
-max_bodies_per_node : int64 = 16  # Nombre maximum de corps par nœud avant subdivision
+max_bodies_per_node : int64 = 16  # Nombre maximum de corps par feuille avant subdivision
+stack_block_size : int64 = 32     # Nombre de corps (consécutifs dans l'ordre de Morton) traités par une même tâche
 
-@njit(fastmath=True)
-def scatter_bodies(bodies_index : np.ndarray, positions : np.ndarray, center : np.ndarray, children_bodies : list[np.ndarray],
-                   children_nbodies : list[int]):
-    """
-    Distribue les corps dans les quadrants en fonction de leur position par rapport au centre.
-
-    :param bodies_index: Indices des corps à distribuer
-    :type bodies_index: np.ndarray
-    :param positions: Positions des corps [x,y,z]
-    :type positions: np.ndarray
-    :param center: Centre de la région (x, y, z)
-    :type center: np.ndarray
-    :param children_bodies: Listes des indices des corps pour chaque quadrant
-    :type children_bodies: list[np.ndarray]
-    :param children_nbodies: Nombres de corps dans chaque quadrant
-    :type children_nbodies: list[int]
+@njit
+def grow(array : np.ndarray, capacity : int) -> np.ndarray:
+    new_array = np.empty(capacity, dtype=array.dtype)
+    new_array[:array.shape[0]] = array
+    return new_array
+
+@njit
+def build_octree_nodes(codes : np.ndarray, leaf_size : int):
     """
-    for i in range(bodies_index.shape[0]):
-        body_idx = bodies_index[i]
-        pos = positions[body_idx]
-        if pos[0] < center[0]:
-            if pos[1] < center[1]:
-                quadrant = SW  # Quadrant inférieur gauche
-            else:
-                quadrant = NW  # Quadrant supérieur gauche
-        else:
-            if pos[1] < center[1]:
-                quadrant = SE  # Quadrant inférieur droit
-            else:
-                quadrant = NE  # Quadrant supérieur droit
-        children_bodies[quadrant][children_nbodies[quadrant]] = body_idx
-        children_nbodies[quadrant] += 1
+    Construit la topologie de l'octree linéaire à partir des codes de Morton triés des corps.
 
-@njit(fastmath=True)
-def compute_local_masses_com(bodies_index, positions, masses):
-    mass = 0.
-    com  = np.zeros(3,dtype=np.double)
-    for i in bodies_index:
-        mass += masses[i]
-        com += masses[i]*positions[i]
-    return (mass, com)
+    Les nœuds sont créés en largeur d'abord : les enfants (non vides) d'un nœud sont contigus et ont toujours
+    un indice supérieur à celui de leur parent. Chaque nœud correspond à l'intervalle [start, end[ des corps triés
+    dont les codes partagent le même préfixe de 3*level bits.
 
-@njit(fastmath=True)
-def local_compute_acceleration(position, positions : np.ndarray, masses : np.ndarray, indices : np.ndarray) -> np.ndarray :
+    :param codes: Codes de Morton des corps, triés par ordre croissant
+    :param leaf_size: Nombre maximal de corps dans une feuille
+    :return: (node_start, node_end, node_level, node_child, node_nchild) où node_child vaut -1 pour une feuille
     """
-    Calcule l'accélération gravitationnelle exercée sur une position donnée par les corps spécifiés par leurs indices.
-    :param position: Position du corps cible [x,y,z]
-    :type position: np.ndarray
-    :param indices: Indices des corps exerçant la force
-    :type indices: np.ndarray
-    :param positions: Positions des différents corps [x,y,z]
-    :type positions: np.ndarray
-    :param masses: Tableau des masses des corps
-    :type masses: np.ndarray
-    :return: Accélération gravitationnelle [ax, ay, az]
-    :rtype: np.ndarray
+    n_bodies = codes.shape[0]
+    capacity = max(64, 4 * (n_bodies // max(leaf_size, 1) + 1))
+    node_start = np.empty(capacity, dtype=np.int64)
+    node_end = np.empty(capacity, dtype=np.int64)
+    node_level = np.empty(capacity, dtype=np.int64)
+    node_child = np.empty(capacity, dtype=np.int64)
+    node_nchild = np.empty(capacity, dtype=np.int64)
+    node_start[0] = 0
+    node_end[0] = n_bodies
+    node_level[0] = 0
+    n_nodes = 1
+    inode = 0
+    while inode < n_nodes:
+        start = node_start[inode]
+        end = node_end[inode]
+        level = node_level[inode]
+        node_child[inode] = -1
+        node_nchild[inode] = 0
+        if end - start > leaf_size and level < MORTON_BITS:
+            # Agrandissement des tableaux si les huit enfants potentiels ne tiennent pas
+            if n_nodes + 8 > capacity:
+                capacity *= 2
+                node_start = grow(node_start, capacity)
+                node_end = grow(node_end, capacity)
+                node_level = grow(node_level, capacity)
+                node_child = grow(node_child, capacity)
+                node_nchild = grow(node_nchild, capacity)
+            shift = np.uint64(3 * (MORTON_BITS - 1 - level))
+            node_child[inode] = n_nodes
+            k = start
+            while k < end:
+                digit = (codes[k] >> shift) & np.uint64(7)
+                k_end = k + 1
+                while k_end < end and ((codes[k_end] >> shift) & np.uint64(7)) == digit:
+                    k_end += 1
+                node_start[n_nodes] = k
+                node_end[n_nodes] = k_end
+                node_level[n_nodes] = level + 1
+                n_nodes += 1
+                k = k_end
+            node_nchild[inode] = n_nodes - node_child[inode]
+        inode += 1
+    return (node_start[:n_nodes], node_end[:n_nodes], node_level[:n_nodes],
+            node_child[:n_nodes], node_nchild[:n_nodes])
+
+@njit(parallel=True, fastmath=True)
+def compute_node_moments(node_start : np.ndarray, node_end : np.ndarray, node_child : np.ndarray, node_nchild : np.ndarray,
+                         positions : np.ndarray, masses : np.ndarray, use_quadrupole : bool):
     """
-    acceleration = np.zeros(3)
-    for i in range(indices.shape[0]):
-        body_idx = indices[i]
-        direction = positions[body_idx] - position
-        distance = sqrt(direction[0]*direction[0]+direction[1]*direction[1]+direction[2]*direction[2])#linalg.norm(direction)  # Ajouter une petite valeur pour éviter la division par zéro
-        if distance > 1.E-10 : 
-            force_magnitude = G * masses[body_idx] / (distance*distance*distance)
-            acceleration += force_magnitude * direction
-    return acceleration
-
-node_type = deferred_type()
-@jitclass([('center', float64[:]),('com', float64[:]),('body', int64[:])])
-class QuadtreeNode:
-    center : np.ndarray
-    size   : float
-    size_z : float
-    mass   : float
-    nbodies: int
-    body   : np.ndarray
-    com    : np.ndarray
-    nw_child : optional(node_type)
-    ne_child : optional(node_type)
-    sw_child : optional(node_type)
-    se_child : optional(node_type)
+    Calcule la masse (multipliée par G), le centre de masse et, si demandé, le moment quadripolaire sans trace
+    Q = G.Σ m (3 r r^T - |r|² I) (xx, xy, xz, yy, yz, zz) de chaque nœud.
+    Les feuilles sont traitées en parallèle à partir des corps triés, puis les nœuds internes sont combinés
+    des feuilles vers la racine (ordre inverse de création) ; les moments des enfants sont ramenés au centre
+    de masse du parent par le théorème de transport.
+
+    :param positions: Positions des corps triées dans l'ordre de Morton
+    :param masses: Masses des corps triées dans l'ordre de Morton
     """
-    Nœud d'un quadtree pour l'algorithme de Barnes-Hut en pseudo 2D.
-    Chaque région  représente une région parallépiède-rectangle avec une base carrée en OXY
+    n_nodes = node_start.shape[0]
+    node_mass = np.zeros(n_nodes, dtype=np.float64)
+    node_com = np.zeros((n_nodes, 3), dtype=np.float64)
+    node_quad = np.zeros((n_nodes, 6), dtype=np.float64)
+    for inode in prange(n_nodes):
+        if node_child[inode] < 0:
+            mass = 0.
+            cx = 0.
+            cy = 0.
+            cz = 0.
+            for i in range(node_start[inode], node_end[inode]):
+                m = masses[i]
+                mass += m
+                cx += m*positions[i,0]
+                cy += m*positions[i,1]
+                cz += m*positions[i,2]
+            if mass > 0:
+                cx /= mass
+                cy /= mass
+                cz /= mass
+                if use_quadrupole:
+                    for i in range(node_start[inode], node_end[inode]):
+                        m = G * masses[i]
+                        rx = positions[i,0] - cx
+                        ry = positions[i,1] - cy
+                        rz = positions[i,2] - cz
+                        r2 = rx*rx + ry*ry + rz*rz
+                        node_quad[inode,0] += m * (3.*rx*rx - r2)
+                        node_quad[inode,1] += m * 3.*rx*ry
+                        node_quad[inode,2] += m * 3.*rx*rz
+                        node_quad[inode,3] += m * (3.*ry*ry - r2)
+                        node_quad[inode,4] += m * 3.*ry*rz
+                        node_quad[inode,5] += m * (3.*rz*rz - r2)
+            node_mass[inode] = G * mass
+            node_com[inode,0] = cx
+            node_com[inode,1] = cy
+            node_com[inode,2] = cz
+    for inode in range(n_nodes-1, -1, -1):
+        first = node_child[inode]
+        if first >= 0:
+            mass = 0.
+            cx = 0.
+            cy = 0.
+            cz = 0.
+            for child in range(first, first + node_nchild[inode]):
+                m = node_mass[child]
+                mass += m
+                cx += m*node_com[child,0]
+                cy += m*node_com[child,1]
+                cz += m*node_com[child,2]
+            if mass > 0:
+                cx /= mass
+                cy /= mass
+                cz /= mass
+                if use_quadrupole:
+                    for child in range(first, first + node_nchild[inode]):
+                        m = node_mass[child]
+                        rx = node_com[child,0] - cx
+                        ry = node_com[child,1] - cy
+                        rz = node_com[child,2] - cz
+                        r2 = rx*rx + ry*ry + rz*rz
+                        node_quad[inode,0] += node_quad[child,0] + m * (3.*rx*rx - r2)
+                        node_quad[inode,1] += node_quad[child,1] + m * 3.*rx*ry
+                        node_quad[inode,2] += node_quad[child,2] + m * 3.*rx*rz
+                        node_quad[inode,3] += node_quad[child,3] + m * (3.*ry*ry - r2)
+                        node_quad[inode,4] += node_quad[child,4] + m * 3.*ry*rz
+                        node_quad[inode,5] += node_quad[child,5] + m * (3.*rz*rz - r2)
+            node_mass[inode] = mass
+            node_com[inode,0] = cx
+            node_com[inode,1] = cy
+            node_com[inode,2] = cz
+    return node_mass, node_com, node_quad
+
+@njit(fastmath=True)
+def quadrupole_acceleration(dx : float, dy : float, dz : float, distance : float, quad : np.ndarray):
     """
-    def __init__(self, center : np.ndarray, size : float, size_z : float):
-        global max_bodies_per_node
-        self.center = center
-        self.size = size
-        self.size_z = size_z
-        self.mass = 0.0
-        self.nbodies = 0
-        self.body = np.empty(max_bodies_per_node, dtype=np.int64)
-        self.com = np.zeros(3)
-        self.nw_child = None  # Enfant nord-ouest
-        self.ne_child = None  # Enfant nord-est
-        self.sw_child = None  # Enfant sud-ouest
-        self.se_child = None  # Enfant sud-est
-
-    def subdivide(self):
-        """
-        Subdivise un nœud en quatre parties égales sur le plan OXY 
-        """
-        half_size = self.size * 0.5
-        quarter_size = self.size * 0.25
-        self.nw_child = QuadtreeNode(self.center + np.array([-quarter_size, quarter_size, 0]), half_size,self.size_z)
-        self.ne_child = QuadtreeNode(self.center + np.array([quarter_size, quarter_size, 0]), half_size,self.size_z)
-        self.sw_child = QuadtreeNode(self.center + np.array([-quarter_size, -quarter_size, 0]), half_size,self.size_z)
-        self.se_child = QuadtreeNode(self.center + np.array([quarter_size, -quarter_size, 0]), half_size,self.size_z)
-        
-    def get_quadrant(self,position : np.ndarray):
-        """    
+    Correction quadripolaire de l'accélération créée par un nœud de moment quad (déjà multiplié par G),
+    (dx, dy, dz) étant le vecteur allant de la position cible au centre de masse du nœud.
+    """
+    qx = quad[0]*dx + quad[1]*dy + quad[2]*dz
+    qy = quad[1]*dx + quad[3]*dy + quad[4]*dz
+    qz = quad[2]*dx + quad[4]*dy + quad[5]*dz
+    inv_dist5 = 1. / distance**5
+    coef = 2.5 * (dx*qx + dy*qy + dz*qz) * inv_dist5 / (distance*distance)
+    return coef*dx - qx*inv_dist5, coef*dy - qy*inv_dist5, coef*dz - qz*inv_dist5
 
-        Détermine dans quel quadrant se trouve la position passée en argument.
-        La composante z n'est pas prise en compte pour cette décision.
+@njit(parallel=True, fastmath=FASTMATH_FLAGS)
+def compute_accelerations(node_start : np.ndarray, node_end : np.ndarray, node_child : np.ndarray, node_nchild : np.ndarray,
+                          node_size : np.ndarray, node_mass : np.ndarray, node_com : np.ndarray, node_quad : np.ndarray,
+                          positions : np.ndarray, masses : np.ndarray, sorted_targets : np.ndarray, out_index : np.ndarray,
+                          theta : float, use_quadrupole : bool, accumulator, compensated : bool) -> np.ndarray :
+    """
+    Calcule les accélérations des corps cibles en parcourant l'octree avec une pile explicite.
 
-        :param position: Tableau [x,y[,z]]
-        :type position: np.ndarray
-        """
-        if position[0] < self.center[0]:
-            if position[1] < self.center[1]:
-                return self.sw_child  # Quadrant inférieur gauche
-            else:
-                return self.nw_child  # Quadrant supérieur gauche
-        else:
-            if position[1] < self.center[1]:
-                return self.se_child  # Quadrant inférieur droit
-            else:
-                return self.ne_child  # Quadrant supérieur droit
-                        
-    def set_nbodies(self, n : int64):
-        self.nbodies = n
-        
-    def get_bodies_index(self):
-        return self.body[:self.nbodies]
-        
-    def get_mass(self) -> float:
-        return self.mass
-    
-    def set_mass(self, m : float):
-        self.mass = m
-        
-    def get_com(self) -> np.ndarray:
-        return self.com
-    
-    def set_com(self, com : np.ndarray):
-        self.com = com
-        
-    def has_children(self) -> bool:
-        return self.nw_child is not None
-    
-    def get_size(self) -> float:
-        return self.size
-    
-    def get_child(self, i : int):
-        if   i==NW: return self.nw_child
-        elif i==NE: return self.ne_child
-        elif i==SW: return self.sw_child
-        elif i==SE: return self.se_child
-        return None
+    Un nœud de taille s vu à la distance d de son centre de masse est approximé par sa masse (et son quadripôle)
+    si s < θ.d ; sinon on descend dans ses enfants, ou on somme directement sur ses corps si c'est une feuille.
+    Les corps sont parcourus par blocs consécutifs dans l'ordre de Morton : les corps d'un même bloc sont voisins
+    et visitent à peu près les mêmes nœuds, et chaque bloc réutilise sa propre pile.
 
-node_type.define(QuadtreeNode.class_type.instance_type)
+    :param positions: Positions des corps triées dans l'ordre de Morton
+    :param masses: Masses des corps triées dans l'ordre de Morton
+    :param sorted_targets: Indices croissants (dans l'ordre de Morton) des corps dont on calcule l'accélération
+    :param out_index: Ligne du tableau résultat où écrire l'accélération de chaque cible
+    :param accumulator: Type des sommes des forces, compensées (Kahan) si compensated (voir precision.py) ; la
+                        réassociation est exclue des options fastmath pour ne pas supprimer la compensation
+    :return: Accélérations [ax, ay, az] des cibles
+    """
+    n_targets = sorted_targets.shape[0]
+    accel = np.empty((n_targets, 3), dtype=positions.dtype)
+    g = accumulator(G)
+    n_blocks = (n_targets + stack_block_size - 1) // stack_block_size
+    for iblock in prange(n_blocks):
+        # Au plus 7 nœuds en attente par niveau, plus la racine
+        stack = np.empty(8 * (MORTON_BITS + 1), dtype=np.int64)
+        for itarget in range(iblock * stack_block_size, min((iblock + 1) * stack_block_size, n_targets)):
+            k = sorted_targets[itarget]
+            px = positions[k,0]
+            py = positions[k,1]
+            pz = positions[k,2]
+            ax = ay = az = accumulator(0.)
+            cx = cy = cz = accumulator(0.)
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                inode = stack[top]
+                dx = node_com[inode,0] - px
+                dy = node_com[inode,1] - py
+                dz = node_com[inode,2] - pz
+                distance = sqrt(dx*dx + dy*dy + dz*dz)
+                if node_size[inode] < theta * distance:
+                    # Approximation du nœud par son centre de masse
+                    inv_dist3 = node_mass[inode] / (distance*distance*distance)
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                        dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+                    if use_quadrupole:
+                        qx, qy, qz = quadrupole_acceleration(dx, dy, dz, distance, node_quad[inode])
+                        ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, accumulator(qx),
+                                                            accumulator(qy), accumulator(qz), compensated)
+                elif node_child[inode] < 0:
+                    # Feuille : somme directe sur ses corps
+                    for j in range(node_start[inode], node_end[inode]):
+                        dx = positions[j,0] - px
+                        dy = positions[j,1] - py
+                        dz = positions[j,2] - pz
+                        distance = sqrt(dx*dx + dy*dy + dz*dz)
+                        if distance > 1.E-10:
+                            inv_dist3 = g * masses[j] / (distance*distance*distance)
+                            ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, dx * inv_dist3,
+                                                                dy * inv_dist3, dz * inv_dist3, compensated)
+                else:
+                    for child in range(node_child[inode], node_child[inode] + node_nchild[inode]):
+                        stack[top] = child
+                        top += 1
+            irow = out_index[itarget]
+            accel[irow,0] = ax
+            accel[irow,1] = ay
+            accel[irow,2] = az
+    return accel
 
-@njit(fastmath=True)
-def insert_index_in_node(node : QuadtreeNode, body_index : int64, positions : np.ndarray):
+@njit(parallel=True)
+def count_interactions(node_start : np.ndarray, node_end : np.ndarray, node_child : np.ndarray, node_nchild : np.ndarray,
+                       node_size : np.ndarray, node_com : np.ndarray, positions : np.ndarray, theta : float) -> int:
     """
-    Insère un corps dans le quadtree.
+    Nombre d'interactions (nœuds approximés et paires de corps des feuilles) d'un calcul complet des accélérations :
+    même parcours que compute_accelerations, sans le calcul des forces.
+    """
+    n_bodies = positions.shape[0]
+    n_blocks = (n_bodies + stack_block_size - 1) // stack_block_size
+    counts = np.zeros(n_blocks, dtype=np.int64)
+    for iblock in prange(n_blocks):
+        stack = np.empty(8 * (MORTON_BITS + 1), dtype=np.int64)
+        for k in range(iblock * stack_block_size, min((iblock + 1) * stack_block_size, n_bodies)):
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                inode = stack[top]
+                dx = node_com[inode,0] - positions[k,0]
+                dy = node_com[inode,1] - positions[k,1]
+                dz = node_com[inode,2] - positions[k,2]
+                if node_size[inode] < theta * sqrt(dx*dx + dy*dy + dz*dz):
+                    counts[iblock] += 1
+                elif node_child[inode] < 0:
+                    counts[iblock] += node_end[inode] - node_start[inode]
+                    if node_start[inode] <= k < node_end[inode]:
+                        counts[iblock] -= 1
+                else:
+                    for child in range(node_child[inode], node_child[inode] + node_nchild[inode]):
+                        stack[top] = child
+                        top += 1
+    return counts.sum()
 
+@njit(parallel=True)
+def compute_potential_energy(node_start : np.ndarray, node_end : np.ndarray, node_child : np.ndarray,
+                             node_nchild : np.ndarray, node_size : np.ndarray, node_com : np.ndarray,
+                             positions : np.ndarray, node_mass : np.ndarray, moment_com : np.ndarray,
+                             moment_positions : np.ndarray, masses : np.ndarray, theta : float) -> float:
+    """
+    Énergie potentielle approchée -1/2.Σ_k m_k.φ_k (en float64), le potentiel φ_k étant calculé par le même
+    parcours que compute_accelerations (monopôle des nœuds approximés, somme directe dans les feuilles).
+    Le choix des nœuds approximés se fait avec node_com et positions (ceux de la construction de l'arbre), le
+    potentiel avec les centres de masse moment_com recalculés aux positions moment_positions.
+    """
+    n_bodies = positions.shape[0]
+    n_blocks = (n_bodies + stack_block_size - 1) // stack_block_size
+    energies = np.zeros(n_blocks)
+    for iblock in prange(n_blocks):
+        stack = np.empty(8 * (MORTON_BITS + 1), dtype=np.int64)
+        for k in range(iblock * stack_block_size, min((iblock + 1) * stack_block_size, n_bodies)):
+            phi = 0.
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                inode = stack[top]
+                dx = node_com[inode,0] - positions[k,0]
+                dy = node_com[inode,1] - positions[k,1]
+                dz = node_com[inode,2] - positions[k,2]
+                if node_size[inode] < theta * sqrt(dx*dx + dy*dy + dz*dz):
+                    dx = moment_com[inode,0] - moment_positions[k,0]
+                    dy = moment_com[inode,1] - moment_positions[k,1]
+                    dz = moment_com[inode,2] - moment_positions[k,2]
+                    phi += node_mass[inode] / sqrt(dx*dx + dy*dy + dz*dz)
+                elif node_child[inode] < 0:
+                    for j in range(node_start[inode], node_end[inode]):
+                        dx = moment_positions[j,0] - moment_positions[k,0]
+                        dy = moment_positions[j,1] - moment_positions[k,1]
+                        dz = moment_positions[j,2] - moment_positions[k,2]
+                        distance = sqrt(dx*dx + dy*dy + dz*dz)
+                        if distance > 1.E-10:
+                            phi += G * masses[j] / distance
+                else:
+                    for child in range(node_child[inode], node_child[inode] + node_nchild[inode]):
+                        stack[top] = child
+                        top += 1
+            energies[iblock] += masses[k] * phi
+    return -0.5 * energies.sum()
 
-        :param body_index: Index du corps à insérer
-        :type body_index: int64
-        :param positions: Positions des différents corps [x,y,z]
-        :type positions: np.ndarray
-        :param masses: Tableau des masses des corps
-        :type masses: np.ndarray
+class Octree:
     """
-    global max_bodies_per_node
-    if node.nbodies < max_bodies_per_node and node.nw_child is None:
-        # Nœud vide, insérer le corps ici
-        node.body[node.nbodies] = body_index
-        node.set_nbodies(node.nbodies + 1)
-    else:
-        if node.nw_child is None:
-            # Nœud feuille avec un corps, subdiviser
-            node.subdivide()
-            assert(node.nw_child is not None)
-            assert(node.ne_child is not None)
-            assert(node.sw_child is not None)
-            assert(node.se_child is not None)
-            children_bodies = [node.nw_child.body, node.ne_child.body, node.sw_child.body, node.se_child.body]
-            children_nbodies : list = [0,0,0,0]
-            scatter_bodies(node.body, positions, node.center, children_bodies, children_nbodies)
-            node.nw_child.set_nbodies(children_nbodies[0])
-            node.ne_child.set_nbodies(children_nbodies[1])
-            node.sw_child.set_nbodies(children_nbodies[2])
-            node.se_child.set_nbodies(children_nbodies[3])
-            quadrant : QuadtreeNode = node.get_quadrant(positions[body_index])
-            insert_index_in_node(quadrant, body_index, positions)
-            
-            # Réinitialiser le nœud actuel
-            node.set_nbodies(0)
-        else:
-            # Nœud interne, insérer dans l'enfant approprié
-            quadrant : QuadtreeNode = node.get_quadrant(positions[body_index])
-            insert_index_in_node(quadrant, body_index, positions)
+    Octree linéaire stocké dans des tableaux plats (un indice par nœud) :
+        - node_start, node_end : intervalle des corps du nœud dans l'ordre de Morton
+        - node_child, node_nchild : indice du premier enfant (-1 pour une feuille) et nombre d'enfants
+        - node_size : longueur d'arête du nœud (cubique)
+        - node_mass, node_com, node_quad : masse (multipliée par G), centre de masse et moment quadripolaire
+    Les positions et masses des corps sont recopiées dans l'ordre de Morton pour que les corps d'une feuille
+    soient contigus en mémoire. Ces copies, node_mass et node_com sont dans la précision de stockage de precision
+    (voir precision.py) ; les moments sont calculés en float64.
+    """
+    def __init__(self, leaf_size : int = max_bodies_per_node, precision = "float64"):
+        self.leaf_size = leaf_size
+        self.precision = make_precision(precision)
 
-@njit(fastmath=True)
-def update_masses_com(node : QuadtreeNode, positions : np.ndarray, masses : np.ndarray ):
-    if node.has_children():
-        update_masses_com(node.get_child(NW), positions, masses)
-        update_masses_com(node.get_child(NE), positions, masses)
-        update_masses_com(node.get_child(SW), positions, masses)
-        update_masses_com(node.get_child(SE), positions, masses)
-        node.set_mass(node.get_child(NW).get_mass() + node.get_child(NE).get_mass() +
-                     node.get_child(SW).get_mass() + node.get_child(SE).get_mass())
-        node.set_com(node.get_child(NW).get_com() + node.get_child(NE).get_com() +
-                     node.get_child(SW).get_com() + node.get_child(SE).get_com())
-    else:
-        m, c = compute_local_masses_com(node.get_bodies_index(), positions, masses)
-        node.set_mass(m)
-        node.set_com(c)
-        
-@njit(fastmath=True)
-def finalize(node : QuadtreeNode):
-        global G
-        if node.has_children():
-            finalize(node.get_child(NW))
-            finalize(node.get_child(NE))
-            finalize(node.get_child(SW))
-            finalize(node.get_child(SE))
-        if node.get_mass() > 0:
-            node.set_com(node.get_com() / node.get_mass())
-            node.set_mass(G * node.get_mass())
+    def build(self, positions : np.ndarray, masses : np.ndarray, use_quadrupole : bool = False):
+        """
+        (Re)construit l'arbre et ses moments pour les positions courantes.
+        """
+        box_min, box_size = morton.bounding_cube(positions)
+        codes = morton.morton_codes(positions, box_min, box_size)
+        self.order = np.argsort(codes, kind="stable")
+        self.positions = np.ascontiguousarray(positions[self.order], dtype=self.precision.storage)
+        self.masses = np.ascontiguousarray(masses[self.order], dtype=self.precision.storage)
+        (self.node_start, self.node_end, node_level,
+         self.node_child, self.node_nchild) = build_octree_nodes(codes[self.order], self.leaf_size)
+        self.node_size = box_size * 0.5**node_level
+        node_mass, node_com, self.node_quad = compute_node_moments(self.node_start, self.node_end,
+                                                                   self.node_child, self.node_nchild,
+                                                                   self.positions, self.masses, use_quadrupole)
+        self.node_mass = node_mass.astype(self.precision.storage, copy=False)
+        self.node_com = node_com.astype(self.precision.storage, copy=False)
 
-@njit(fastmath=True)
-def compute_acceleration(node : QuadtreeNode, position : np.ndarray, positions : np.ndarray, masses : np.ndarray, theta : float = 0.5) -> np.ndarray :
+    def compute_accelerations(self, theta : float, use_quadrupole : bool = False,
+                              targets : np.ndarray = None) -> np.ndarray:
         """
-        Calcule l'accélération gravitationnelle exercée sur une position donnée par les corps dans ce nœud.
-
-        :param position: Position du corps cible [x,y,z]
-        :type position: np.ndarray
-        :param theta: Paramètre de précision pour l'approximation Barnes-Hut
-        :type theta: float
-        :return: Accélération gravitationnelle [ax, ay, az]
-        :rtype: np.ndarray
+        Accélérations de tous les corps (dans leur ordre d'origine) pour l'arbre courant, ou seulement des corps
+        d'indices targets (dans l'ordre de targets). Les cibles sont traitées dans l'ordre de Morton.
         """
-        if node.get_mass()==0. : 
-            return np.zeros(3)
-        # Calculer la distance entre le corps cible et le centre de masse du nœud
-        direction = node.get_com() - position
-        distance = sqrt(direction[0]*direction[0]+direction[1]*direction[1]+direction[2]*direction[2])#linalg.norm(direction) 
-        
-        # Taille du nœud (longueur d'un côté de la base carrée)
-        s : float = node.get_size()
-        
-        if s  < theta * distance:
-            # Utiliser le centre de masse du nœud pour l'approximation
-            force_magnitude = node.get_mass() / (distance*distance*distance)
-            return force_magnitude * direction 
+        if targets is None:
+            sorted_targets = np.arange(self.order.shape[0])
+            out_index = self.order
         else:
-            if not node.has_children():
-                if node.nbodies == 0:
-                    return np.zeros(3)  # Nœud vide
-                else:
-                    # Nœud feuille, calculer la force directement
-                    return local_compute_acceleration(position, positions, masses, node.get_bodies_index())
-            else:
-                # Descendre dans les enfants
-                acceleration  = compute_acceleration(node.get_child(NW), position, positions, masses, theta)
-                acceleration += compute_acceleration(node.get_child(NE), position, positions, masses, theta)
-                acceleration += compute_acceleration(node.get_child(SW), position, positions, masses, theta)
-                acceleration += compute_acceleration(node.get_child(SE), position, positions, masses, theta)
-        
-                return acceleration
+            rank = np.empty_like(self.order)
+            rank[self.order] = np.arange(self.order.shape[0])
+            out_index = np.argsort(rank[targets])
+            sorted_targets = rank[targets][out_index]
+        return compute_accelerations(self.node_start, self.node_end, self.node_child, self.node_nchild,
+                                     self.node_size, self.node_mass, self.node_com, self.node_quad,
+                                     self.positions, self.masses, sorted_targets, out_index, theta, use_quadrupole,
+                                     self.precision.accumulator, self.precision.compensated)
 
-@njit(fastmath=True)
-def info_node(node : QuadtreeNode):
-    print(f"noeud ayant {node.nbodies} corps")
-    print("center : ", node.center, " masse : ", node.mass, " com : ", node.com)
-    if node.nbodies > 0:
-        print("indices des corps :")
-        a = node.get_bodies_index()
-        for v in a : print (v);
-        print()
-    if node.has_children():
-        print(f"A des enfants -> ")
-        info_node(node.get_child(NW))
-        info_node(node.get_child(NE))
-        info_node(node.get_child(SW))
-        info_node(node.get_child(SE))
-    else:
-        print(f"et est une feuille")
+    def count_interactions(self, theta : float) -> int:
+        """
+        Nombre d'interactions d'un calcul complet des accélérations avec l'arbre courant.
+        """
+        return count_interactions(self.node_start, self.node_end, self.node_child, self.node_nchild,
+                                  self.node_size, self.node_com, self.positions, theta)
 
-@njit(fastmath=True)
-def build_quadtree(box : np.ndarray, positions : np.ndarray) -> QuadtreeNode:
-    """
-    Construit le quadtree pour le système de N corps actuel.
-    """
-    center = np.array([(box[0][0] + box[1][0]) / 2., (box[0][1] + box[1][1]) / 2., (box[0][2] + box[1][2]) / 2.], dtype=np.float64)
-    size = float(max(box[1][0] - box[0][0], box[1][1] - box[0][1]))
-    size_z = float(box[1][2] - box[0][2])
-    quadtree_root = QuadtreeNode(center, size, size_z)
-    for i in range(positions.shape[0]):
-        insert_index_in_node(quadtree_root, i, positions)
-    return quadtree_root
+    def potential_energy(self, theta : float, positions : np.ndarray) -> float:
+        """
+        Énergie potentielle approchée des corps placés en positions (dans leur ordre d'origine) avec l'arbre
+        courant : ses nœuds et le choix des nœuds approximés sont ceux de sa construction, seuls les moments sont
+        recalculés. L'énergie est donc une fonction régulière des positions (pas de saut quand un corps change de
+        nœud), ce qui permet de comparer deux énergies calculées avec le même arbre.
+        """
+        moment_positions = np.ascontiguousarray(positions[self.order], dtype=np.float64)
+        masses = self.masses.astype(np.float64)
+        node_mass, moment_com, _ = compute_node_moments(self.node_start, self.node_end, self.node_child,
+                                                        self.node_nchild, moment_positions, masses, False)
+        return compute_potential_energy(self.node_start, self.node_end, self.node_child, self.node_nchild,
+                                        self.node_size, self.node_com, self.positions, node_mass, moment_com,
+                                        moment_positions, masses, theta)
 
 class NBodySystem:
-    def __init__(self, filename, theta=0.5):
+    def __init__(self, filename, theta=0.5, use_quadrupole=False, reorder_period=0, integrator="verlet",
+                 precision="float64"):
         """
         Initialise le système de N corps.
         
@@ -367,74 +455,89 @@ class NBodySystem:
 les données des corps
         theta : float
             Paramètre de Barnes-Hut (par défaut 0.5)
+        use_quadrupole : bool
+            Ajoute le moment quadripolaire des nœuds approximés (par défaut False)
+        reorder_period : int
+            Nombre de pas de temps entre deux renumérotations des corps selon l'ordre de Morton
+            (par défaut 0 : jamais)
+        integrator : str ou integrators.Integrator
+            Schéma d'intégration en temps (par défaut "verlet", voir integrators.make_integrator)
+        precision : str
+            Précision du stockage des corps et des sommes des forces : "mixed", "float32" ou "float64"
+            (par défaut) ; voir precision.py
         """
-        positions = []
-        velocities = []
-        masses = []
+        self.precision = make_precision(precision)
+        masses, positions, velocities = snapshot.load_bodies(filename)
+        self.max_mass = float(np.max(masses))
+        self.box = snapshot.bounding_box(positions) # Contient les coins min et max du système
         
-        self.max_mass = 0.
-        self.box = np.array([[-1.E-6, -1.E-6, -1.E-6], [1.E-6, 1.E-6, 1.E-6]], dtype=np.float64)
-        
-        with open(filename, "r") as fich:
-            line = fich.readline()
-            while line:
-                data = line.split()
-                masses.append(float(data[0]))
-                positions.append([float(data[1]), float(data[2]), float(data[3])])
-                velocities.append([float(data[4]), float(data[5]), float(data[6])])
-                self.max_mass = max(self.max_mass, masses[-1])
-                
-                for i in range(3):
-                    self.box[0][i] = min(self.box[0][i], positions[-1][i] - 1.E-6)
-                    self.box[1][i] = max(self.box[1][i], positions[-1][i] + 1.E-6)
-                
-                line = fich.readline()
-        
-        self.positions = np.array(positions, dtype=np.float64)
-        self.velocities = np.array(velocities, dtype=np.float64)
-        self.masses = np.array(masses, dtype=np.float64)
+        self.positions = np.array(positions, dtype=self.precision.storage)
+        self.velocities = np.array(velocities, dtype=self.precision.storage)
+        self.masses = np.array(masses, dtype=self.precision.storage)
         self.colors = [generate_star_color(m) for m in masses]
         self.theta = theta
-        
-@njit(parallel=True, fastmath=True)
-def compute_accelerations(quadtree_root : QuadtreeNode, positions : np.ndarray, masses : np.ndarray, theta : float) -> np.ndarray :
+        self.use_quadrupole = use_quadrupole
+        self.tree = Octree(precision=self.precision)
+        self.ids = np.arange(self.positions.shape[0])
+        # Accélération calculée au pas précédent pour les positions courantes (self.tree est l'arbre correspondant)
+        self.acceleration = None
+        self.integrator = integrators.make_integrator(integrator)
+        self.reorder_period = reorder_period
+        self.n_steps = 0
+
+    def reorder_bodies(self):
         """
-        Calcule les accélérations pour tous les corps dans le système.
-        
-        Returns:
-        --------
-        accelerations : np.ndarray
-            Tableau des accélérations [ax, ay, az] pour chaque corps
+        Renumérote les corps selon leur code de Morton. L'arbre trie déjà les corps à chaque construction, mais
+        ses copies triées (et le parcours des corps par blocs) deviennent alors des accès quasi séquentiels.
+        self.ids garde l'identifiant d'origine de chaque corps. L'arbre est reconstruit pour la nouvelle
+        numérotation (il sert aussi à potential_energy).
         """
-        accel = np.empty_like(positions,dtype=np.float64)
-        for i in prange(positions.shape[0]):
-            accel[i] = compute_acceleration(quadtree_root, positions[i], positions, masses, theta)
-        return accel
+        perm = morton.morton_order(self.positions)
+        self.positions = self.positions[perm]
+        self.velocities = self.velocities[perm]
+        self.masses = self.masses[perm]
+        self.colors = [self.colors[i] for i in perm]
+        self.ids = self.ids[perm]
+        if self.acceleration is not None:
+            self.acceleration = self.acceleration[perm]
+        self.integrator.permute(perm)
+        self.tree.build(self.positions, self.masses, self.use_quadrupole)
 
-@njit(parallel=True, fastmath=True)
-def update_positions_(dt : float, box : np.ndarray, positions : np.ndarray, velocities : np.ndarray, masses : np.ndarray, theta : float):
+    def positions_by_id(self):
+        """Positions des corps dans l'ordre du fichier d'origine (ordre attendu par l'affichage)."""
+        if self.reorder_period == 0:
+            return self.positions
+        return morton.in_original_order(self.positions, self.ids)
+
+    def evaluate_acceleration(self, targets : np.ndarray = None):
         """
-        Met à jour les positions et vitesses des corps.
-        
-        Parameters:
-        -----------
-        dt : float
-            Pas de temps
+        Construit l'octree pour les positions courantes et calcule l'accélération de chaque corps
+        (ou seulement des corps d'indices targets, dans cet ordre).
+        """
+        self.tree.build(self.positions, self.masses, self.use_quadrupole)
+        return self.tree.compute_accelerations(self.theta, self.use_quadrupole, targets)
+
+    def interaction_count(self) -> int:
+        """Nombre d'interactions d'un calcul complet des accélérations pour l'arbre courant."""
+        return self.tree.count_interactions(self.theta)
+
+    def potential_energy(self, positions : np.ndarray = None) -> float:
+        """
+        Énergie potentielle approchée (voir Octree.potential_energy) des corps placés en positions (par défaut les
+        positions courantes) avec l'arbre de la dernière évaluation des accélérations. Remplace la somme directe en
+        O(N²) dans integrators.total_energy (voir integrators.AdaptiveTimeStep).
         """
-        # Intégration de Verlet
-        quadtree_root : QuadtreeNode = build_quadtree(box, positions)
-        update_masses_com(quadtree_root, positions, masses)
-        finalize(quadtree_root)
-        accelerations = compute_accelerations(quadtree_root, positions, masses, theta)
-        for i in prange(positions.shape[0]):
-            positions[i,:] += velocities[i,:] * dt + 0.5 * accelerations[i,:] * dt * dt
-        quadtree_root = build_quadtree(box, positions)
-        update_masses_com(quadtree_root, positions, masses)
-        finalize(quadtree_root)
-        accelerations2 = compute_accelerations(quadtree_root, positions, masses, theta)
-        for i in prange(velocities.shape[0]):
-            velocities[i,:] += 0.5*(accelerations[i,:]+accelerations2[i,:]) * dt
-        return (positions, velocities)
+        return self.tree.potential_energy(self.theta, self.positions if positions is None else positions)
+
+    def update_positions(self, dt : float):
+        """
+        Avance le système d'un pas de temps dt avec l'intégrateur choisi (Verlet vitesse par défaut).
+        L'accélération aux nouvelles positions (et l'arbre construit pour elles) sert aussi au début du pas suivant.
+        """
+        if self.reorder_period > 0 and self.n_steps % self.reorder_period == 0:
+            self.reorder_bodies()
+        self.n_steps += 1
+        self.integrator.step(self, dt)
 
 system : NBodySystem
 
@@ -443,17 +546,10 @@ def update_positions(dt : float):
     Fonction callback pour la visualisation.
     """
     global system
-    box = system.box
-    positions = system.positions
-    velocities = system.velocities
-    masses = system.masses
-    theta = system.theta
-    positions, velocities = update_positions_(dt, box, positions, velocities, masses, theta)
-    system.positions = positions
-    system.velocities = velocities
-    return positions
-
-def run_simulation(filename, geometry=(800, 600), theta=0.5, dt=0.001):
+    system.update_positions(dt)
+    return system.positions_by_id()
+
+def run_simulation(filename, geometry=(800, 600), theta=0.5, dt=0.001, use_quadrupole=False):
     """
     Lance la simulation avec visualisation.
     
@@ -467,10 +563,13 @@ def run_simulation(filename, geometry=(800, 600), theta=0.5, dt=0.001):
         Paramètre de Barnes-Hut
     dt : float
         Pas de temps
+    use_quadrupole : bool
+        Ajoute le moment quadripolaire des nœuds approximés
     """
     import timeit
+    import visualizer3d
     global system
-    system = NBodySystem(filename, theta=theta)
+    system = NBodySystem(filename, theta=theta, use_quadrupole=use_quadrupole)
     
     # Initialiser la visualisation
     pos = system.positions
@@ -495,10 +594,13 @@ def run():
         dt = float(sys.argv[2])
     if len(sys.argv) > 3:
         theta = float(sys.argv[3])
+    use_quadrupole = len(sys.argv) > 4 and sys.argv[4] == "quad"
     
     print(f"Simulation Barnes-Hut de {filename} avec dt = {dt} et theta = {theta}")
+    if use_quadrupole:
+        print("Nœuds approximés avec correction quadripolaire")
     
-    run_simulation(filename, theta=theta, dt=dt)
+    run_simulation(filename, theta=theta, dt=dt, use_quadrupole=use_quadrupole)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,75 @@
+# Effet de la renumérotation des corps selon l'ordre de Morton sur la localité mémoire :
+#     - estimation du nombre de lignes de cache (64 octets) chargées lors du parcours des corps cellule par cellule
+#       (ordre des accès de la boucle de champ proche de la grille)
+#     - temps d'un calcul d'accélération pour la grille numba parallèle et pour Barnes-Hut, corps dans l'ordre du
+#       fichier contre corps triés selon leur code de Morton
+#
+# Usage : python3 bench_morton.py fichier [nx ny nz [theta]]
+#     Le fichier doit contenir au moins quelques dizaines de milliers de corps pour que les données ne tiennent
+#     plus dans les caches, par exemple : python3 galaxy_generator.py 50000 data/galaxy_50000
+import sys
+import time
+import numpy as np
+
+import nbodies_grid_numba_parallel as grid_numba
+import barnes_hut_numba as bh
+
+CACHE_LINE = 64
+
+def cache_lines_touched(body_order : np.ndarray, item_size : int) -> int:
+    """
+    Nombre de changements de ligne de cache quand on lit les corps dans l'ordre body_order, pour des
+    enregistrements de item_size octets (estimation des défauts de cache quand les données ne tiennent pas en cache).
+    """
+    lines = (body_order * item_size) // CACHE_LINE
+    return 1 + int(np.count_nonzero(lines[1:] != lines[:-1]))
+
+def best_time(func, repeat : int = 3):
+    func()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_grid(filename : str, ncells):
+    print(f"\n### Grille numba {ncells} ({filename})\n")
+    print("| ordre des corps | lignes de cache (parcours CSR) | accélération (ms) |")
+    print("| :-------------- | -----------------------------: | ----------------: |")
+    system = grid_numba.NBodySystem(filename, ncells_per_dir=ncells)
+    for label in ("fichier", "Morton"):
+        if label == "Morton":
+            system.reorder_bodies()
+        item_size = system.positions.itemsize * system.positions.shape[1]
+        lines = cache_lines_touched(system.grid.body_indices, item_size)
+        elapsed = best_time(system.compute_acceleration)
+        print(f"| {label} | {lines} | {1000*elapsed:.1f} |")
+
+def bench_barnes_hut(filename : str, theta : float):
+    print(f"\n### Barnes-Hut theta = {theta} ({filename})\n")
+    print("| ordre des corps | lignes de cache (copie triée) | construction (ms) | accélération (ms) |")
+    print("| :-------------- | ----------------------------: | ----------------: | ----------------: |")
+    system = bh.NBodySystem(filename, theta=theta)
+    for label in ("fichier", "Morton"):
+        if label == "Morton":
+            system.reorder_bodies()
+        build = best_time(lambda: system.tree.build(system.positions, system.masses))
+        item_size = system.positions.itemsize * system.positions.shape[1]
+        lines = cache_lines_touched(system.tree.order, item_size)
+        elapsed = best_time(lambda: system.tree.compute_accelerations(theta))
+        print(f"| {label} | {lines} | {1000*build:.1f} | {1000*elapsed:.1f} |")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage : python3 bench_morton.py fichier [nx ny nz [theta]]")
+        sys.exit(1)
+    filename = sys.argv[1]
+    ncells = (20, 20, 1)
+    theta = 0.5
+    if len(sys.argv) > 4:
+        ncells = (int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))
+    if len(sys.argv) > 5:
+        theta = float(sys.argv[5])
+    bench_grid(filename, ncells)
+    bench_barnes_hut(filename, theta)
@@ -0,0 +1,86 @@
+# Mesure du compromis précision / coût des modes de precision.py ("mixed", "float32", "float64") pour chaque moteur
+# (grille numpy, grilles numba séquentielle, parallèle et de l'affichage séparé, Barnes-Hut ; la grille MPI utilise
+# les noyaux de la grille numba parallèle) :
+#     - mémoire occupée par les corps (positions, vitesses, masses) et temps d'un calcul des accélérations
+#     - erreur relative des accélérations par rapport à une somme directe en float64, et par rapport au même moteur
+#       en float64 (même approximation du champ lointain : seule reste l'erreur due à la précision)
+#     - dérive relative de l'énergie totale |E - E0| / |E0| après n_pas pas de Verlet
+#
+# Usage : python3 bench_precision.py [fichier [dt n_pas]]
+#     (par défaut data/galaxy_5000, dt = 0.001 et 100 pas)
+import sys
+import numpy as np
+
+import nbodies_grid
+import nbodies_grid_numba
+import nbodies_grid_numba_parallel as grid_numba
+import barnes_hut_numba as bh
+import integrators
+from precision import PRECISIONS
+from bench_quadrupole import direct_acceleration, relative_errors, best_time
+
+def split_system(filename : str, precision : str):
+    """
+    NBodySystem de la grille de l'affichage séparé, importée à la demande : son module importe mpi4py et
+    l'affichage (sdl2, OpenGL), absents d'une machine sans affichage (ImportError, le moteur est alors ignoré).
+    """
+    import nbodies_grid_numba_parallel_split_affichage as split
+    return split.NBodySystem(filename, ncells_per_dir=(20, 20, 1), precision=precision)
+
+# Moteurs comparés : nom, constructeur de NBodySystem (fichier, precision)
+ENGINES = [
+    ("grille numpy (20x20x1)", lambda filename, precision: nbodies_grid.NBodySystem(
+        filename, ncells_per_dir=(20, 20, 1), integrator="verlet", precision=precision)),
+    ("grille numba séquentielle (20x20x1)", lambda filename, precision: nbodies_grid_numba.NBodySystem(
+        filename, ncells_per_dir=(20, 20, 1), precision=precision)),
+    ("grille numba (20x20x1)", lambda filename, precision: grid_numba.NBodySystem(
+        filename, ncells_per_dir=(20, 20, 1), precision=precision)),
+    ("Barnes-Hut (theta = 0.5)", lambda filename, precision: bh.NBodySystem(filename, precision=precision)),
+    ("grille numba de l'affichage séparé (20x20x1)", split_system),
+]
+
+def energy_drift(system, dt : float, n_steps : int) -> float:
+    """
+    Dérive relative de l'énergie totale après n_steps pas de temps dt. L'énergie potentielle est la somme directe
+    exacte (pas l'énergie approchée potential_energy des moteurs, dont l'erreur masquerait la dérive).
+    """
+    energy = integrators.total_energy(system, exact=True)
+    for _ in range(n_steps):
+        system.update_positions(dt)
+    return abs(integrators.total_energy(system, exact=True) - energy) / abs(energy)
+
+def bench_engine(name : str, make_system, filename : str, ref : np.ndarray, dt : float, n_steps : int):
+    print(f"\n### {name} ({filename}, {n_steps} pas de {dt})\n")
+    try:
+        make_system(filename, "float64")
+    except ImportError as error:
+        print(f"Moteur ignoré : {error}")
+        return
+    print("| précision | mémoire des corps (Mo) | temps (ms) | erreur médiane | erreur 99% "
+          "| écart médian au float64 | écart 99% au float64 | dérive de l'énergie |")
+    print("| :-------- | ---------------------: | ---------: | -------------: | ---------: "
+          "| ----------------------: | -------------------: | ------------------: |")
+    # Le mode float64 d'abord : il sert de référence aux autres
+    same_engine = None
+    for precision in ("float64",) + tuple(p for p in PRECISIONS if p != "float64"):
+        system = make_system(filename, precision)
+        memory = (system.positions.nbytes + system.velocities.nbytes + system.masses.nbytes) / 2**20
+        acc, elapsed = best_time(system.evaluate_acceleration)
+        acc = acc.astype(np.float64)
+        if same_engine is None:
+            same_engine = acc
+        med, p99, _ = relative_errors(acc, ref)
+        same_med, same_p99, _ = relative_errors(acc, same_engine)
+        system.acceleration = None
+        drift = energy_drift(system, dt, n_steps)
+        print(f"| {precision} | {memory:.2f} | {1000*elapsed:.1f} | {med:.2e} | {p99:.2e} "
+              f"| {same_med:.2e} | {same_p99:.2e} | {drift:.2e} |")
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "data/galaxy_5000"
+    dt = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    n_steps = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    system = bh.NBodySystem(filename)
+    ref = direct_acceleration(system.positions, system.masses)
+    for name, make_system in ENGINES:
+        bench_engine(name, make_system, filename, ref, dt, n_steps)
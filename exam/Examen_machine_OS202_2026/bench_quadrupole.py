@@ -0,0 +1,105 @@
+# Mesure du compromis précision / coût de l'approximation du champ lointain :
+#     - grille numba parallèle : monopôle (centre de masse) contre monopôle + quadripôle, pour plusieurs grilles
+#     - Barnes-Hut : monopôle contre monopôle + quadripôle, pour plusieurs valeurs de theta
+# L'erreur est mesurée par rapport à une somme directe en O(N²).
+#
+# Usage : python3 bench_quadrupole.py [fichier ...]
+#     (par défaut data/galaxy_1000 et data/galaxy_5000)
+import sys
+import time
+import numpy as np
+from numba import njit, prange
+
+import nbodies_grid_numba_parallel as grid_numba
+import barnes_hut_numba as bh
+
+G = grid_numba.G
+
+@njit(parallel=True)
+def direct_acceleration(positions : np.ndarray, masses : np.ndarray) -> np.ndarray:
+    """
+    Accélération de référence calculée par sommation directe sur tous les couples de corps (en double précision).
+    """
+    n_bodies = positions.shape[0]
+    acc = np.zeros((n_bodies, 3), dtype=np.float64)
+    for i in prange(n_bodies):
+        ax = 0.
+        ay = 0.
+        az = 0.
+        for j in range(n_bodies):
+            dx = positions[j,0] - positions[i,0]
+            dy = positions[j,1] - positions[i,1]
+            dz = positions[j,2] - positions[i,2]
+            d2 = dx*dx + dy*dy + dz*dz
+            if d2 > 1.E-20:
+                inv_d3 = G * masses[j] / (d2*np.sqrt(d2))
+                ax += inv_d3*dx
+                ay += inv_d3*dy
+                az += inv_d3*dz
+        acc[i,0] = ax
+        acc[i,1] = ay
+        acc[i,2] = az
+    return acc
+
+def relative_errors(acc : np.ndarray, ref : np.ndarray):
+    """
+    Erreur relative par corps |a - a_ref| / |a_ref|, résumée par sa médiane, son 99e centile et son maximum.
+    """
+    err = np.linalg.norm(acc - ref, axis=1) / np.maximum(np.linalg.norm(ref, axis=1), 1.E-300)
+    return np.median(err), np.percentile(err, 99), np.max(err)
+
+def best_time(func, repeat : int = 3):
+    """
+    Exécute func une première fois (compilation JIT) puis retourne son résultat et le meilleur temps sur repeat appels.
+    """
+    result = func()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def bench_grid(filename : str, ref : np.ndarray, grids):
+    print(f"\n### Grille numba ({filename})\n")
+    print("| grille | champ lointain | erreur médiane | erreur 99% | erreur max | temps (ms) |")
+    print("| :----- | :------------- | -------------: | ---------: | ---------: | ---------: |")
+    for ncells in grids:
+        for use_quadrupole in (False, True):
+            system = grid_numba.NBodySystem(filename, ncells_per_dir=ncells, use_quadrupole=use_quadrupole)
+
+            def evaluate():
+                system.grid.update(system.positions, system.masses)
+                return system.compute_acceleration()
+
+            acc, elapsed = best_time(evaluate)
+            med, p99, emax = relative_errors(acc, ref)
+            label = "quadripôle" if use_quadrupole else "monopôle"
+            print(f"| {ncells} | {label} | {med:.2e} | {p99:.2e} | {emax:.2e} | {1000*elapsed:.1f} |")
+
+def bench_barnes_hut(filename : str, ref : np.ndarray, thetas):
+    print(f"\n### Barnes-Hut ({filename})\n")
+    print("| theta | champ lointain | erreur médiane | erreur 99% | erreur max | temps (ms) |")
+    print("| :---- | :------------- | -------------: | ---------: | ---------: | ---------: |")
+    system = bh.NBodySystem(filename)
+    for theta in thetas:
+        for use_quadrupole in (False, True):
+
+            def evaluate():
+                system.tree.build(system.positions, system.masses, use_quadrupole)
+                return system.tree.compute_accelerations(theta, use_quadrupole)
+
+            acc, elapsed = best_time(evaluate)
+            med, p99, emax = relative_errors(acc, ref)
+            label = "quadripôle" if use_quadrupole else "monopôle"
+            print(f"| {theta} | {label} | {med:.2e} | {p99:.2e} | {emax:.2e} | {1000*elapsed:.1f} |")
+
+if __name__ == "__main__":
+    filenames = sys.argv[1:] if len(sys.argv) > 1 else ["data/galaxy_1000", "data/galaxy_5000"]
+    grids = [(5,5,1), (10,10,1), (20,20,1), (40,40,1)]
+    thetas = [0.3, 0.5, 0.7, 1.0]
+    for filename in filenames:
+        system = grid_numba.NBodySystem(filename)
+        ref = direct_acceleration(system.positions.astype(np.float64), system.masses.astype(np.float64))
+        bench_grid(filename, ref, grids)
+        bench_barnes_hut(filename, ref, thetas)
@@ -0,0 +1,130 @@
+# Boîte des grilles pour les simulations longues.
+#     Une boîte fixe range les corps qui s'en échappent dans les cellules du bord, qui se remplissent et dont le
+#     champ proche devient très coûteux ; une boîte qui suit tous les corps grandit sans fin et ses cellules,
+#     de plus en plus grandes, se vident presque toutes. On suit donc une boîte « cœur » qui contient presque tous
+#     les corps et n'est modifiée qu'avec hystérésis ; les rares corps qui en sortent (corps éloignés) ne sont pas
+#     rangés dans la grille et sont traités par sommation directe.
+#
+#     Un corps éloigné coûte de l'ordre de 2N interactions par calcul des forces, contre quelques centaines pour un
+#     corps de la grille : on cherche à en garder peu (max_outliers). Mais une boîte qui suit des corps qui
+#     s'échappent finit par entasser tous les autres dans quelques cellules (coût proche de N^2) : au-delà d'une
+#     certaine distance du cœur, un corps reste hors de la boîte quel que soit leur nombre.
+#
+#     Avec max_outliers = 0, la boîte contient tous les corps et chaque corps qui en sort la déplace (reconstruction
+#     complète de la grille) : sur data/galaxy_5000 avec dt = 0.05, 10 déplacements en 25 mises à jour contre aucun
+#     avec max_outliers = 5. Par défaut (max_outliers = None), on vise donc DEFAULT_OUTLIER_FRACTION des corps.
+import numpy as np
+
+# Proportion de corps laissés hors de la boîte par défaut
+DEFAULT_OUTLIER_FRACTION = 1.E-3
+
+def default_max_outliers(n_bodies : int) -> int:
+    """Nombre de corps hors de la boîte visé par défaut : DEFAULT_OUTLIER_FRACTION des corps, au moins 1."""
+    return max(1, int(DEFAULT_OUTLIER_FRACTION * n_bodies))
+
+class CoreBox:
+    """
+    Boîte cœur d'une grille.
+
+    Le cœur est délimité sur chaque axe par les barrières de Tukey [Q1 - fence.(Q3 - Q1), Q3 + fence.(Q3 - Q1)]
+    (Q1 et Q3 : premier et troisième quartiles), ramenées aux positions extrêmes, ce qui ne dépend pas de la
+    proportion de corps qui s'échappent. S'il laisse dehors plus de max_outliers corps, il est élargi jusqu'à
+    n'en laisser qu'au plus max_outliers // 6 de chaque côté de chaque axe, sans dépasser max_growth fois sa
+    largeur ; s'il en laisse encore dehors plus de max_outliers, il n'est pas élargi.
+
+    La boîte est le cœur élargi de slack fois sa largeur de chaque côté. Le cœur est recalculé tous les
+    check_period appels à update, ou dès que plus de max_outliers corps sont sortis de la boîte depuis le calcul
+    précédent ; la boîte n'est refaite que si le cœur n'y tient plus ou si elle est devenue nettement trop
+    grande (la boîte refaite mesurerait moins de shrink_ratio fois sa largeur sur un axe). Tant que ce n'est
+    pas le cas, les cellules de la grille ne changent pas.
+    """
+    def __init__(self, positions : np.ndarray, max_outliers : int = None, fence : float = 1.5, max_growth : float = 2.,
+                 slack : float = 0.1, shrink_ratio : float = 0.7, check_period : int = 50):
+        """
+        :param max_outliers: Nombre de corps hors de la boîte visé (None : default_max_outliers, 0 : la boîte
+                             contient toujours tous les corps, qu'elle suit avec hystérésis)
+        :param fence: Coefficient des barrières de Tukey délimitant le cœur
+        :param max_growth: Élargissement maximal (en proportion de sa largeur) du cœur pour ne pas laisser dehors
+                           plus de max_outliers corps
+        :param slack: Marge de la boîte de chaque côté du cœur, en proportion de sa largeur
+        :param shrink_ratio: La boîte est refaite si la boîte refaite mesurerait moins de shrink_ratio fois sa
+                             largeur sur un axe
+        :param check_period: Nombre d'appels à update entre deux calculs du cœur
+        """
+        self.max_outliers = default_max_outliers(positions.shape[0]) if max_outliers is None else max_outliers
+        self.fence = fence
+        self.max_growth = max_growth
+        self.slack = slack
+        self.shrink_ratio = shrink_ratio
+        self.check_period = check_period
+        self.n_updates = 0
+        self.n_changes = 0
+        core_min, core_max = self.core(positions)
+        self.min_bounds, self.max_bounds = self.around(core_min, core_max)
+        # Nombre de corps hors de la boîte au dernier calcul du cœur
+        self.n_outside = int(np.count_nonzero(self.outside(positions)))
+
+    def core(self, positions : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Coins min et max du cœur des positions.
+        """
+        n_bodies = positions.shape[0]
+        if n_bodies == 0:
+            return np.zeros(3), np.zeros(3)
+        low, high = np.min(positions, axis=0).astype(np.float64), np.max(positions, axis=0).astype(np.float64)
+        if self.max_outliers == 0:
+            return low, high
+        q1, q3 = np.quantile(positions, [0.25, 0.75], axis=0)
+        core_min = np.maximum(low, q1 - self.fence * (q3 - q1))
+        core_max = np.minimum(high, q3 + self.fence * (q3 - q1))
+        outside = np.any((positions < core_min) | (positions > core_max), axis=1)
+        if np.count_nonzero(outside) > self.max_outliers:
+            # Au plus max_outliers // 6 corps laissés de chaque côté de chaque axe, dans la limite de max_growth
+            k = min(self.max_outliers // 6, n_bodies - 1)
+            growth = 0.5 * (self.max_growth - 1.) * (core_max - core_min)
+            wide_min = np.maximum(core_min - growth, np.minimum(core_min, np.partition(positions, k, axis=0)[k]))
+            wide_max = np.minimum(core_max + growth, np.maximum(core_max, -np.partition(-positions, k, axis=0)[k]))
+            # Inutile d'agrandir les cellules si les corps laissés dehors restent trop nombreux (corps qui s'échappent)
+            outside = np.any((positions < wide_min) | (positions > wide_max), axis=1)
+            if np.count_nonzero(outside) <= self.max_outliers:
+                core_min, core_max = wide_min, wide_max
+        return np.asarray(core_min, dtype=np.float64), np.asarray(core_max, dtype=np.float64)
+
+    def around(self, core_min : np.ndarray, core_max : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Boîte placée autour du cœur (marge slack, et au moins 1.E-6 comme les boîtes d'origine).
+        """
+        margin = self.slack * (core_max - core_min) + 1.E-6
+        return core_min - margin, core_max + margin
+
+    def extent(self) -> np.ndarray:
+        """Largeur de la boîte sur chaque axe."""
+        return self.max_bounds - self.min_bounds
+
+    def update(self, positions : np.ndarray, n_outside : int) -> bool:
+        """
+        Refait la boîte autour du cœur des positions si c'est nécessaire.
+
+        :param n_outside: Nombre de corps hors de la boîte courante (connu de la répartition dans les cellules)
+        :return: Vrai si la boîte a changé (toutes les cellules sont à refaire)
+        """
+        self.n_updates += 1
+        if (n_outside <= self.n_outside + self.max_outliers and
+            (self.check_period == 0 or self.n_updates % self.check_period != 0)):
+            return False
+        core_min, core_max = self.core(positions)
+        min_bounds, max_bounds = self.around(core_min, core_max)
+        if (np.all(core_min >= self.min_bounds) and np.all(core_max <= self.max_bounds) and
+            np.all(max_bounds - min_bounds >= self.shrink_ratio * self.extent())):
+            self.n_outside = n_outside
+            return False
+        self.min_bounds, self.max_bounds = min_bounds, max_bounds
+        self.n_outside = int(np.count_nonzero(self.outside(positions)))
+        self.n_changes += 1
+        return True
+
+    def outside(self, positions : np.ndarray) -> np.ndarray:
+        """
+        Masque des corps hors de la boîte.
+        """
+        return np.any((positions < self.min_bounds) | (positions > self.max_bounds), axis=1)
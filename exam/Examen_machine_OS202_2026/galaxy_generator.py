@@ -2,7 +2,7 @@
 Module pour générer une galaxie avec des étoiles en orbite stable autour d'un trou noir central.
 """
 import numpy as np
-import random
+import snapshot
 
 # Unités:
 # - Distance: année-lumière (ly)
@@ -19,16 +19,27 @@ import random
 G = 1.560339e-13  # ly^3 / (M_sun * an^2)
 
 
-def generate_stable_orbit(black_hole_mass, star_mass, min_radius=0.001, max_radius=1.0):
+# Nombre d'étoiles tirées avec un même flux de nombres aléatoires. Chaque bloc a son propre générateur (dérivé
+# de la graine et du numéro du bloc) : le résultat ne dépend ni de la taille des morceaux écrits, ni de l'ordre
+# dans lequel les blocs sont calculés.
+SEED_BLOCK_SIZE = 1 << 16
+# Nombre d'étoiles générées (et écrites) à la fois par défaut (environ 60 Mo de données en double précision)
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def generate_stable_orbits(rng, black_hole_mass, n_stars, min_radius=0.001, max_radius=1.0):
     """
-    Génère une position et vitesse pour une étoile en orbite elliptique stable.
+    Génère (en une seule passe vectorisée) les positions et vitesses de n_stars étoiles en orbites
+    elliptiques stables autour du trou noir central.
     
     Parameters:
     -----------
+    rng : np.random.Generator
+        Générateur de nombres aléatoires
     black_hole_mass : float
         Masse du trou noir central (en masses solaires)
-    star_mass : float
-        Masse de l'étoile (en masses solaires)
+    n_stars : int
+        Nombre d'étoiles
     min_radius : float
         Rayon minimal de l'orbite (en années-lumière)
     max_radius : float
@@ -36,56 +47,40 @@ def generate_stable_orbit(black_hole_mass, star_mass, min_radius=0.001, max_radi
     
     Returns:
     --------
-    position : np.array
-        Position 3D de l'étoile (x, y, z) en années-lumière
-    velocity : np.array
-        Vitesse 3D de l'étoile (vx, vy, vz) en années-lumière par an
+    positions : np.ndarray
+        Positions 3D (n_stars, 3) des étoiles en années-lumière
+    velocities : np.ndarray
+        Vitesses 3D (n_stars, 3) des étoiles en années-lumière par an
     """
-    # Masse en masses solaires (pas de conversion nécessaire)
-    M_bh = black_hole_mass
-    
-    # Génération d'une position aléatoire dans un disque galactique
     # Distance au centre (semi-grand axe de l'orbite elliptique)
-    radius = random.uniform(min_radius, max_radius)
-    
+    radius = rng.uniform(min_radius, max_radius, n_stars)
     # Angle dans le plan du disque galactique
-    theta = random.uniform(0, 2 * np.pi)
-    
+    theta = rng.uniform(0, 2 * np.pi, n_stars)
     # Inclinaison par rapport au plan (faible pour simuler un disque)
-    inclination = random.gauss(0, 0.1)  # Faible inclinaison
-    
-    # Position dans le plan (x, y)
-    x = radius * np.cos(theta)
-    y = radius * np.sin(theta)
-    z = radius * np.sin(inclination)
-    
-    position = np.array([x, y, z])
-    
-    # Calcul de la vitesse orbitale pour une orbite circulaire
-    # v = sqrt(G * M / r) en ly/an
-    r = np.linalg.norm(position)
-    v_orbital = np.sqrt(G * M_bh / r)
-    
+    inclination = rng.normal(0, 0.1, n_stars)
     # Excentricité de l'orbite (0 = circulaire, proche de 1 = très elliptique)
-    eccentricity = random.uniform(0.0, 0.7)
-    
-    # Ajustement de la vitesse en fonction de l'excentricité
-    # Pour une orbite elliptique, la vitesse varie selon la position
-    v_magnitude = v_orbital * np.sqrt(1 + eccentricity)
+    eccentricity = rng.uniform(0.0, 0.7, n_stars)
+    # Composante verticale aléatoire faible de la vitesse (relative à sa norme)
+    z_factor = rng.normal(0, 0.05, n_stars)
     
-    # Direction de la vitesse (perpendiculaire au rayon dans le plan orbital)
-    # Vecteur unitaire dans la direction tangentielle
-    tangent = np.array([-y, x, 0])
-    if np.linalg.norm(tangent) > 0:
-        tangent = tangent / np.linalg.norm(tangent)
+    positions = np.empty((n_stars, 3), dtype=np.float64)
+    positions[:, 0] = radius * np.cos(theta)
+    positions[:, 1] = radius * np.sin(theta)
+    positions[:, 2] = radius * np.sin(inclination)
     
-    # Ajout d'une composante verticale aléatoire faible
-    z_component = random.gauss(0, 0.05) * v_magnitude
+    # Vitesse orbitale circulaire v = sqrt(G * M / r) en ly/an, ajustée selon l'excentricité
+    r = np.linalg.norm(positions, axis=1)
+    v_magnitude = np.sqrt(G * black_hole_mass / r) * np.sqrt(1 + eccentricity)
     
-    velocity = v_magnitude * tangent
-    velocity[2] += z_component
+    # Direction de la vitesse : tangente au cercle dans le plan (x, y), perpendiculaire au rayon
+    planar = np.hypot(positions[:, 0], positions[:, 1])
+    planar = np.where(planar > 0, planar, 1.)
+    velocities = np.empty((n_stars, 3), dtype=np.float64)
+    velocities[:, 0] = -v_magnitude * positions[:, 1] / planar
+    velocities[:, 1] = v_magnitude * positions[:, 0] / planar
+    velocities[:, 2] = z_factor * v_magnitude
     
-    return position, velocity
+    return positions, velocities
 
 
 def generate_star_color(mass):
@@ -109,7 +104,7 @@ def generate_star_color(mass):
     elif mass > 2.0:
         # Étoiles moyennes-massives: blanc
         return (255, 255, 255)
-    elif mass > 1.0:
+    elif mass >= 1.0:
         # Étoiles comme le Soleil: jaune
         return (255, 255, 200)
     else:
@@ -117,14 +112,133 @@ def generate_star_color(mass):
         return (255, 150, 100)
 
 
+def generate_star_colors(masses):
+    """
+    Version vectorisée de generate_star_color (mêmes seuils : masse >= 1, > 2 et > 5).
+    
+    Returns:
+    --------
+    colors : np.ndarray
+        Couleurs RGB (n, 3) (uint8)
+    """
+    masses = np.asarray(masses)
+    palette = np.array([(255, 150, 100), (255, 255, 200), (255, 255, 255), (150, 180, 255)], dtype=np.uint8)
+    return palette[(masses >= 1.0).astype(np.int64) + (masses > 2.0) + (masses > 5.0)]
+
+
+def generate_star_block(entropy, block, n_stars, black_hole_mass, star_mass_range=(0.5, 10.0),
+                        min_orbital_radius=0.001, max_orbital_radius=1.0):
+    """
+    Génère les étoiles du bloc numéro block (au plus SEED_BLOCK_SIZE étoiles) avec le générateur propre à ce bloc.
+    
+    Returns:
+    --------
+    masses, positions, velocities : np.ndarray
+        Masses (n,), positions (n, 3) et vitesses (n, 3) des étoiles du bloc
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(block,)))
+    masses = rng.uniform(star_mass_range[0], star_mass_range[1], n_stars)
+    positions, velocities = generate_stable_orbits(rng, black_hole_mass, n_stars,
+                                                   min_orbital_radius, max_orbital_radius)
+    return masses, positions, velocities
+
+
+def generate_galaxy_chunks(n_stars,
+                           black_hole_mass=None,
+                           star_mass_range=(0.5, 10.0),
+                           min_orbital_radius=0.001,
+                           max_orbital_radius=1.0,
+                           seed=None,
+                           chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Génère la galaxie morceau par morceau, pour ne jamais avoir plus de chunk_size corps en mémoire.
+    Le premier morceau commence par le trou noir central. Pour une même graine, la concaténation des morceaux
+    est identique quelle que soit chunk_size.
+    
+    Yields:
+    -------
+    masses, positions, velocities : np.ndarray
+        Masses (n,), positions (n, 3) et vitesses (n, 3) des corps du morceau
+    """
+    seed_sequence = np.random.SeedSequence(seed)
+    # Masse du trou noir tirée avec le générateur racine, les étoiles avec les générateurs des blocs
+    if black_hole_mass is None:
+        black_hole_mass = np.random.default_rng(seed_sequence).uniform(1e5, 1e10)
+    chunk_size = max(SEED_BLOCK_SIZE, chunk_size // SEED_BLOCK_SIZE * SEED_BLOCK_SIZE)
+    
+    first = True
+    for chunk_start in range(0, max(n_stars, 1), chunk_size):
+        blocks = []
+        for block_start in range(chunk_start, min(chunk_start + chunk_size, n_stars), SEED_BLOCK_SIZE):
+            blocks.append(generate_star_block(seed_sequence.entropy, block_start // SEED_BLOCK_SIZE,
+                                              min(SEED_BLOCK_SIZE, n_stars - block_start), black_hole_mass,
+                                              star_mass_range, min_orbital_radius, max_orbital_radius))
+        if first:
+            # Trou noir central (position et vitesse nulles)
+            blocks.insert(0, (np.array([black_hole_mass]), np.zeros((1, 3)), np.zeros((1, 3))))
+            first = False
+        yield tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+
+def write_galaxy(output_file, n_stars, seed=None, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+    """
+    Génère une galaxie et l'écrit morceau par morceau dans output_file (binaire si le nom se termine par .nbs,
+    texte sinon), sans jamais la stocker entièrement en mémoire.
+    Les autres paramètres sont ceux de generate_galaxy_chunks.
+    
+    Returns:
+    --------
+    stats : dict
+        Masse du trou noir, masse totale, masse moyenne des étoiles, distances min/max des étoiles au centre
+    """
+    n_bodies = n_stars + 1
+    binary = output_file.endswith(snapshot.BINARY_SUFFIX)
+    if binary:
+        records = snapshot.create_snapshot(output_file, n_bodies)
+    else:
+        text_file = open(output_file, "w")
+    stats = {"total_mass": 0., "min_distance": np.inf, "max_distance": 0.}
+    box = snapshot.bounding_box(np.zeros((0, 3)))
+    start = 0
+    for masses, positions, velocities in generate_galaxy_chunks(n_stars, seed=seed, chunk_size=chunk_size,
+                                                                **kwargs):
+        if start == 0:
+            stats["black_hole_mass"] = masses[0]
+        stats["total_mass"] += np.sum(masses)
+        chunk_box = snapshot.bounding_box(positions)
+        box[0] = np.minimum(box[0], chunk_box[0])
+        box[1] = np.maximum(box[1], chunk_box[1])
+        distances = np.linalg.norm(positions[1:] if start == 0 else positions, axis=1)
+        if distances.shape[0] > 0:
+            stats["min_distance"] = min(stats["min_distance"], np.min(distances))
+            stats["max_distance"] = max(stats["max_distance"], np.max(distances))
+        if binary:
+            records[start:start + masses.shape[0]]["mass"] = masses
+            records[start:start + masses.shape[0]]["position"] = positions
+            records[start:start + masses.shape[0]]["velocity"] = velocities
+        else:
+            np.savetxt(text_file, np.column_stack((masses, positions, velocities)), fmt="%.6e", delimiter=" ")
+        start += masses.shape[0]
+    if binary:
+        records.flush()
+        del records
+        snapshot.set_box(output_file, box)
+    else:
+        text_file.close()
+    stats["mean_star_mass"] = (stats["total_mass"] - stats["black_hole_mass"]) / max(n_stars, 1)
+    return stats
+
+
 def generate_galaxy(n_stars, 
                    black_hole_mass=None,
                    star_mass_range=(0.5, 10.0),
                    min_orbital_radius=0.001,
                    max_orbital_radius=1.0,
-                   output_file=None):
+                   output_file=None,
+                   seed=None):
     """
-    Génère une galaxie avec n étoiles en orbite autour d'un trou noir central.
+    Génère une galaxie avec n étoiles en orbite autour d'un trou noir central (entièrement en mémoire ;
+    voir write_galaxy pour écrire directement de très grandes galaxies).
     
     Parameters:
     -----------
@@ -139,96 +253,72 @@ def generate_galaxy(n_stars,
     max_orbital_radius : float
         Rayon orbital maximum (en années-lumière)
     output_file : str, optional
-        Nom du fichier de sortie (si None, ne sauvegarde pas)
+        Nom du fichier de sortie (si None, ne sauvegarde pas ; binaire si le nom se termine par .nbs)
+    seed : int, optional
+        Graine du générateur aléatoire (si None, galaxie différente à chaque appel)
     
     Returns:
     --------
-    masses : list
-        Liste des masses (trou noir + étoiles)
-    positions : list
-        Liste des positions
-    velocities : list
-        Liste des vitesses
-    colors : list
-        Liste des couleurs RGB
-    """
-    # Génération de la masse du trou noir si non spécifiée
-    if black_hole_mass is None:
-        black_hole_mass = random.uniform(1e5, 1e10)
-    
-    # Listes pour stocker les données
-    masses = []
-    positions = []
-    velocities = []
-    colors = []
-    
-    # Ajout du trou noir central (position et vitesse nulles)
-    masses.append(black_hole_mass)
-    positions.append([0.0, 0.0, 0.0])
-    velocities.append([0.0, 0.0, 0.0])
-    colors.append((0, 0, 0))  # Noir pour le trou noir
-    
-    # Génération des étoiles
-    for i in range(n_stars):
-        # Masse aléatoire de l'étoile
-        star_mass = random.uniform(star_mass_range[0], star_mass_range[1])
-        
-        # Génération de l'orbite stable
-        pos, vel = generate_stable_orbit(black_hole_mass, star_mass, 
-                                         min_orbital_radius, max_orbital_radius)
-        
-        # Couleur de l'étoile
-        color = generate_star_color(star_mass)
-        
-        # Ajout aux listes
-        masses.append(star_mass)
-        positions.append(pos.tolist())
-        velocities.append(vel.tolist())
-        colors.append(color)
+    masses : np.ndarray
+        Masses (n_stars + 1,) (trou noir + étoiles)
+    positions : np.ndarray
+        Positions (n_stars + 1, 3)
+    velocities : np.ndarray
+        Vitesses (n_stars + 1, 3)
+    colors : np.ndarray
+        Couleurs RGB (n_stars + 1, 3)
+    """
+    chunks = list(generate_galaxy_chunks(n_stars, black_hole_mass, star_mass_range, min_orbital_radius,
+                                         max_orbital_radius, seed=seed, chunk_size=max(n_stars, 1)))
+    masses, positions, velocities = (np.concatenate(arrays) for arrays in zip(*chunks))
+    colors = generate_star_colors(masses)
+    colors[0] = (0, 0, 0)  # Noir pour le trou noir
     
     # Sauvegarde dans un fichier si spécifié
     if output_file is not None:
-        with open(output_file, 'w') as f:
-            for i in range(len(masses)):
-                # Format: masse px py pz vx vy vz
-                f.write(f"{masses[i]:.6e} ")
-                f.write(f"{positions[i][0]:.6e} {positions[i][1]:.6e} {positions[i][2]:.6e} ")
-                f.write(f"{velocities[i][0]:.6e} {velocities[i][1]:.6e} {velocities[i][2]:.6e}\n")
+        # Format binaire si le nom se termine par .nbs, sinon texte "masse px py pz vx vy vz" (cf. snapshot.py)
+        snapshot.save_bodies(output_file, masses, positions, velocities)
         
         print(f"Galaxie générée avec {n_stars} étoiles et sauvegardée dans '{output_file}'")
-        print(f"Masse du trou noir central: {black_hole_mass:.2e} masses solaires")
+        print(f"Masse du trou noir central: {masses[0]:.2e} masses solaires")
     
     return masses, positions, velocities, colors
 
 
 def main():
     """
-    Fonction principale pour tester le générateur de galaxie.
+    Fonction principale : génère une galaxie et l'écrit morceau par morceau.
+    Usage : python3 galaxy_generator.py [nombre étoiles [fichier de sortie [graine]]]
     """
     import sys
+    import time
     
     # Paramètres par défaut
     n_stars = 100
     output_file = "data/galaxy_100"
+    seed = None
     
     # Lecture des arguments de ligne de commande
     if len(sys.argv) > 1:
         n_stars = int(sys.argv[1])
     if len(sys.argv) > 2:
         output_file = sys.argv[2]
+    if len(sys.argv) > 3:
+        seed = int(sys.argv[3])
     
     # Génération de la galaxie
-    masses, positions, velocities, colors = generate_galaxy(
-        n_stars=n_stars,
-        output_file=output_file
-    )
+    start = time.perf_counter()
+    stats = write_galaxy(output_file, n_stars, seed=seed)
+    elapsed = time.perf_counter() - start
     
+    print(f"Galaxie générée avec {n_stars} étoiles et sauvegardée dans '{output_file}' en {elapsed:.2f} s")
+    print(f"Masse du trou noir central: {stats['black_hole_mass']:.2e} masses solaires")
     print(f"\nStatistiques de la galaxie:")
-    print(f"  - Nombre total d'objets: {len(masses)}")
+    print(f"  - Nombre total d'objets: {n_stars + 1}")
     print(f"  - Nombre d'étoiles: {n_stars}")
-    print(f"  - Masse totale: {sum(masses):.2e} masses solaires")
-    print(f"  - Masse moyenne des étoiles: {np.mean(masses[1:]):.2f} masses solaires")
-    print(f"  - Distance min/max: {min(np.linalg.norm(p) for p in positions[1:]):.4f} / {max(np.linalg.norm(p) for p in positions[1:]):.4f} années-lumière")
+    print(f"  - Masse totale: {stats['total_mass']:.2e} masses solaires")
+    print(f"  - Masse moyenne des étoiles: {stats['mean_star_mass']:.2f} masses solaires")
+    print(f"  - Distance min/max: {stats['min_distance']:.4f} / {stats['max_distance']:.4f} années-lumière")
 
 
 if __name__ == "__main__":
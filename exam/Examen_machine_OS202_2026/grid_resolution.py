@@ -0,0 +1,56 @@
+# Choix automatique de la résolution des grilles (nombre de cellules dans chaque direction), commun aux moteurs à
+# grille (numpy, numba séquentielle, parallèle et de l'affichage séparé, MPI) :
+#     - ncells_per_dir = "auto" à la place d'un triplet (nx, ny, nz) demande ce choix
+#     - choose_cell_counts minimise un modèle du coût d'un calcul des accélérations (champ proche corps par corps,
+#       champ lointain par cellule) d'après le nombre de corps et la forme de leur boîte
+# Le modèle ne dépend que de numpy : la grille numpy s'en sert sans importer numba.
+import numpy as np
+
+AUTO = "auto"
+
+def is_auto(ncells_per_dir) -> bool:
+    """Vrai si ncells_per_dir demande le choix automatique de la grille."""
+    return isinstance(ncells_per_dir, str) and ncells_per_dir == AUTO
+
+def choose_cell_counts( n_bodies : int, extent : np.ndarray, near_far_cost_ratio : float = 1.,
+                        fill_ratio : float = 1., max_cells : int = 1 << 20, max_aspect : float = 4.,
+                        near_width : int = 5 ) -> np.ndarray:
+    """
+    Nombre de cellules dans chaque direction minimisant le coût estimé d'un calcul des accélérations.
+
+    Les cellules sont à peu près cubiques, de côté h ; une direction d'étendue au plus max_aspect.h peut ne pas
+    être découpée (une seule cellule, par exemple dans l'épaisseur d'un disque). Des cellules plus allongées
+    rendraient l'approximation du champ lointain par le centre de masse trop grossière. Pour M cellules occupées
+    (fill_ratio des cellules de la grille) et un voisinage proche de min(near_width, n_i) cellules dans chaque
+    direction, un corps a environ V.N/M voisins proches et M - V cellules lointaines ; on minimise
+    ratio.V.N/M + (M - V), ratio étant le coût d'une interaction proche rapporté à celui d'une interaction avec
+    une cellule lointaine.
+
+    :param extent: Dimensions de la boîte englobante
+    :param near_far_cost_ratio: Rapport mesuré du coût d'une interaction proche à celui d'une interaction lointaine
+    :param fill_ratio: Proportion mesurée (ou supposée) de cellules occupées
+    :param near_width: Largeur en cellules du voisinage proche (5 pour les grilles numba, distance de Chebyshev
+                       <= 2 ; 3 pour la grille numpy, distance <= 1)
+    """
+    extent = np.maximum(np.asarray(extent, dtype=np.float64), 0.)
+    largest = max(float(np.max(extent)), 1.E-30)
+    best_counts = np.ones(3, dtype=np.int64)
+    best_cost = np.inf
+    # Parcours de la taille de cellule h, de la boîte entière à des cellules 2^12 fois plus petites
+    for h in largest * np.logspace(0., -12., 241, base=2.):
+        cubic = np.maximum(1, np.round(extent / h)).astype(np.int64)
+        # Chaque direction est découpée en cellules de taille h, ou pas du tout si elle est assez mince
+        for flat in range(8):
+            if any(flat & (1 << i) and extent[i] > max_aspect * h for i in range(3)):
+                continue
+            counts = np.array([1 if flat & (1 << i) else cubic[i] for i in range(3)], dtype=np.int64)
+            total = int(np.prod(counts))
+            if total > max_cells:
+                continue
+            occupied = max(1., fill_ratio * total)
+            neighbourhood = min(float(np.prod(np.minimum(near_width, counts))), occupied)
+            cost = near_far_cost_ratio * neighbourhood * n_bodies / occupied + (occupied - neighbourhood)
+            if cost < best_cost:
+                best_cost = cost
+                best_counts = counts
+    return best_counts
@@ -0,0 +1,181 @@
+# Exécution sans affichage (nœud de calcul, mesure du débit de calcul pur) :
+#     - avance le système de n_steps pas de temps avec la méthode choisie
+#     - écrit tous les K pas un instantané au format binaire (snapshot.py), sur un fil d'exécution séparé pour que
+#       l'écriture se recouvre avec le calcul des pas suivants
+#     - affiche le nombre de pas par seconde et d'interactions par seconde (paires de corps du champ proche et
+#       couples corps-cellule ou corps-nœud du champ lointain, voir NBodySystem.interaction_count)
+#
+# Usage : python3 headless.py méthode fichier dt n_pas [K [préfixe]] [paramètre=valeur ...]
+#     méthode : grid (numpy), grid_numba, grid_parallel ou barnes_hut
+#     Les paramètres sont passés au constructeur de NBodySystem, par exemple :
+#     python3 headless.py barnes_hut data/galaxy_5000 0.001 1000 100 out/galaxy theta=0.7 integrator=yoshida4
+import os
+import sys
+import time
+import queue
+import threading
+import importlib
+import numpy as np
+
+import morton
+import snapshot
+
+# Module de chaque méthode (tous définissent une classe NBodySystem)
+SOLVERS = {
+    "grid": "nbodies_grid",
+    "grid_numba": "nbodies_grid_numba",
+    "grid_parallel": "nbodies_grid_numba_parallel",
+    "barnes_hut": "barnes_hut_numba",
+}
+
+class SnapshotWriter:
+    """
+    Écrit les instantanés sur un fil d'exécution dédié. Les tableaux sont copiés au moment de submit, puis écrits
+    pendant que la simulation continue ; au plus max_pending instantanés attendent d'être écrits (submit bloque
+    au-delà, ce qui borne la mémoire si le disque est plus lent que le calcul). Le répertoire du préfixe
+    (par exemple out pour out/galaxy) est créé s'il n'existe pas.
+    """
+    def __init__(self, prefix : str, max_pending : int = 2):
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        self.prefix = prefix
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.n_written = 0
+        self.write_time = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def filename(self, step : int) -> str:
+        return f"{self.prefix}_{step:06d}{snapshot.BINARY_SUFFIX}"
+
+    def submit(self, step : int, time_value : float, masses, positions, velocities):
+        """
+        Programme l'écriture de l'instantané du pas step (les tableaux ne doivent plus être modifiés par l'appelant).
+        """
+        if self.error is not None:
+            raise self.error
+        self.pending.put((step, time_value, masses, positions, velocities))
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            step, time_value, masses, positions, velocities = item
+            start = time.perf_counter()
+            try:
+                snapshot.write_binary(self.filename(step), masses, positions, velocities, positions.dtype,
+                                      metadata={"step": step, "time": time_value})
+            except Exception as error:
+                self.error = error
+            self.write_time += time.perf_counter() - start
+            self.n_written += 1
+
+    def close(self):
+        """
+        Attend la fin des écritures en cours.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def submit_snapshot(writer : SnapshotWriter, system, step : int, dt : float):
+    """
+    Copie l'état courant du système (dans l'ordre d'origine des corps) et programme son écriture.
+    """
+    writer.submit(step, step * dt, morton.in_original_order(system.masses, system.ids),
+                  morton.in_original_order(system.positions, system.ids),
+                  morton.in_original_order(system.velocities, system.ids))
+
+def run_headless(system, dt : float, n_steps : int, snapshot_every : int = 0, prefix : str = "snapshot",
+                 report_every : int = 0) -> dict:
+    """
+    Avance le système de n_steps pas de temps sans affichage.
+
+    :param snapshot_every: Écrit un instantané tous les snapshot_every pas (et l'état initial) ; 0 : jamais
+    :param prefix: Préfixe des fichiers d'instantanés (prefix_000100.nbs, ...)
+    :param report_every: Affiche le débit tous les report_every pas ; 0 : seulement à la fin
+    :return: Statistiques de l'exécution (temps de calcul, pas/s, interactions/s, ...)
+    """
+    n_bodies = system.positions.shape[0]
+    # Calcul préalable hors du temps mesuré (compilation des noyaux numba) ; l'accélération obtenue est celle des
+    # positions courantes et sert au premier pas
+    system.acceleration = system.evaluate_acceleration()
+    system.interaction_count()
+    # Compte les corps dont l'accélération est calculée (plusieurs calculs par pas pour certains intégrateurs,
+    # une partie des corps seulement avec les pas de temps par blocs)
+    evaluated = [0]
+    evaluate = system.evaluate_acceleration
+    def counted_evaluation(targets=None):
+        evaluated[0] += n_bodies if targets is None else len(targets)
+        return evaluate(targets)
+    system.evaluate_acceleration = counted_evaluation
+
+    writer = SnapshotWriter(prefix) if snapshot_every > 0 else None
+    if writer is not None:
+        submit_snapshot(writer, system, 0, dt)
+    # Nombre moyen d'interactions par corps évalué, échantillonné au fil de la simulation
+    interaction_samples = []
+    compute_time = 0.
+    start = time.perf_counter()
+    for step in range(1, n_steps + 1):
+        step_start = time.perf_counter()
+        system.update_positions(dt)
+        compute_time += time.perf_counter() - step_start
+        if writer is not None and step % snapshot_every == 0:
+            submit_snapshot(writer, system, step, dt)
+        # Le comptage des interactions (un parcours de l'arbre pour Barnes-Hut) n'est pas compté dans le temps de
+        # calcul ; il n'est fait qu'aux pas de compte rendu
+        if step == n_steps or (report_every > 0 and step % report_every == 0):
+            interaction_samples.append(system.interaction_count() / n_bodies)
+        if report_every > 0 and step % report_every == 0:
+            print(f"pas {step} : {step / compute_time:.2f} pas/s, "
+                  f"{np.mean(interaction_samples) * evaluated[0] / compute_time:.3e} interactions/s")
+    if writer is not None:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    del system.evaluate_acceleration
+
+    stats = {
+        "n_bodies": n_bodies,
+        "n_steps": n_steps,
+        "compute_time": compute_time,
+        "elapsed": elapsed,
+        "steps_per_second": n_steps / compute_time,
+        "evaluations_per_step": evaluated[0] / (n_steps * n_bodies),
+        "interactions_per_body": np.mean(interaction_samples),
+        "interactions_per_second": np.mean(interaction_samples) * evaluated[0] / compute_time,
+        "snapshots": 0 if writer is None else writer.n_written,
+        # Grille utilisée par les méthodes à grille (choix automatique compris)
+        "grid": system.grid_report() if hasattr(system, "grid_report") else None,
+        "write_time": 0. if writer is None else writer.write_time,
+    }
+    return stats
+
+def print_stats(stats : dict):
+    print(f"{stats['n_bodies']} corps, {stats['n_steps']} pas en {stats['elapsed']:.2f} s "
+          f"(calcul : {stats['compute_time']:.2f} s)")
+    print(f"  - {stats['steps_per_second']:.2f} pas/s, {stats['evaluations_per_step']:.2f} calcul(s) de forces par pas")
+    print(f"  - {stats['interactions_per_body']:.1f} interactions par corps, "
+          f"{stats['interactions_per_second']:.3e} interactions/s")
+    if stats["grid"] is not None:
+        print(f"  - {stats['grid']}")
+    if stats["snapshots"] > 0:
+        print(f"  - {stats['snapshots']} instantanés écrits en {stats['write_time']:.2f} s (en arrière-plan)")
+
+if __name__ == "__main__":
+    from scenarios import parse_value
+    positional = [arg for arg in sys.argv[1:] if "=" not in arg]
+    if len(positional) < 4 or positional[0] not in SOLVERS:
+        print("Usage : python3 headless.py méthode fichier dt n_pas [K [préfixe]] [paramètre=valeur ...]")
+        print(f"Méthodes : {', '.join(SOLVERS)}")
+        sys.exit(1)
+    solver, filename, dt, n_steps = positional[0], positional[1], float(positional[2]), int(positional[3])
+    snapshot_every = int(positional[4]) if len(positional) > 4 else 0
+    prefix = positional[5] if len(positional) > 5 else "snapshot"
+    params = {key: parse_value(value) for key, value in (arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)}
+    module = importlib.import_module(SOLVERS[solver])
+    system = module.NBodySystem(filename, **params)
+    print(f"Simulation sans affichage de {filename} ({solver}) avec dt = {dt}, {n_steps} pas")
+    print_stats(run_headless(system, dt, n_steps, snapshot_every, prefix, report_every=max(1, n_steps // 10)))
@@ -0,0 +1,349 @@
+# Schémas d'intégration en temps communs à tous les codes à N corps.
+#
+# Un intégrateur fait avancer un système d'un pas de temps dt. Le système doit fournir :
+#     - positions, velocities, masses : tableaux (n, 3), (n, 3) et (n,) modifiés sur place
+#     - evaluate_acceleration() : met à jour ses structures (grille, arbre) pour les positions courantes
+#       et retourne l'accélération de chaque corps
+#     - acceleration : accélération aux positions courantes si elle est connue, None sinon. Les intégrateurs la
+#       tiennent à jour, ce qui permet de réutiliser la dernière évaluation de forces d'un pas sur le suivant.
+#     - potential_energy(positions) (facultatif) : énergie potentielle approchée avec la dernière grille ou le
+#       dernier arbre, à la place de la somme directe en O(N²) (voir total_energy et AdaptiveTimeStep)
+#
+# Schémas disponibles :
+#     - TaylorIntegrator   : développement de Taylor d'ordre 1 (schéma historique de nbodies_grid.py)
+#     - VelocityVerlet     : Verlet vitesse, ordre 2, une évaluation de forces par pas
+#     - LeapfrogKDK        : saute-mouton « kick-drift-kick », ordre 2, une évaluation de forces par pas
+#     - Yoshida4           : composition de trois saute-moutons (Yoshida 1990), ordre 4, trois évaluations par pas
+#     - AdaptiveTimeStep   : enveloppe d'un des schémas précédents qui découpe dt en sous-pas dont la taille
+#                            est pilotée par l'erreur relative sur l'énergie totale
+#     - BlockTimeStep      : pas de temps individuels hiérarchiques dt/2^l (saute-mouton par blocs) ; le système
+#                            doit alors accepter evaluate_acceleration(targets) qui ne calcule que les corps actifs
+import numpy as np
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba est facultatif pour la grille numpy (nbodies_grid.py) : potential_energy a alors une version numpy
+    njit = None
+
+# Constante gravitationnelle en unités [ly^3 / (M_sun * an^2)]
+G = 1.560339e-13
+
+def current_acceleration(system) -> np.ndarray:
+    """
+    Accélération aux positions courantes du système, évaluée seulement si elle n'est pas déjà connue.
+    """
+    if system.acceleration is None:
+        system.acceleration = system.evaluate_acceleration()
+    return system.acceleration
+
+class Integrator:
+    """
+    Interface commune des schémas d'intégration.
+    order est l'ordre de convergence du schéma (utilisé pour adapter le pas de temps).
+    """
+    order = 1
+
+    def step(self, system, dt : float):
+        raise NotImplementedError
+
+    def permute(self, perm : np.ndarray):
+        """
+        Appelée quand le système renumérote ses corps (corps k <- ancien corps perm[k]) : les intégrateurs qui
+        gardent un état par corps doivent le permuter de la même façon.
+        """
+        pass
+
+    def body_state(self) -> list:
+        """
+        État par corps de l'intégrateur (tableaux dont la première dimension est le nombre de corps), pour les
+        systèmes qui échangent des corps entre processus ; [] si l'intégrateur n'en garde pas.
+        """
+        return []
+
+    def set_body_state(self, state : list):
+        """
+        Remplace l'état par corps (mêmes tableaux que body_state, pour le nouvel ensemble de corps).
+        """
+        pass
+
+class TaylorIntegrator(Integrator):
+    """
+    x += v.dt + a.dt²/2 puis v += a.dt : schéma d'ordre 1, non symplectique.
+    """
+    order = 1
+
+    def step(self, system, dt : float):
+        a = current_acceleration(system)
+        system.positions  += system.velocities * dt + 0.5 * a * dt * dt
+        system.velocities += a * dt
+        system.acceleration = None
+
+class VelocityVerlet(Integrator):
+    """
+    x += v.dt + a.dt²/2 puis v += (a + a_new).dt/2, a_new étant l'accélération aux nouvelles positions.
+    """
+    order = 2
+
+    def step(self, system, dt : float):
+        a = current_acceleration(system)
+        system.positions += system.velocities * dt + 0.5 * a * dt * dt
+        a_new = system.evaluate_acceleration()
+        system.velocities += 0.5 * (a + a_new) * dt
+        system.acceleration = a_new
+
+class LeapfrogKDK(Integrator):
+    """
+    Demi-pas sur les vitesses (kick), pas complet sur les positions (drift), demi-pas sur les vitesses (kick).
+    """
+    order = 2
+
+    def step(self, system, dt : float):
+        system.velocities += 0.5 * dt * current_acceleration(system)
+        system.positions  += system.velocities * dt
+        system.acceleration = system.evaluate_acceleration()
+        system.velocities += 0.5 * dt * system.acceleration
+
+class Yoshida4(Integrator):
+    """
+    Schéma symplectique d'ordre 4 obtenu en enchaînant trois saute-moutons de pas w1.dt, w0.dt et w1.dt
+    avec w1 = 1/(2 - 2^(1/3)) et w0 = 1 - 2.w1 (le pas central est négatif).
+    L'accélération de fin d'un saute-mouton sert de début au suivant : trois évaluations de forces par pas.
+    """
+    order = 4
+    w1 = 1. / (2. - 2.**(1./3.))
+    w0 = 1. - 2. * w1
+
+    def __init__(self):
+        self.leapfrog = LeapfrogKDK()
+
+    def step(self, system, dt : float):
+        for w in (self.w1, self.w0, self.w1):
+            self.leapfrog.step(system, w * dt)
+
+def numpy_potential_energy(positions : np.ndarray, masses : np.ndarray, block_size : int = 1024) -> float:
+    """
+    Version numpy de potential_energy (utilisée sans numba) : les paires sont traitées par tuiles de
+    block_size x block_size corps pour borner la mémoire temporaire.
+    """
+    positions = positions.astype(np.float64)
+    masses = masses.astype(np.float64)
+    n_bodies = positions.shape[0]
+    energy = 0.
+    for first in range(0, n_bodies, block_size):
+        last = min(first + block_size, n_bodies)
+        for first_j in range(first, n_bodies, block_size):
+            last_j = min(first_j + block_size, n_bodies)
+            delta = positions[np.newaxis, first_j:last_j, :] - positions[first:last, np.newaxis, :]
+            distance = np.sqrt(np.sum(delta * delta, axis=2))
+            # Paires i < j seulement (la tuile diagonale ne garde que sa partie triangulaire supérieure stricte)
+            keep = distance > 1.E-10
+            if first_j == first:
+                keep &= np.triu(np.ones(keep.shape, dtype=np.bool_), k=1)
+            inverse = np.divide(1., distance, out=np.zeros_like(distance), where=keep)
+            energy -= G * np.sum(masses[first:last, np.newaxis] * masses[np.newaxis, first_j:last_j] * inverse)
+    return energy
+
+if njit is None:
+    potential_energy = numpy_potential_energy
+else:
+    @njit(parallel=True)
+    def potential_energy(positions : np.ndarray, masses : np.ndarray) -> float:
+        """
+        Énergie potentielle gravitationnelle -G.Σ_{i<j} m_i.m_j / r_ij par sommation directe (coût en O(N²)).
+        """
+        n_bodies = positions.shape[0]
+        energy = 0.
+        for i in prange(n_bodies):
+            e = 0.
+            for j in range(i + 1, n_bodies):
+                dx = np.float64(positions[j, 0]) - positions[i, 0]
+                dy = np.float64(positions[j, 1]) - positions[i, 1]
+                dz = np.float64(positions[j, 2]) - positions[i, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    e += masses[j] / distance
+            energy -= G * masses[i] * e
+        return energy
+
+def total_energy(system, positions : np.ndarray = None, velocities : np.ndarray = None,
+                 exact : bool = False) -> float:
+    """
+    Énergie cinétique plus énergie potentielle du système (en double précision), pour ses positions et vitesses
+    courantes ou pour celles données. Un système peut fournir sa propre méthode potential_energy(positions)
+    (approchée) pour éviter la somme en O(N²) ; exact impose la somme directe.
+    """
+    if positions is None:
+        positions = system.positions
+    if velocities is None:
+        velocities = system.velocities
+    masses = system.masses.astype(np.float64)
+    kinetic = 0.5 * np.sum(masses * np.sum(velocities.astype(np.float64)**2, axis=1))
+    if hasattr(system, "potential_energy") and not exact:
+        return kinetic + system.potential_energy(positions)
+    return kinetic + potential_energy(positions, masses)
+
+class AdaptiveTimeStep(Integrator):
+    """
+    Découpe chaque pas dt demandé en sous-pas h de l'intégrateur sous-jacent. Après chaque sous-pas, l'erreur
+    relative sur l'énergie totale err = |E1 - E0| / |E0| est comparée à la tolérance :
+        - si err > tolerance, le sous-pas est rejeté (état restauré) et recommencé avec un h plus petit ;
+        - sinon il est accepté et h est ajusté pour le sous-pas suivant.
+    Pour un schéma d'ordre p l'erreur locale varie comme h^(p+1), d'où h <- h.safety.(tolerance/err)^(1/(p+1)),
+    borné entre h/2 et 2h ainsi qu'entre min_dt et dt. h est conservé d'un appel à l'autre.
+    Si le système fournit potential_energy(positions) (énergie approchée des moteurs à grille et de Barnes-Hut),
+    E0 et E1 sont calculées avec le même découpage : deux évaluations approchées par sous-pas au lieu d'une somme
+    directe en O(N²).
+    """
+    def __init__(self, integrator : Integrator, tolerance : float = 1.E-6, min_dt : float = 1.E-9,
+                 safety : float = 0.9):
+        self.integrator = integrator
+        self.order = integrator.order
+        self.tolerance = tolerance
+        self.min_dt = min_dt
+        self.safety = safety
+        self.h = None
+        self.n_rejected = 0
+
+    def permute(self, perm : np.ndarray):
+        self.integrator.permute(perm)
+
+    def body_state(self) -> list:
+        return self.integrator.body_state()
+
+    def set_body_state(self, state : list):
+        self.integrator.set_body_state(state)
+
+    def step(self, system, dt : float):
+        if self.h is None:
+            self.h = dt
+        elapsed = 0.
+        approximate = hasattr(system, "potential_energy")
+        energy = None if approximate else total_energy(system)
+        while elapsed < dt:
+            h = min(self.h, dt - elapsed)
+            saved = (system.positions.copy(), system.velocities.copy(), system.acceleration)
+            self.integrator.step(system, h)
+            if approximate:
+                # Énergie approchée : l'énergie de début de sous-pas est recalculée avec le même découpage que celle
+                # de fin (celui de la dernière mise à jour de la grille ou de l'arbre), sinon les corps qui changent
+                # de cellule pendant le sous-pas fausseraient l'erreur
+                energy = total_energy(system, saved[0], saved[1])
+            new_energy = total_energy(system)
+            error = abs(new_energy - energy) / max(abs(energy), 1.E-300)
+            factor = 2. if error == 0. else self.safety * (self.tolerance / error)**(1. / (self.order + 1))
+            factor = min(2., max(0.5, factor))
+            if error > self.tolerance and h > self.min_dt:
+                # Rejet : retour à l'état de début de sous-pas
+                system.positions[:] = saved[0]
+                system.velocities[:] = saved[1]
+                system.acceleration = saved[2]
+                self.h = max(self.min_dt, h * factor)
+                self.n_rejected += 1
+                continue
+            elapsed += h
+            energy = new_energy
+            if h == self.h:
+                self.h = min(dt, max(self.min_dt, h * factor))
+
+class BlockTimeStep(Integrator):
+    """
+    Pas de temps individuels hiérarchiques : le corps i avance avec le pas dt/2^l_i, où le niveau l_i (entre 0 et
+    max_level) est le plus petit niveau tel que dt/2^l_i <= eta.|a_i|/|j_i| (j : dérivée de l'accélération,
+    estimée par différence finie sur le pas précédent du corps ; avant la première estimation on utilise
+    eta.|v_i|/|a_i|, qui vaut aussi 1/ω pour une orbite circulaire).
+
+    Chaque pas dt est découpé en 2^max_level sous-pas élémentaires h. À chaque sous-pas :
+        - les corps dont le pas commence reçoivent un demi-kick v += a.dt_i/2 ;
+        - tous les corps dérivent x += v.h (opération peu coûteuse) ;
+        - les corps dont le pas se termine (les « actifs ») voient leur accélération recalculée, reçoivent le
+          demi-kick de fin puis un nouveau niveau.
+    Un corps ne peut passer à un niveau plus grossier que si la fin de son pas est alignée sur ce niveau.
+    Le coût des forces est donc proportionnel au nombre de corps actifs : les étoiles proches du trou noir
+    central sont mises à jour souvent, le disque extérieur rarement. Tous les corps sont synchronisés à la
+    fin de chaque pas dt.
+    """
+    order = 2
+
+    def __init__(self, max_level : int = 6, eta : float = 0.05):
+        self.max_level = max_level
+        self.eta = eta
+        self.levels = None
+        self.jerk = None
+        self.n_evaluations = 0
+
+    def permute(self, perm : np.ndarray):
+        if self.levels is not None:
+            self.levels = self.levels[perm]
+            self.jerk = self.jerk[perm]
+
+    def body_state(self) -> list:
+        return [] if self.levels is None else [self.levels, self.jerk]
+
+    def set_body_state(self, state : list):
+        if state:
+            self.levels, self.jerk = state
+
+    def compute_levels(self, dt : float, acceleration : np.ndarray, velocities : np.ndarray,
+                       jerk : np.ndarray) -> np.ndarray:
+        """
+        Niveau de pas de temps de chaque corps d'après son accélération et sa dérivée (ou sa vitesse).
+        """
+        acc = np.linalg.norm(acceleration, axis=1).astype(np.float64)
+        vel = np.linalg.norm(velocities, axis=1).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.where(jerk > 0., acc / jerk, vel / acc)
+        scale = np.where(np.isfinite(scale), scale, dt)
+        with np.errstate(divide="ignore"):
+            levels = np.ceil(np.log2(dt / np.maximum(self.eta * scale, 1.E-300)))
+        return np.clip(levels, 0, self.max_level).astype(np.int64)
+
+    def step(self, system, dt : float):
+        n_bodies = system.positions.shape[0]
+        a = current_acceleration(system).copy()
+        if self.levels is None or self.levels.shape[0] != n_bodies:
+            self.jerk = np.zeros(n_bodies)
+            self.levels = self.compute_levels(dt, a, system.velocities, self.jerk)
+        n_sub = 1 << self.max_level
+        h = dt / n_sub
+        a_start = a.copy()
+        for k in range(n_sub):
+            strides = 1 << (self.max_level - self.levels)
+            body_dt = (h * strides)[:, np.newaxis]
+            starting = np.nonzero(k % strides == 0)[0]
+            system.velocities[starting] += 0.5 * body_dt[starting] * a[starting]
+            a_start[starting] = a[starting]
+            system.positions += system.velocities * h
+            active = np.nonzero((k + 1) % strides == 0)[0]
+            if active.shape[0] == n_bodies:
+                a = system.evaluate_acceleration().copy()
+            else:
+                a[active] = system.evaluate_acceleration(active)
+            self.n_evaluations += active.shape[0]
+            system.velocities[active] += 0.5 * body_dt[active] * a[active]
+            # Nouveau niveau des corps actifs, qui ne peut grossir que si la fin du pas y est alignée
+            self.jerk[active] = np.linalg.norm(a[active] - a_start[active], axis=1) / body_dt[active, 0]
+            levels = self.compute_levels(dt, a[active], system.velocities[active], self.jerk[active])
+            aligned_level = self.max_level - (((k + 1) & -(k + 1)).bit_length() - 1)
+            self.levels[active] = np.maximum(levels, aligned_level)
+        system.acceleration = a
+
+INTEGRATORS = {
+    "taylor"   : TaylorIntegrator,
+    "verlet"   : VelocityVerlet,
+    "leapfrog" : LeapfrogKDK,
+    "yoshida4" : Yoshida4,
+    "block"    : BlockTimeStep,
+}
+
+def make_integrator(name : str, **adaptive_options) -> Integrator:
+    """
+    Construit un intégrateur à partir de son nom ("taylor", "verlet", "leapfrog", "yoshida4"), éventuellement
+    préfixé par "adaptive-" pour l'envelopper dans AdaptiveTimeStep (options transmises à son constructeur).
+    """
+    if isinstance(name, Integrator):
+        return name
+    if name.startswith("adaptive-"):
+        return AdaptiveTimeStep(make_integrator(name[len("adaptive-"):]), **adaptive_options)
+    if name not in INTEGRATORS:
+        raise ValueError(f"Intégrateur inconnu : {name} (choix possibles : {', '.join(INTEGRATORS)})")
+    return INTEGRATORS[name]()
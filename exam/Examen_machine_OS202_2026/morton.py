@@ -0,0 +1,64 @@
+# Codes de Morton (ordre en Z) pour des positions 3D.
+#     Le code de Morton d'un point entrelace les bits de ses coordonnées entières (x, y, z) dans un cube
+#     découpé en 2^MORTON_BITS intervalles par direction. Deux points proches dans l'espace ont le plus souvent
+#     des codes proches : trier les corps par code de Morton les regroupe donc en mémoire par voisinage spatial,
+#     et chaque préfixe de 3*l bits du code désigne la cellule de niveau l d'un octree.
+import numpy as np
+
+# Nombre de bits par direction (3*21 = 63 bits, ce qui tient dans un entier 64 bits)
+MORTON_BITS = 21
+
+def spread_bits(v : np.ndarray) -> np.ndarray:
+    """
+    Intercale deux zéros entre chacun des MORTON_BITS bits de poids faible de v :
+    b20 ... b1 b0 -> b20 0 0 ... 0 0 b1 0 0 b0
+
+    :param v: Entiers positifs inférieurs à 2^MORTON_BITS
+    :return: Entiers 64 bits dont les bits sont espacés de trois en trois
+    """
+    v = v.astype(np.uint64) & np.uint64(0x1fffff)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8)))  & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4)))  & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2)))  & np.uint64(0x1249249249249249)
+    return v
+
+def bounding_cube(positions : np.ndarray) -> tuple[np.ndarray, float]:
+    """
+    Retourne le coin inférieur et la longueur d'arête du plus petit cube (légèrement élargi) contenant les positions.
+    Un cube (et non un parallélépipède) garantit des cellules d'octree cubiques à tous les niveaux.
+    """
+    box_min = np.min(positions, axis=0).astype(np.float64) - 1.E-6
+    box_max = np.max(positions, axis=0).astype(np.float64) + 1.E-6
+    return box_min, float(np.max(box_max - box_min))
+
+def morton_codes(positions : np.ndarray, box_min : np.ndarray, box_size : float) -> np.ndarray:
+    """
+    Calcule le code de Morton de chaque position dans le cube [box_min, box_min + box_size]^3.
+    Les positions hors du cube sont ramenées sur son bord.
+
+    :param positions: Tableau (n, 3) des positions
+    :param box_min: Coin inférieur du cube
+    :param box_size: Longueur d'arête du cube
+    :return: Tableau (n,) de codes de Morton (uint64)
+    """
+    n_max = (1 << MORTON_BITS) - 1
+    scaled = (positions - box_min) * ((n_max + 1) / box_size)
+    ijk = np.clip(scaled, 0, n_max).astype(np.uint64)
+    return spread_bits(ijk[:, 0]) | (spread_bits(ijk[:, 1]) << np.uint64(1)) | (spread_bits(ijk[:, 2]) << np.uint64(2))
+
+def morton_order(positions : np.ndarray) -> np.ndarray:
+    """
+    Retourne la permutation (stable) qui trie les positions selon leur code de Morton dans leur cube englobant.
+    """
+    box_min, box_size = bounding_cube(positions)
+    return np.argsort(morton_codes(positions, box_min, box_size), kind="stable")
+
+def in_original_order(array : np.ndarray, ids : np.ndarray) -> np.ndarray:
+    """
+    Remet dans l'ordre d'origine un tableau dont la ligne k concerne le corps d'identifiant ids[k].
+    """
+    result = np.empty_like(array)
+    result[ids] = array
+    return result
@@ -6,10 +6,14 @@
 #          - En sommant les corps de la même cellule et des cellules voisines
 #          - En utilisant le centre de masse et la masse totale des cellules plus éloignées
 import numpy as np
-from numpy import linalg
-import visualizer3d
 import sys
 import time
+import morton
+import integrators
+import snapshot
+import core_box
+from grid_resolution import choose_cell_counts, is_auto
+from precision import add_compensated, make_precision
 # Unités:
 # - Distance: année-lumière (ly)
 # - Masse: masse solaire (M_sun)
@@ -48,8 +52,15 @@ def generate_star_color(mass):
         return (255, 150, 100)
     
 class Grid:
-    def __init__(self, box_min : np.ndarray, box_max : np.ndarray, n_cells_per_dir : np.ndarray[np.int32]):
+    def __init__(self, box_min : np.ndarray, box_max : np.ndarray, n_cells_per_dir : np.ndarray[np.int32],
+                 core_box : core_box.CoreBox = None):
+        """
+        :param core_box: Boîte cœur (voir core_box.CoreBox) de bornes box_min et box_max : la boîte de la grille
+                         la suit, et les corps qui en sortent ne sont rangés dans aucune cellule. Sans elle, la
+                         boîte grandit pour contenir tous les corps
+        """
         print (f"box min : {box_min}, box max : {box_max}")
+        self.core_box = core_box
         self.box_min = box_min
         self.box_max = box_max
         self.n_cells_per_dir = n_cells_per_dir
@@ -57,204 +68,475 @@ class Grid:
         # Pré-calculer les cellules voisines et lointaines pour chaque cellule
         self._precompute_cell_neighbors()
 
-    def update_bounding_box(self, positions : np.ndarray):
+    def update_bounding_box(self, positions : np.ndarray) -> bool:
         """
-        Met à jour la boîte englobante du système en fonction des positions des corps.
-        
-        :param self: Description
-        :param positions: Description
+        Met à jour la boîte englobante du système en fonction des positions des corps. Avec une boîte cœur, la
+        boîte n'est refaite que si le cœur des positions l'exige : elle ne grandit pas avec les corps qui
+        s'échappent, ni ne se déplace à chaque pas (voir core_box.CoreBox).
+
+        :param positions: Positions des corps [x,y,z]
         :type positions: np.ndarray
+        :return: Vrai si la boîte a (peut-être) changé
         """
-        for i in range(3):
-            self.box_min[i] = min(self.box_min[i], np.min(positions[:,i]) - 1.E-6)
-            self.box_max[i] = max(self.box_max[i], np.max(positions[:,i]) + 1.E-6)
+        if self.core_box is None:
+            for i in range(3):
+                self.box_min[i] = min(self.box_min[i], np.min(positions[:,i]) - 1.E-6)
+                self.box_max[i] = max(self.box_max[i], np.max(positions[:,i]) + 1.E-6)
+            self.cell_size = (self.box_max - self.box_min) / self.n_cells_per_dir
+            return True
+        if not self.core_box.update(positions, int(np.count_nonzero(self.core_box.outside(positions)))):
+            return False
+        self.box_min = self.core_box.min_bounds
+        self.box_max = self.core_box.max_bounds
         self.cell_size = (self.box_max - self.box_min) / self.n_cells_per_dir
-        # Recalculer les voisins si nécessaire (structure de grille changée)
-        self._precompute_cell_neighbors()
+        return True
 
     def _precompute_cell_neighbors(self):
         """
-        Pré-calcule pour chaque cellule possible ses cellules voisines (distance Chebyshev <= 1)
-        et génère un mapping efficace pour les cellules lointaines.
+        Pré-calcule les décalages (ix, iy, iz) des cellules voisines d'une cellule (distance Chebyshev <= 1),
+        qui ne dépendent pas de la boîte.
         """
         self.neighbor_offsets = []
         for dx in [-1, 0, 1]:
             for dy in [-1, 0, 1]:
                 for dz in [-1, 0, 1]:
                     self.neighbor_offsets.append((dx, dy, dz))
-        
-        # Pré-calculer toutes les cellules possibles comme array
+
+    def cell_linear_indices(self, positions : np.ndarray) -> np.ndarray:
+        """
+        Calcule l'indice (forme morse : ix + iy*nx + iz*nx*ny) de la cellule contenant chaque corps,
+        -1 pour les corps hors de la boîte cœur.
+
+        :param positions: Positions des corps [x,y,z]
+        :type positions: np.ndarray
+        :return: Indice linéaire de la cellule de chaque corps
+        :rtype: np.ndarray
+        """
+        indices = np.floor( (positions - self.box_min) / self.cell_size ).astype(np.int64)
+        # On s'assure que les indices sont dans les bornes :
+        indices = np.clip(indices, 0, self.n_cells_per_dir - 1)
         n = self.n_cells_per_dir
-        self.all_cell_indices = np.array(
-            [(i, j, k) for i in range(n[0]) for j in range(n[1]) for k in range(n[2])],
-            dtype=np.int32
-        )
+        cells = indices[:,0] + indices[:,1]*n[0] + indices[:,2]*n[0]*n[1]
+        if self.core_box is None:
+            return cells
+        return np.where(self.core_box.outside(positions), -1, cells)
 
     def update_indices_in_cells(self, positions : np.ndarray):
         """
         Met à jour les indices des corps dans chaque cellule de la grille.
-        
-        :param self: Description
-        :param positions: Description
+
+        Les cellules sont stockées sous forme morse (CSR) comme dans SpatialGrid :
+        les corps de la cellule c sont body_indices[cell_start_indices[c]:cell_start_indices[c+1]].
+        Le tableau est construit par un tri par dénombrement (argsort stable + bincount),
+        sans boucle python sur les corps. Les corps hors de la boîte (self.outliers) ne sont dans aucune cellule.
+
+        :param positions: Positions des corps [x,y,z]
         :type positions: np.ndarray
         """
-        # On le fait en vectorisé :
-        ##On calculer l'indice de la cellule correspondant à chaque position des corps :
-        indices = np.floor( (positions - self.box_min) / self.cell_size ).astype(int)
-        # On s'assure que les indices sont dans les bornes :
-        indices = np.clip(indices, 0, self.n_cells_per_dir - 1)
-        # Puis on remplit le dictionnaire des contenus des cellules :
-        self.cell_contents = {}
-        for ibody, idx in enumerate(indices):
-            key = (idx[0], idx[1], idx[2])
-            if key not in self.cell_contents:
-                self.cell_contents[key] = []
-            self.cell_contents[key].append(ibody)
+        n_cells = int(np.prod(self.n_cells_per_dir))
+        self.body_cells = self.cell_linear_indices(positions)
+        self.outliers = np.flatnonzero(self.body_cells < 0)
+        # Le tri stable conserve l'ordre croissant des corps à l'intérieur de chaque cellule ; les corps hors de
+        # la boîte (cellule -1) sont en tête
+        self.body_indices = np.argsort(self.body_cells, kind="stable")[self.outliers.shape[0]:]
+        self.cell_counts  = np.bincount(self.body_cells[self.body_indices], minlength=n_cells)
+        self.cell_start_indices = np.zeros(n_cells + 1, dtype=np.int64)
+        np.cumsum(self.cell_counts, out=self.cell_start_indices[1:])
+        self.occupied_cells = np.flatnonzero(self.cell_counts)
 
     def compute_global_mass_and_com(self, masses : np.ndarray, positions : np.ndarray):
         """
         Calcule la masse totale et le centre de masse de chaque cellule de la grille.
-        
-        :param self: Description
-        :param masses: Description
+
+        Les sommes par cellule sont faites avec np.add.reduceat sur les corps triés par cellule.
+
+        :param masses: Masses des corps
         :type masses: np.ndarray
-        :param positions: Description
+        :param positions: Positions des corps [x,y,z]
         :type positions: np.ndarray
         """
-        self.cell_mass = {}
-        self.cell_com  = {}
-        for key, body_indices in self.cell_contents.items():
-            total_mass = np.sum(masses[body_indices])
-            com = np.sum(positions[body_indices] * masses[body_indices][:,np.newaxis], axis=0) / total_mass
-            self.cell_mass[key] = total_mass
-            self.cell_com[key]  = com               
+        n_cells = self.cell_counts.shape[0]
+        self.cell_masses = np.zeros(n_cells, dtype=np.float64)
+        self.cell_com_positions = np.zeros((n_cells, 3), dtype=np.float64)
+        if self.occupied_cells.shape[0] == 0:
+            return
+        sorted_masses = masses[self.body_indices].astype(np.float64)
+        weighted = positions[self.body_indices] * sorted_masses[:, np.newaxis]
+        # reduceat n'est appliqué que sur les cellules occupées (un segment vide renverrait un élément)
+        starts = self.cell_start_indices[self.occupied_cells]
+        occupied_mass = np.add.reduceat(sorted_masses, starts)
+        self.cell_masses[self.occupied_cells] = occupied_mass
+        self.cell_com_positions[self.occupied_cells] = np.add.reduceat(weighted, starts, axis=0) / occupied_mass[:, np.newaxis]
+
+    def cell_key(self, cell : int) -> tuple:
+        """
+        Convertit un indice linéaire de cellule en triplet (ix, iy, iz).
+        """
+        n = self.n_cells_per_dir
+        return (cell % n[0], (cell // n[0]) % n[1], cell // (n[0]*n[1]))
+
+    @property
+    def cell_contents(self) -> dict:
+        """
+        Vue dictionnaire {(ix,iy,iz) : [indices des corps]} des cellules occupées (compatibilité).
+        """
+        return { self.cell_key(c) : self.body_indices[self.cell_start_indices[c]:self.cell_start_indices[c+1]].tolist()
+                 for c in self.occupied_cells }
+
+    @property
+    def cell_mass(self) -> dict:
+        """
+        Vue dictionnaire {(ix,iy,iz) : masse totale} des cellules occupées (compatibilité).
+        """
+        return { self.cell_key(c) : self.cell_masses[c] for c in self.occupied_cells }
+
+    @property
+    def cell_com(self) -> dict:
+        """
+        Vue dictionnaire {(ix,iy,iz) : centre de masse} des cellules occupées (compatibilité).
+        """
+        return { self.cell_key(c) : self.cell_com_positions[c] for c in self.occupied_cells }
     
 class NBodySystem:
-    def __init__(self, filename, ncells_per_dir = 10):
-        positions = []
-        velocities = []
-        masses    = []
-        
-        self.max_mass = 0.
-        self.box = np.array([[-1.E-6,-1.E-6,-1.E-6],[1.E-6,1.E-6,1.E-6]], dtype=np.float64) # Contient les coins min et max du système
-        with open(filename, "r") as fich:
-            line = fich.readline() # Récupère la masse, la position et la vitesse sous forme de chaîne
-            # Récupère les données numériques pour instancier un corps qu'on rajoute aux corps déjà présents :
-            while line:
-                data = line.split()
-                masses.append(float(data[0]))
-                positions.append([float(data[1]), float(data[2]), float(data[3])])
-                velocities.append([float(data[4]), float(data[5]), float(data[6])])
-                self.max_mass = max(self.max_mass, masses[-1])
-                
-                for i in range(3):
-                    self.box[0][i] = min(self.box[0][i], positions[-1][i]-1.E-6)
-                    self.box[1][i] = max(self.box[1][i], positions[-1][i]+1.E-6)
-                    
-                line = fich.readline()
+    def __init__(self, filename, ncells_per_dir = 10, max_tile_size = 1 << 20, reorder_period = 0,
+                 integrator = "taylor", max_outliers = None, precision = "mixed"):
+        """
+        :param filename: Fichier contenant les données des corps (texte ou binaire .nbs, cf. snapshot.py)
+        :param ncells_per_dir: Nombre de cellules de la grille dans chaque direction (un entier pour toutes les
+                               directions), ou "auto" pour le choisir d'après le nombre de corps et la forme de la
+                               boîte (voir tune_grid)
+        :param max_tile_size: Nombre maximal de paires (corps, source) traitées en une seule opération
+                              vectorisée (borne la mémoire temporaire à quelques dizaines de Mo)
+        :param reorder_period: Nombre de pas de temps entre deux renumérotations des corps selon l'ordre de
+                               Morton (0 : jamais). Les corps voisins dans l'espace deviennent voisins en mémoire
+        :param integrator: Schéma d'intégration en temps (nom accepté par integrators.make_integrator ou instance),
+                           par défaut le développement de Taylor d'ordre 1 d'origine
+        :param max_outliers: Nombre maximal de corps laissés hors de la boîte de la grille (voir core_box.CoreBox),
+                             traités par sommation directe. None (par défaut) : 0,1 % des corps
+                             (core_box.default_max_outliers) ; 0 : la boîte contient tous les corps et se déplace
+                             dès qu'un corps en sort
+        :param precision: Précision du stockage des corps et des sommes des forces : "mixed" (float32 et sommes en
+                          float64), "float32" (sommes compensées) ou "float64", voir precision.py
+        """
+        self.precision = make_precision(precision)
+        self.max_tile_size = max_tile_size
+        masses, positions, velocities = snapshot.load_bodies(filename)
+        self.max_mass = float(np.max(masses))
+        self.box = snapshot.bounding_box(positions) # Contient les coins min et max du système
         
-        self.positions  = np.array(positions, dtype=np.float32)
-        self.velocities = np.array(velocities, dtype=np.float32)
-        self.masses     = np.array(masses, dtype=np.float32)
+        self.positions  = np.array(positions, dtype=self.precision.storage)
+        self.velocities = np.array(velocities, dtype=self.precision.storage)
+        self.masses     = np.array(masses, dtype=self.precision.storage)
         self.colors = [generate_star_color(m) for m in masses]
-        self.grid   = Grid(self.box[0], self.box[1], ncells_per_dir)
+        self.ids = np.arange(self.positions.shape[0])
+        # Accélération aux positions courantes si elle est déjà connue
+        self.acceleration = None
+        self.integrator = integrators.make_integrator(integrator)
+        self.reorder_period = reorder_period
+        self.n_steps = 0
+        # Choix de la grille automatique : nombre de cellules et remplissage utilisés
+        self.grid_tuning = None
+        auto_grid = is_auto(ncells_per_dir)
+        box = core_box.CoreBox(self.positions, max_outliers)
+        if auto_grid:
+            ncells_per_dir = choose_cell_counts(self.positions.shape[0], box.extent(), near_width=3)
+        ncells_per_dir = np.broadcast_to(np.asarray(ncells_per_dir, dtype=np.int64), 3).copy()
+        self.grid   = Grid(box.min_bounds, box.max_bounds, ncells_per_dir, core_box=box)
         self.grid.update_indices_in_cells(self.positions)
+        if auto_grid:
+            self.tune_grid()
 
-    def compute_acceleration(self):
+    def tune_grid(self):
+        """
+        Choisit le nombre de cellules par direction (grid_resolution.choose_cell_counts, voisinage proche de 3
+        cellules par direction) pour les positions courantes et le remplissage de la grille courante, puis
+        reconstruit la grille sur leur boîte englobante.
         """
-        Calcul l'accélération de chaque corps en utilisant la méthode de la grille (version hautement optimisée).
+        grid = self.grid
+        box = core_box.CoreBox(self.positions, grid.core_box.max_outliers)
+        fill_ratio = grid.occupied_cells.shape[0] / np.prod(grid.n_cells_per_dir)
+        n_cells = choose_cell_counts(self.positions.shape[0], box.extent(), fill_ratio=fill_ratio, near_width=3)
+        self.grid = Grid(box.min_bounds, box.max_bounds, n_cells, core_box=box)
+        self.grid.update_indices_in_cells(self.positions)
+        self.grid_tuning = {"ncells_per_dir": tuple(int(n) for n in n_cells), "fill_ratio": float(fill_ratio)}
+
+    def grid_report(self) -> str:
+        """Description de la grille utilisée (et de son choix automatique), pour les comptes rendus de temps."""
+        grid = self.grid
+        n_cells = "x".join(str(int(n)) for n in grid.n_cells_per_dir)
+        if self.grid_tuning is not None:
+            n_cells += f" (automatique : remplissage {self.grid_tuning['fill_ratio']:.2f})"
+        return (f"grille {n_cells}, {grid.outliers.shape[0]} corps hors de la boîte "
+                f"({grid.core_box.n_changes} déplacement(s) de la boîte)")
+
+    def compute_acceleration(self, targets : np.ndarray = None):
+        """
+        Calcul l'accélération de chaque corps (ou des seuls corps d'indices targets) en utilisant la méthode de la
+        grille (version vectorisée par tuiles).
         Si un corps est dans une cellule, on somme les contributions des corps dans la même cellule et les cellules voisines
         sinon on utilise le centre de masse et la masse totale des cellules plus éloignées.
-        
-        :param self: Description
+
+        - Champ proche : pour chaque cellule occupée, on traite en bloc toutes les paires
+          (corps de la cellule x corps des cellules voisines), découpées en tuiles d'au plus
+          self.max_tile_size paires pour borner la mémoire.
+        - Champ lointain : une seule opération matricielle (corps x cellules occupées), elle aussi
+          découpée en tuiles de corps, où les cellules voisines sont masquées.
+        - Corps hors de la boîte de la grille : sommation directe (ils attirent les corps de la grille et
+          subissent l'attraction de tous les corps).
+
+        Les sommes sont faites dans la précision choisie (voir add_forces). Avec targets (indices sans doublon), les
+        passes proche et lointaine ne portent que sur les lignes des corps cibles.
+
+        :return: Accélérations [ax, ay, az] de chaque corps (ou des corps targets, dans cet ordre)
+        :rtype: np.ndarray
         """
         n_bodies = self.positions.shape[0]
-        accelerations = np.zeros((n_bodies, 3), dtype=np.float32)
+        is_target = np.ones(n_bodies, dtype=np.bool_)
+        if targets is not None:
+            is_target[:] = False
+            is_target[targets] = True
+        accelerations = np.zeros((n_bodies, 3), dtype=self.precision.accumulator)
+        compensation = np.zeros_like(accelerations) if self.precision.compensated else None
         
         # Met à jour la grille :
         self.grid.update_bounding_box(self.positions)
         self.grid.update_indices_in_cells(self.positions)
         self.grid.compute_global_mass_and_com(self.masses, self.positions)
-        
-        # Calcul des indices de cellule pour tous les corps
-        idx_cells = np.floor((self.positions - self.grid.box_min) / self.grid.cell_size).astype(int)
-        idx_cells = np.clip(idx_cells, 0, self.grid.n_cells_per_dir - 1)
-        # Convertir les clés de cellules en array numpy pour vectorisation
-        cell_keys = np.array(list(self.grid.cell_contents.keys()))
-        cell_coms = np.array([self.grid.cell_com[tuple(k)] for k in cell_keys], dtype=np.float32)
-        cell_masses = np.array([self.grid.cell_mass[tuple(k)] for k in cell_keys], dtype=np.float32)
-        # Pour chaque cellule occupée, traiter les interactions
-        for key in self.grid.cell_contents:
-            cell_bodies = np.array(self.grid.cell_contents[key], dtype=int)
-            if len(cell_bodies) == 0:
+
+        grid = self.grid
+        n = grid.n_cells_per_dir
+        occupied = grid.occupied_cells
+        # Corps cibles de la grille, coordonnées (ix,iy,iz) des cellules occupées et de la cellule de ces corps
+        in_box = np.flatnonzero((grid.body_cells >= 0) & is_target)
+        in_box_cells = grid.body_cells[in_box]
+        cell_keys = np.stack((occupied % n[0], (occupied // n[0]) % n[1], occupied // (n[0]*n[1])), axis=1)
+        body_keys = np.stack((in_box_cells % n[0], (in_box_cells // n[0]) % n[1], in_box_cells // (n[0]*n[1])), axis=1)
+
+        # 1. Interactions proches (cellules voisines à distance de Chebyshev <= 1)
+        neighbor_keys = cell_keys[:, np.newaxis, :] + np.array(grid.neighbor_offsets)[np.newaxis, :, :]
+        inside = np.all((neighbor_keys >= 0) & (neighbor_keys < n), axis=2)
+        neighbor_cells = neighbor_keys[:,:,0] + neighbor_keys[:,:,1]*n[0] + neighbor_keys[:,:,2]*n[0]*n[1]
+        starts = grid.cell_start_indices
+        for icell, cell in enumerate(occupied):
+            i_bodies = grid.body_indices[starts[cell]:starts[cell+1]]
+            i_bodies = i_bodies[is_target[i_bodies]]
+            if i_bodies.shape[0] == 0:
                 continue
-                
-            cell_idx = np.array(key)
-            # 1. Interactions proches (cellules voisines) - traitement vectorisé par cellule
-            for offset in self.grid.neighbor_offsets:
-                neighbor_key = (cell_idx[0] + offset[0], cell_idx[1] + offset[1], cell_idx[2] + offset[2])
-                # Vérifier que la cellule voisine est dans la grille
-                if  (0 <= neighbor_key[0] < self.grid.n_cells_per_dir[0] and
-                    0 <= neighbor_key[1] < self.grid.n_cells_per_dir[1] and
-                    0 <= neighbor_key[2] < self.grid.n_cells_per_dir[2] and
-                    neighbor_key in self.grid.cell_contents):                            
-                            neighbor_bodies = np.array(self.grid.cell_contents[neighbor_key], dtype=int)
-                            
-                            # Calcul vectorisé pour toutes les paires (cell_bodies x neighbor_bodies)
-                            for ibody in cell_bodies:
-                                j_bodies = neighbor_bodies
-                                diff = self.positions[j_bodies] - self.positions[ibody]
-                                dists = linalg.norm(diff, axis=1)
-                                valid = dists > 1.E-10  # Seuil ajusté pour les années-lumière
-                                if np.any(valid):
-                                    inv_dist3 = 1.0 / dists[valid]**3
-                                    accelerations[ibody] += np.sum(
-                                        (G * self.masses[j_bodies[valid], np.newaxis] * inv_dist3[:, np.newaxis]) * diff[valid],
-                                        axis=0
-                                    )
-            
-            # 2. Interactions lointaines (centre de masse) - traitement vectorisé
-            # Calculer quelles cellules sont lointaines pour cette cellule (distance Chebyshev > 1)
-            # Utiliser la distance de Chebyshev: max(|dx|, |dy|, |dz|)
-            far_mask = ((np.abs(cell_keys[:, 0] - cell_idx[0]) > 1) |
-                       (np.abs(cell_keys[:, 1] - cell_idx[1]) > 1) |
-                       (np.abs(cell_keys[:, 2] - cell_idx[2]) > 1)) & \
-                       ((np.abs(cell_keys[:, 0] - cell_idx[0]) + 
-                         np.abs(cell_keys[:, 1] - cell_idx[1]) + 
-                         np.abs(cell_keys[:, 2] - cell_idx[2])) > 1)
-            
-            if np.any(far_mask):
-                far_coms = cell_coms[far_mask]
-                far_masses = cell_masses[far_mask]
-                
-                # Pour chaque corps de la cellule, calculer l'accélération due aux cellules lointaines
-                for ibody in cell_bodies:
-                    diff = far_coms - self.positions[ibody]  # (n_far_cells, 3)
-                    dists = linalg.norm(diff, axis=1)
-                    inv_dist_cube = 1.0 / (dists**3)
-                    accelerations[ibody] += np.sum(
-                            (G * far_masses[:, np.newaxis] * inv_dist_cube[:, np.newaxis]) * diff,
-                            axis=0
-                        )
-        return accelerations
+            neighbors = neighbor_cells[icell, inside[icell]]
+            neighbors = neighbors[grid.cell_counts[neighbors] > 0]
+            j_bodies = np.concatenate([grid.body_indices[starts[c]:starts[c+1]] for c in neighbors])
+            pos_j  = self.positions[j_bodies]
+            mass_j = self.masses[j_bodies]
+            rows = max(1, self.max_tile_size // j_bodies.shape[0])
+            for first in range(0, i_bodies.shape[0], rows):
+                i_tile = i_bodies[first:first+rows]
+                diff = pos_j[np.newaxis, :, :] - self.positions[i_tile, np.newaxis, :]
+                dist2 = np.einsum("ijk,ijk->ij", diff, diff)
+                with np.errstate(divide="ignore"):
+                    weight = mass_j / (dist2 * np.sqrt(dist2))
+                # Seuil ajusté pour les années-lumière (exclut le corps lui-même)
+                weight[dist2 <= 1.E-20] = 0.
+                self.add_forces(accelerations, compensation, i_tile, weight, diff)
+
+        # 2. Interactions lointaines (centre de masse des cellules à distance de Chebyshev > 1)
+        cell_coms = grid.cell_com_positions[occupied].astype(self.positions.dtype)
+        cell_masses = grid.cell_masses[occupied].astype(self.positions.dtype)
+        if occupied.shape[0] > 0:
+            rows = max(1, self.max_tile_size // occupied.shape[0])
+            for first in range(0, in_box.shape[0], rows):
+                last = min(first + rows, in_box.shape[0])
+                tile = in_box[first:last]
+                chebyshev = np.max(np.abs(body_keys[first:last, np.newaxis, :] - cell_keys[np.newaxis, :, :]), axis=2)
+                far = chebyshev > 1
+                diff = cell_coms[np.newaxis, :, :] - self.positions[tile, np.newaxis, :]
+                dist2 = np.einsum("ijk,ijk->ij", diff, diff)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    weight = np.where(far, cell_masses / (dist2 * np.sqrt(dist2)), 0.)
+                self.add_forces(accelerations, compensation, tile, weight, diff)
+
+        # 3. Corps hors de la boîte
+        if grid.outliers.shape[0] > 0:
+            self.direct_acceleration(accelerations, compensation, in_box, grid.outliers)
+            outliers = grid.outliers[is_target[grid.outliers]]
+            self.direct_acceleration(accelerations, compensation, outliers, np.arange(n_bodies))
+        if targets is not None:
+            accelerations = accelerations[targets]
+        return (G * accelerations).astype(self.precision.storage)
+
+    def add_forces(self, accelerations : np.ndarray, compensation : np.ndarray, rows : np.ndarray,
+                   weight : np.ndarray, diff : np.ndarray):
+        """
+        Ajoute aux lignes rows (sans doublon) des accélérations les sommes Σ_j weight[i,j].diff[i,j,:] d'une tuile,
+        calculées dans le type des accélérations. Avec compensation (précision "float32"), les sommes des tuiles
+        successives sont ajoutées par sommation de Kahan ; celles d'une même tuile (einsum) ne sont pas compensées.
+        """
+        term = np.einsum("ij,ijk->ik", weight.astype(accelerations.dtype, copy=False), diff)
+        if compensation is None:
+            accelerations[rows] += term
+        else:
+            add_compensated(accelerations, compensation, rows, term)
+
+    def direct_acceleration(self, accelerations : np.ndarray, compensation : np.ndarray, targets : np.ndarray,
+                            sources : np.ndarray):
+        """
+        Ajoute aux accélérations des corps targets la somme directe (sans le facteur G) des attractions des corps
+        sources, découpée en tuiles d'au plus self.max_tile_size paires.
+        """
+        pos_j  = self.positions[sources]
+        mass_j = self.masses[sources]
+        rows = max(1, self.max_tile_size // max(1, sources.shape[0]))
+        for first in range(0, targets.shape[0], rows):
+            tile = targets[first:first+rows]
+            diff = pos_j[np.newaxis, :, :] - self.positions[tile, np.newaxis, :]
+            dist2 = np.einsum("ijk,ijk->ij", diff, diff)
+            with np.errstate(divide="ignore"):
+                weight = mass_j / (dist2 * np.sqrt(dist2))
+            # Exclut le corps lui-même
+            weight[dist2 <= 1.E-20] = 0.
+            self.add_forces(accelerations, compensation, tile, weight, diff)
+
+    def evaluate_acceleration(self, targets = None):
+        # compute_acceleration met déjà la grille à jour pour les positions courantes
+        return self.compute_acceleration(targets)
+
+    def potential_energy(self, positions : np.ndarray = None) -> float:
+        """
+        Énergie potentielle approchée (en float64) des corps placés en positions (par défaut les positions
+        courantes), calculée comme les accélérations : paires des cellules voisines, couples (corps, cellule
+        lointaine) et sommation directe pour les corps hors de la boîte. Le découpage en cellules est celui du
+        dernier calcul des accélérations, seuls les centres de masse sont recalculés : deux énergies calculées avec
+        le même découpage ne diffèrent que par le déplacement des corps (voir integrators.AdaptiveTimeStep).
+        Remplace la somme directe en O(N²) dans integrators.total_energy.
+        """
+        if positions is None:
+            positions = self.positions
+        positions = positions.astype(np.float64)
+        masses = self.masses.astype(np.float64)
+        grid = self.grid
+        n = grid.n_cells_per_dir
+        occupied = grid.occupied_cells
+        starts = grid.cell_start_indices
+        # Potentiel Σ_j m_j / r_ij de chaque corps, sans le facteur -G
+        phi = np.zeros(positions.shape[0])
+        cell_keys = np.stack((occupied % n[0], (occupied // n[0]) % n[1], occupied // (n[0]*n[1])), axis=1)
+        neighbor_keys = cell_keys[:, np.newaxis, :] + np.array(grid.neighbor_offsets)[np.newaxis, :, :]
+        inside = np.all((neighbor_keys >= 0) & (neighbor_keys < n), axis=2)
+        neighbor_cells = neighbor_keys[:,:,0] + neighbor_keys[:,:,1]*n[0] + neighbor_keys[:,:,2]*n[0]*n[1]
+        for icell, cell in enumerate(occupied):
+            i_bodies = grid.body_indices[starts[cell]:starts[cell+1]]
+            neighbors = neighbor_cells[icell, inside[icell]]
+            neighbors = neighbors[grid.cell_counts[neighbors] > 0]
+            j_bodies = np.concatenate([grid.body_indices[starts[c]:starts[c+1]] for c in neighbors])
+            rows = max(1, self.max_tile_size // j_bodies.shape[0])
+            for first in range(0, i_bodies.shape[0], rows):
+                i_tile = i_bodies[first:first+rows]
+                diff = positions[np.newaxis, j_bodies, :] - positions[i_tile, np.newaxis, :]
+                dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+                with np.errstate(divide="ignore"):
+                    weight = masses[j_bodies] / dist
+                weight[dist <= 1.E-10] = 0.
+                phi[i_tile] += np.sum(weight, axis=1)
+        # Cellules lointaines : masse et centre de masse recalculé aux positions données
+        if occupied.shape[0] > 0:
+            cell_masses = np.add.reduceat(masses[grid.body_indices], starts[occupied])
+            cell_coms = (np.add.reduceat(positions[grid.body_indices] * masses[grid.body_indices, np.newaxis],
+                                         starts[occupied], axis=0) / cell_masses[:, np.newaxis])
+            in_box = np.flatnonzero(grid.body_cells >= 0)
+            in_box_cells = grid.body_cells[in_box]
+            body_keys = np.stack((in_box_cells % n[0], (in_box_cells // n[0]) % n[1], in_box_cells // (n[0]*n[1])),
+                                 axis=1)
+            rows = max(1, self.max_tile_size // occupied.shape[0])
+            for first in range(0, in_box.shape[0], rows):
+                last = min(first + rows, in_box.shape[0])
+                tile = in_box[first:last]
+                far = np.max(np.abs(body_keys[first:last, np.newaxis, :] - cell_keys[np.newaxis, :, :]), axis=2) > 1
+                diff = cell_coms[np.newaxis, :, :] - positions[tile, np.newaxis, :]
+                dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+                with np.errstate(divide="ignore"):
+                    phi[tile] += np.sum(np.where(far, cell_masses / dist, 0.), axis=1)
+        energy = -0.5 * G * np.sum(masses * phi)
+        # Paires corps hors de la boîte - tous les corps, sans compter deux fois celles entre corps hors de la boîte
+        outliers = grid.outliers
+        if outliers.shape[0] > 0:
+            is_outlier = np.zeros(positions.shape[0], dtype=np.bool_)
+            is_outlier[outliers] = True
+            rows = max(1, self.max_tile_size // positions.shape[0])
+            for first in range(0, outliers.shape[0], rows):
+                tile = outliers[first:first+rows]
+                diff = positions[np.newaxis, :, :] - positions[tile, np.newaxis, :]
+                dist = np.sqrt(np.einsum("ijk,ijk->ij", diff, diff))
+                with np.errstate(divide="ignore"):
+                    weight = masses / dist
+                weight[dist <= 1.E-10] = 0.
+                weight[:, is_outlier] *= 0.5
+                energy -= G * np.sum(masses[tile] * np.sum(weight, axis=1))
+        return energy
     
+    def reorder_bodies(self):
+        """
+        Renumérote les corps (positions, vitesses, masses, couleurs) selon leur code de Morton, pour que les corps
+        proches dans l'espace soient aussi proches en mémoire. self.ids garde l'identifiant d'origine de chaque corps.
+        """
+        perm = morton.morton_order(self.positions)
+        self.positions = self.positions[perm]
+        self.velocities = self.velocities[perm]
+        self.masses = self.masses[perm]
+        self.colors = [self.colors[i] for i in perm]
+        self.ids = self.ids[perm]
+        if self.acceleration is not None:
+            self.acceleration = self.acceleration[perm]
+        self.integrator.permute(perm)
+        # Les cellules (qui servent aussi à potential_energy) suivent la nouvelle numérotation
+        self.grid.update_indices_in_cells(self.positions)
+
+    def positions_by_id(self):
+        """Positions des corps dans l'ordre du fichier d'origine (ordre attendu par l'affichage)."""
+        if self.reorder_period == 0:
+            return self.positions
+        return morton.in_original_order(self.positions, self.ids)
+
+    def interaction_count(self) -> int:
+        """
+        Nombre d'interactions d'un calcul complet des accélérations pour l'état courant de la grille : paires de
+        corps des cellules voisines, couples (corps, cellule lointaine occupée) et paires de la sommation directe
+        des corps hors de la boîte.
+        """
+        grid = self.grid
+        n_bodies = self.positions.shape[0]
+        n_outliers = grid.outliers.shape[0]
+        direct = n_outliers * (n_bodies - n_outliers) + n_outliers * (n_bodies - 1)
+        n = grid.n_cells_per_dir
+        occupied = grid.occupied_cells
+        cell_keys = np.stack((occupied % n[0], (occupied // n[0]) % n[1], occupied // (n[0]*n[1])), axis=1)
+        neighbor_keys = cell_keys[:, np.newaxis, :] + np.array(grid.neighbor_offsets)[np.newaxis, :, :]
+        inside = np.all((neighbor_keys >= 0) & (neighbor_keys < n), axis=2)
+        neighbor_cells = neighbor_keys[:,:,0] + neighbor_keys[:,:,1]*n[0] + neighbor_keys[:,:,2]*n[0]*n[1]
+        neighbor_counts = np.where(inside, grid.cell_counts[np.where(inside, neighbor_cells, 0)], 0)
+        neighbor_occupied = np.count_nonzero(neighbor_counts, axis=1)
+        bodies_per_cell = grid.cell_counts[occupied]
+        near = np.sum(bodies_per_cell * (np.sum(neighbor_counts, axis=1) - 1))
+        return int(direct + near + np.sum(bodies_per_cell * (occupied.shape[0] - neighbor_occupied)))
+
     def update_positions(self, dt):
-        accelerations = self.compute_acceleration()
+        if self.reorder_period > 0 and self.n_steps % self.reorder_period == 0:
+            self.reorder_bodies()
+        self.n_steps += 1
         # Met à jour les vitesses et positions de tous les corps :
-        self.positions  += self.velocities  * dt + 0.5 * accelerations * dt * dt
-        self.velocities += accelerations * dt
+        self.integrator.step(self, dt)
         
 system = None
 
 def update_positions(dt):
     global system
     system.update_positions(dt)
-    return system.positions
+    return system.positions_by_id()
 
 def run_simulation(filename, geometry=(800,600), ncells_per_dir=10, dt=0.001):
+    import visualizer3d
     # Initialise le système de corps :
     global system
     system = NBodySystem(filename, ncells_per_dir=ncells_per_dir)
+    print(system.grid_report())
     # Initialise l'affichage graphique :
     pos = system.positions
     col = system.colors
@@ -263,14 +545,18 @@ def run_simulation(filename, geometry=(800,600), ncells_per_dir=10, dt=0.001):
     visu.run(updater=update_positions, dt = dt)
 
 
-filename = "data/test_data"
-dt = 0.001
-ncells_per_dir = np.array([10, 10, 1])
-if len(sys.argv) > 1:
-    filename = sys.argv[1]
-if len(sys.argv) > 2:
-    dt = float(sys.argv[2])
-if len(sys.argv) > 3:
-    ncells_per_dir = np.array([int(x) for x in sys.argv[3].split(',')])
-print(f"Simulation de {filename} avec dt = {dt} et ncells_per_dir = {ncells_per_dir}")
-run_simulation(filename, dt=dt, ncells_per_dir=ncells_per_dir)
+if __name__ == "__main__":
+    filename = "data/test_data"
+    dt = 0.001
+    ncells_per_dir = np.array([10, 10, 1])
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        dt = float(sys.argv[2])
+    # "auto" à la place de nx,ny,nz : grille choisie par NBodySystem.tune_grid
+    if len(sys.argv) > 3 and sys.argv[3] == "auto":
+        ncells_per_dir = "auto"
+    elif len(sys.argv) > 3:
+        ncells_per_dir = np.array([int(x) for x in sys.argv[3].split(',')])
+    print(f"Simulation de {filename} avec dt = {dt} et ncells_per_dir = {ncells_per_dir}")
+    run_simulation(filename, dt=dt, ncells_per_dir=ncells_per_dir)
@@ -0,0 +1,520 @@
+# Méthode de la grille en mémoire distribuée (MPI) : décomposition de domaine.
+#
+# Les cellules de la grille (globale, la même sur tous les processus) sont rangées selon un ordre de parcours :
+#     - "slab" : tranches perpendiculaires à la direction qui a le plus de cellules
+#     - "sfc"  : courbe de Morton (ordre en Z) sur les indices (ix, iy, iz) des cellules, qui donne des domaines
+#                plus compacts (moins de cellules fantômes) quand la grille a plusieurs directions peuplées
+# puis découpées en intervalles consécutifs contenant à peu près le même nombre de corps : chaque processus
+# possède les cellules de son intervalle et les corps qu'elles contiennent.
+#
+# À chaque calcul des accélérations :
+#     1. chaque processus calcule pour ses cellules occupées le nombre de corps, la masse et la somme des m.x ;
+#        un Allgatherv rassemble ces moments partiels sur tous les processus, qui en déduisent la masse et le
+#        centre de masse de toutes les cellules (champ lointain) et les cellules occupées par chaque processus ;
+#     2. chaque processus envoie à chacun des autres (Alltoallv) ses corps situés à une distance de Chebyshev
+#        d'au plus 2 cellules d'une cellule occupée par le destinataire (corps fantômes du champ proche) ;
+#     3. le calcul local réutilise les noyaux de nbodies_grid_numba_parallel : grille morse des corps locaux et
+#        fantômes, listes d'interaction construites sur l'occupation globale des cellules.
+# Avant chaque pas de temps, les corps sortis des cellules d'un processus migrent vers leur nouveau propriétaire
+# (Alltoallv), avec leur accélération et l'état par corps de l'intégrateur.
+#
+# Équilibrage dynamique : le disque d'une galaxie est très dense au centre et clairsemé au bord, si bien qu'à nombre
+# de corps égal, les processus du centre calculent bien plus d'interactions. Après chaque calcul des accélérations,
+# tous les processus connaissent le coût (nombre d'interactions) des corps de chaque cellule, déduit des moments
+# rassemblés et des listes d'interaction globales, sans communication supplémentaire. Avant un pas, si la charge du
+# processus le plus chargé dépasse imbalance_threshold fois la charge moyenne, les cellules sont redistribuées
+# (même calcul, déterministe, sur tous les processus) :
+#     - "prefix" : intervalles consécutifs de l'ordre de parcours de coûts égaux (sommes préfixes pondérées)
+#     - "greedy" : l'ordre de parcours est découpé en chunks_per_rank fois plus d'intervalles que de processus, puis
+#                  les intervalles sont attribués du plus coûteux au moins coûteux au processus le moins chargé
+#                  (tas min, comme distribBlocks dans Exemples/Course2/mpi_diagonal_prod_matrix.py)
+#
+# Usage : mpirun -np 4 python3 nbodies_grid_mpi.py fichier dt n_pas [nx ny nz [slab|sfc [K préfixe [équilibrage [seuil]]]]]
+#     (nx = auto : grille choisie automatiquement, ny et nz sont alors ignorés)
+#     Sans affichage : le processus 0 affiche le débit et l'équilibre de charge, et écrit tous les K pas un
+#     instantané binaire (rassemblé par Gatherv) si un préfixe est donné (K = 0 : jamais). L'équilibrage vaut
+#     prefix (par défaut), greedy ou none.
+import sys
+import heapq
+import numpy as np
+from numba import njit, prange
+from mpi4py import MPI
+
+import morton
+import snapshot
+import integrators
+from grid_resolution import choose_cell_counts, is_auto
+from precision import make_precision
+from nbodies_grid_numba_parallel import update_stars_in_grid, build_interaction_lists, compute_acceleration
+
+DECOMPOSITIONS = ("slab", "sfc")
+BALANCINGS = ("prefix", "greedy", "none")
+# Rayon (distance de Chebyshev, en cellules) du champ proche des noyaux de nbodies_grid_numba_parallel
+NEAR_RADIUS = 2
+
+@njit(parallel=True)
+def compute_body_cells( positions : np.ndarray, grid_min : np.ndarray, cell_size : np.ndarray,
+                        n_cells : np.ndarray ) -> np.ndarray:
+    """
+    Indice (forme morse) de la cellule de chaque corps, calculé exactement comme dans update_stars_in_grid.
+    """
+    n_bodies = positions.shape[0]
+    cells = np.empty(n_bodies, dtype=np.int64)
+    for ibody in prange(n_bodies):
+        cell_idx = np.floor((positions[ibody] - grid_min) / cell_size).astype(np.int64)
+        for i in range(3):
+            if cell_idx[i] >= n_cells[i]:
+                cell_idx[i] = n_cells[i] - 1
+            elif cell_idx[i] < 0:
+                cell_idx[i] = 0
+        cells[ibody] = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
+    return cells
+
+@njit
+def dilate_cells( cells : np.ndarray, n_cells : np.ndarray, radius : int ) -> np.ndarray:
+    """
+    Masque des cellules situées à une distance de Chebyshev d'au plus radius d'une des cellules données.
+    """
+    mask = np.zeros(n_cells[0]*n_cells[1]*n_cells[2], dtype=np.bool_)
+    for c in cells:
+        ix = c % n_cells[0]
+        iy = (c // n_cells[0]) % n_cells[1]
+        iz = c // (n_cells[0]*n_cells[1])
+        for jz in range(max(iz - radius, 0), min(iz + radius, n_cells[2] - 1) + 1):
+            for jy in range(max(iy - radius, 0), min(iy + radius, n_cells[1] - 1) + 1):
+                for jx in range(max(ix - radius, 0), min(ix + radius, n_cells[0] - 1) + 1):
+                    mask[jx + jy*n_cells[0] + jz*n_cells[0]*n_cells[1]] = True
+    return mask
+
+def cell_order( n_cells : np.ndarray, decomposition : str ) -> np.ndarray:
+    """
+    Ordre de parcours des cellules utilisé pour les répartir entre les processus.
+
+    :param decomposition: "slab" (tranches selon la direction qui a le plus de cellules) ou "sfc" (courbe de Morton)
+    :return: Indices (forme morse) des cellules dans l'ordre de parcours
+    """
+    n_total = int(np.prod(n_cells))
+    cells = np.arange(n_total)
+    keys = np.stack((cells % n_cells[0], (cells // n_cells[0]) % n_cells[1], cells // (n_cells[0]*n_cells[1])))
+    if decomposition == "slab":
+        axis = int(np.argmax(n_cells))
+        # np.lexsort trie selon la dernière clé en premier
+        return np.lexsort([keys[i] for i in range(3) if i != axis] + [keys[axis]])
+    if decomposition == "sfc":
+        codes = (morton.spread_bits(keys[0]) | (morton.spread_bits(keys[1]) << np.uint64(1)) |
+                 (morton.spread_bits(keys[2]) << np.uint64(2)))
+        return np.argsort(codes, kind="stable")
+    raise ValueError(f"Décomposition inconnue : {decomposition} (choix : {', '.join(DECOMPOSITIONS)})")
+
+def partition_cells( order : np.ndarray, weights : np.ndarray, n_parts : int ) -> np.ndarray:
+    """
+    Découpe la suite des cellules (dans l'ordre order) en n_parts intervalles consécutifs de poids à peu près égaux
+    (somme préfixe des poids) : une cellule va à l'intervalle qui contient le milieu de son poids.
+
+    :return: Numéro du propriétaire de chaque cellule (forme morse)
+    """
+    w = weights[order].astype(np.float64)
+    cumulative = np.cumsum(w)
+    total = cumulative[-1] if cumulative.shape[0] > 0 else 0.
+    owner = np.empty(order.shape[0], dtype=np.int64)
+    if total <= 0.:
+        owner[order] = np.arange(order.shape[0]) * n_parts // max(order.shape[0], 1)
+        return owner
+    bounds = total * np.arange(1, n_parts) / n_parts
+    owner[order] = np.searchsorted(bounds, cumulative - 0.5*w, side="right")
+    return owner
+
+def greedy_partition( order : np.ndarray, weights : np.ndarray, n_parts : int, chunks_per_part : int = 4 ) -> np.ndarray:
+    """
+    Découpe la suite des cellules en n_parts*chunks_per_part intervalles de poids à peu près égaux, puis attribue
+    les intervalles, du plus lourd au plus léger, au processus le moins chargé (tas min des charges). Les intervalles
+    gardent la localité des cellules ; l'attribution gloutonne corrige l'écart de poids entre intervalles.
+
+    :return: Numéro du propriétaire de chaque cellule (forme morse)
+    """
+    n_chunks = n_parts * chunks_per_part
+    chunk = partition_cells(order, weights, n_chunks)
+    chunk_weights = np.bincount(chunk, weights=weights, minlength=n_chunks)
+    loads = [(0., part) for part in range(n_parts)]
+    chunk_owner = np.empty(n_chunks, dtype=np.int64)
+    for ichunk in np.argsort(-chunk_weights, kind="stable"):
+        load, part = heapq.heappop(loads)
+        chunk_owner[ichunk] = part
+        heapq.heappush(loads, (load + chunk_weights[ichunk], part))
+    return chunk_owner[chunk]
+
+def exchange_rows( comm, rows : np.ndarray, destinations : np.ndarray ) -> np.ndarray:
+    """
+    Envoie chaque ligne de rows (tableau (n, k) de réels double précision) au processus destinations[i] et retourne
+    les lignes reçues, rangées par processus d'origine (Alltoall des nombres de lignes puis Alltoallv).
+    """
+    size = comm.Get_size()
+    width = rows.shape[1]
+    order = np.argsort(destinations, kind="stable")
+    send = np.ascontiguousarray(rows[order], dtype=np.float64)
+    send_counts = np.bincount(destinations, minlength=size).astype(np.int64)
+    recv_counts = np.empty(size, dtype=np.int64)
+    comm.Alltoall(send_counts, recv_counts)
+    send_displs = np.concatenate(([0], np.cumsum(send_counts)[:-1]))
+    recv_displs = np.concatenate(([0], np.cumsum(recv_counts)[:-1]))
+    recv = np.empty((int(np.sum(recv_counts)), width), dtype=np.float64)
+    comm.Alltoallv([send, (send_counts*width, send_displs*width), MPI.DOUBLE],
+                   [recv, (recv_counts*width, recv_displs*width), MPI.DOUBLE])
+    return recv
+
+def allgather_rows( comm, rows : np.ndarray ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rassemble sur tous les processus les lignes (tableau (n, k) de réels double précision) de chacun (Allgatherv).
+
+    :return: Lignes de tous les processus (rangées par processus) et nombre de lignes de chaque processus
+    """
+    size = comm.Get_size()
+    width = rows.shape[1]
+    counts = np.empty(size, dtype=np.int64)
+    comm.Allgather(np.array([rows.shape[0]], dtype=np.int64), counts)
+    displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    recv = np.empty((int(np.sum(counts)), width), dtype=np.float64)
+    comm.Allgatherv(np.ascontiguousarray(rows, dtype=np.float64), [recv, (counts*width, displs*width), MPI.DOUBLE])
+    return recv, counts
+
+def cell_costs( cell_counts : np.ndarray, cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                far_start : np.ndarray ) -> np.ndarray:
+    """
+    Coût de calcul de chaque cellule : nombre d'interactions de ses corps (corps du champ proche et cellules
+    lointaines), plus un par corps pour son intégration en temps (le corps lui-même, compté parmi ses voisins proches).
+    """
+    occupied = np.flatnonzero(cell_slots >= 0)
+    near_bodies = np.add.reduceat(cell_counts[near_cells], near_start[:-1]) if occupied.shape[0] > 0 else 0
+    costs = np.zeros(cell_counts.shape[0], dtype=np.float64)
+    slots = cell_slots[occupied]
+    costs[occupied] = cell_counts[occupied] * (near_bodies[slots] + np.diff(far_start)[slots])
+    return costs
+
+class NBodySystem:
+    def __init__(self, filename, ncells_per_dir : tuple[int, int, int] = (10,10,10), decomposition : str = "sfc",
+                 integrator = "verlet", balancing : str = "prefix", imbalance_threshold : float = 1.1,
+                 chunks_per_rank : int = 4, comm = None, precision = "mixed"):
+        """
+        :param filename: Fichier contenant les données des corps (texte ou binaire .nbs, cf. snapshot.py) ; chaque
+                         processus n'en lit qu'une tranche, redistribuée ensuite selon la décomposition
+        :param ncells_per_dir: Nombre de cellules de la grille globale dans chaque direction, ou "auto" pour le
+                               choisir d'après le nombre total de corps, la forme de la boîte et le remplissage
+                               des cellules (grid_resolution.choose_cell_counts)
+        :param decomposition: Ordre de répartition des cellules entre processus ("slab" ou "sfc")
+        :param balancing: Redistribution des cellules selon leur coût ("prefix", "greedy" ou "none", cf. en-tête)
+        :param imbalance_threshold: Rapport charge maximale / charge moyenne au-delà duquel on redistribue
+        :param chunks_per_rank: Nombre d'intervalles de cellules par processus pour l'équilibrage "greedy"
+        :param integrator: Schéma d'intégration en temps (nom accepté par integrators.make_integrator ou instance) ;
+                           le pas adaptatif, qui décide à partir de l'énergie des seuls corps locaux, n'est pas permis
+        :param comm: Communicateur MPI (par défaut MPI.COMM_WORLD)
+        :param precision: Précision du stockage des corps et des sommes des forces ("mixed", "float32" ou "float64",
+                          voir precision.py) ; les échanges MPI se font toujours en float64
+        """
+        self.precision = make_precision(precision)
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+        self.decomposition = decomposition
+        if balancing not in BALANCINGS:
+            raise ValueError(f"Équilibrage inconnu : {balancing} (choix : {', '.join(BALANCINGS)})")
+        self.balancing = balancing
+        self.imbalance_threshold = imbalance_threshold
+        self.chunks_per_rank = chunks_per_rank
+        # Coût de chaque cellule au dernier calcul des accélérations, charge de chaque processus correspondante
+        self.cell_costs = None
+        self.imbalance = 1.
+        self.n_rebalances = 0
+
+        masses, positions, velocities = snapshot.load_bodies(filename)
+        n_total_bodies = masses.shape[0]
+        first = self.rank * n_total_bodies // self.size
+        last = (self.rank + 1) * n_total_bodies // self.size
+        self.n_total_bodies = n_total_bodies
+        self.positions  = np.array(positions[first:last], dtype=self.precision.storage)
+        self.velocities = np.array(velocities[first:last], dtype=self.precision.storage)
+        self.masses     = np.array(masses[first:last], dtype=self.precision.storage)
+        self.ids = np.arange(first, last)
+        # Accélération calculée pour les positions courantes au pas précédent
+        self.acceleration = None
+        self.integrator = integrators.make_integrator(integrator)
+        if isinstance(self.integrator, integrators.AdaptiveTimeStep):
+            raise ValueError("Le pas de temps adaptatif n'est pas disponible en mémoire distribuée")
+        self.n_steps = 0
+
+        # Grille globale : mêmes bornes (fixes) que SpatialGrid, calculées sur tous les corps
+        dtype = self.precision.storage
+        local_min = np.min(self.positions, axis=0) if last > first else np.full(3, np.inf, dtype=dtype)
+        local_max = np.max(self.positions, axis=0) if last > first else np.full(3, -np.inf, dtype=dtype)
+        global_min = np.empty(3, dtype=dtype)
+        global_max = np.empty(3, dtype=dtype)
+        self.comm.Allreduce(local_min, global_min, op=MPI.MIN)
+        self.comm.Allreduce(local_max, global_max, op=MPI.MAX)
+        self.min_bounds = global_min - 1.E-6
+        self.max_bounds = global_max + 1.E-6
+        # Choix de la grille automatique (le même sur tous les processus) : nombre de cellules et remplissage
+        self.grid_tuning = None
+        if is_auto(ncells_per_dir):
+            extent = self.max_bounds - self.min_bounds
+            self.set_cell_counts(choose_cell_counts(n_total_bodies, extent))
+            fill_ratio = np.count_nonzero(self.global_cell_counts()) / self.n_total_cells
+            ncells_per_dir = choose_cell_counts(n_total_bodies, extent, fill_ratio=fill_ratio)
+            self.grid_tuning = {"ncells_per_dir": tuple(int(n) for n in ncells_per_dir),
+                                "fill_ratio": float(fill_ratio)}
+        self.set_cell_counts(ncells_per_dir)
+
+        # Répartition des cellules : intervalles de l'ordre de parcours contenant autant de corps que possible
+        self.cell_order = cell_order(self.n_cells, decomposition)
+        self.cell_owner = partition_cells(self.cell_order, self.global_cell_counts(), self.size)
+        self.migrate()
+
+    def set_cell_counts(self, ncells_per_dir):
+        """Découpe la boîte globale en ncells_per_dir cellules (avant la répartition des cellules)."""
+        self.n_cells = np.array(ncells_per_dir)
+        self.cell_size = (self.max_bounds - self.min_bounds) / self.n_cells
+        self.n_total_cells = int(np.prod(self.n_cells))
+
+    def grid_report(self) -> str:
+        """Description de la grille globale (et de son choix automatique), pour les comptes rendus de temps."""
+        n_cells = "x".join(str(int(n)) for n in self.n_cells)
+        if self.grid_tuning is not None:
+            n_cells += f" (automatique : remplissage {self.grid_tuning['fill_ratio']:.2f})"
+        return f"grille {n_cells}"
+
+    def body_cells(self) -> np.ndarray:
+        """Cellule (forme morse) de chaque corps local."""
+        return compute_body_cells(self.positions, self.min_bounds, self.cell_size, self.n_cells)
+
+    def global_cell_counts(self) -> np.ndarray:
+        """Nombre de corps de chaque cellule, tous processus confondus (Allreduce)."""
+        local_counts = np.bincount(self.body_cells(), minlength=self.n_total_cells).astype(np.int64)
+        counts = np.empty_like(local_counts)
+        self.comm.Allreduce(local_counts, counts, op=MPI.SUM)
+        return counts
+
+    def migrate(self):
+        """
+        Envoie chaque corps au propriétaire de sa cellule, avec son identifiant, son accélération (si elle est
+        connue) et l'état par corps de l'intégrateur. Les corps locaux sont ensuite rangés par identifiant.
+        """
+        n_local = self.positions.shape[0]
+        columns = [self.ids[:, np.newaxis], self.masses[:, np.newaxis], self.positions, self.velocities]
+        if self.acceleration is not None:
+            columns.append(self.acceleration)
+        state = self.integrator.body_state()
+        columns += [np.asarray(array).reshape(n_local, -1) for array in state]
+        rows = np.hstack([np.asarray(column, dtype=np.float64) for column in columns])
+        received = exchange_rows(self.comm, rows, self.cell_owner[self.body_cells()])
+        received = received[np.argsort(received[:, 0], kind="stable")]
+
+        self.ids = received[:, 0].astype(np.int64)
+        self.masses = received[:, 1].astype(self.precision.storage)
+        self.positions = np.ascontiguousarray(received[:, 2:5], dtype=self.precision.storage)
+        self.velocities = np.ascontiguousarray(received[:, 5:8], dtype=self.precision.storage)
+        column = 8
+        if self.acceleration is not None:
+            self.acceleration = np.ascontiguousarray(received[:, 8:11], dtype=self.acceleration.dtype)
+            column = 11
+        new_state = []
+        for array in state:
+            array = np.asarray(array)
+            width = int(np.prod(array.shape[1:]))
+            new_state.append(received[:, column:column + width].astype(array.dtype)
+                             .reshape((received.shape[0],) + array.shape[1:]))
+            column += width
+        self.integrator.set_body_state(new_state)
+
+    def evaluate_acceleration(self, targets : np.ndarray = None):
+        """
+        Calcule l'accélération des corps locaux (ou des seuls corps locaux d'indices targets). Opération
+        collective : tous les processus doivent l'appeler ensemble.
+        """
+        n_local = self.positions.shape[0]
+        if targets is None:
+            targets = np.arange(n_local)
+        cells = self.body_cells()
+
+        # 1. Moments partiels des cellules occupées localement, rassemblés sur tous les processus
+        local_occupied, slot = np.unique(cells, return_inverse=True)
+        masses = self.masses.astype(np.float64)
+        moments = np.empty((local_occupied.shape[0], 6), dtype=np.float64)
+        moments[:, 0] = local_occupied
+        moments[:, 1] = np.bincount(slot, minlength=local_occupied.shape[0])
+        moments[:, 2] = np.bincount(slot, weights=masses, minlength=local_occupied.shape[0])
+        for i in range(3):
+            moments[:, 3+i] = np.bincount(slot, weights=masses*self.positions[:, i], minlength=local_occupied.shape[0])
+        all_moments, moment_counts = allgather_rows(self.comm, moments)
+        all_cells = all_moments[:, 0].astype(np.int64)
+        self.cell_counts = np.zeros(self.n_total_cells, dtype=np.int64)
+        np.add.at(self.cell_counts, all_cells, all_moments[:, 1].astype(np.int64))
+        cell_masses = np.zeros(self.n_total_cells, dtype=np.float64)
+        np.add.at(cell_masses, all_cells, all_moments[:, 2])
+        cell_com_positions = np.zeros((self.n_total_cells, 3), dtype=np.float64)
+        np.add.at(cell_com_positions, all_cells, all_moments[:, 3:6])
+        occupied = cell_masses > 0.
+        cell_com_positions[occupied] /= cell_masses[occupied, np.newaxis]
+
+        # 2. Corps fantômes : corps locaux proches d'une cellule occupée par un autre processus
+        sent_bodies = []
+        destinations = []
+        bounds = np.concatenate(([0], np.cumsum(moment_counts)))
+        for other in range(self.size):
+            if other == self.rank:
+                continue
+            near_other = dilate_cells(all_cells[bounds[other]:bounds[other+1]], self.n_cells, NEAR_RADIUS)
+            selected = np.flatnonzero(near_other[cells])
+            sent_bodies.append(selected)
+            destinations.append(np.full(selected.shape[0], other, dtype=np.int64))
+        sent_bodies = np.concatenate(sent_bodies) if sent_bodies else np.empty(0, dtype=np.int64)
+        destinations = np.concatenate(destinations) if destinations else np.empty(0, dtype=np.int64)
+        rows = np.hstack((self.positions[sent_bodies].astype(np.float64), masses[sent_bodies, np.newaxis]))
+        ghosts = exchange_rows(self.comm, rows, destinations)
+        self.n_ghosts = ghosts.shape[0]
+        all_positions = np.concatenate((self.positions, ghosts[:, 0:3].astype(self.precision.storage)))
+        all_masses = np.concatenate((self.masses, ghosts[:, 3].astype(self.precision.storage)))
+
+        # 3. Calcul local : grille morse des corps locaux et fantômes, listes d'interaction globales
+        self.cell_start_indices = np.full(self.n_total_cells + 1, -1, dtype=np.int64)
+        body_indices = np.empty(all_positions.shape[0], dtype=np.int64)
+        local_cell_masses = np.zeros(self.n_total_cells, dtype=self.precision.storage)
+        local_cell_coms = np.zeros((self.n_total_cells, 3), dtype=self.precision.storage)
+        update_stars_in_grid(self.cell_start_indices, body_indices, local_cell_masses, local_cell_coms,
+                             all_masses, all_positions, self.min_bounds, self.max_bounds, self.cell_size, self.n_cells)
+        # Seule l'occupation des cellules compte pour les listes d'interaction : elle est globale
+        occupancy = np.zeros(self.n_total_cells + 1, dtype=np.int64)
+        np.cumsum(self.cell_counts > 0, out=occupancy[1:])
+        (self.cell_slots, self.near_start, self.near_cells,
+         self.far_start, self.far_cells) = build_interaction_lists(occupancy, self.n_cells)[1:]
+        self.cell_costs = cell_costs(self.cell_counts, self.cell_slots, self.near_start, self.near_cells, self.far_start)
+        # Moments globaux rassemblés en float64, utilisés dans la précision des corps comme ceux de SpatialGrid
+        dtype = self.precision.storage
+        return compute_acceleration(all_positions, all_masses, self.cell_start_indices, body_indices,
+                                    cell_masses.astype(dtype), cell_com_positions.astype(dtype),
+                                    self.min_bounds, self.max_bounds,
+                                    self.cell_size, self.n_cells, self.cell_slots, self.near_start, self.near_cells,
+                                    self.far_start, self.far_cells, np.zeros((1, 6)), False, targets,
+                                    self.precision.accumulator, self.precision.compensated)
+
+    def rank_loads(self) -> np.ndarray:
+        """Charge (coût des cellules possédées, au dernier calcul des accélérations) de chaque processus."""
+        return np.bincount(self.cell_owner, weights=self.cell_costs, minlength=self.size)
+
+    def rebalance(self) -> bool:
+        """
+        Redistribue les cellules selon leur coût si le déséquilibre de charge dépasse le seuil. Le calcul ne
+        dépend que de données globales identiques sur tous les processus : il donne partout la même répartition.
+
+        :return: True si les cellules ont été redistribuées
+        """
+        if self.cell_costs is None:
+            return False
+        loads = self.rank_loads()
+        self.imbalance = np.max(loads) / max(np.mean(loads), 1.)
+        if self.balancing == "none" or self.imbalance <= self.imbalance_threshold:
+            return False
+        if self.balancing == "greedy":
+            self.cell_owner = greedy_partition(self.cell_order, self.cell_costs, self.size, self.chunks_per_rank)
+        else:
+            self.cell_owner = partition_cells(self.cell_order, self.cell_costs, self.size)
+        self.n_rebalances += 1
+        return True
+
+    def update_positions(self, dt):
+        """
+        Redistribue si besoin les cellules, puis les corps selon leur cellule, et avance le système d'un pas dt
+        (opération collective).
+        """
+        self.rebalance()
+        self.migrate()
+        self.n_steps += 1
+        self.integrator.step(self, dt)
+
+    def interaction_count(self) -> int:
+        """
+        Nombre total (tous processus) d'interactions d'un calcul complet des accélérations pour l'état du dernier
+        calcul : paires de corps du champ proche et couples (corps, cellule lointaine).
+        """
+        return int(np.sum(self.cell_costs) - np.sum(self.cell_counts))
+
+    def gather_state(self, root : int = 0):
+        """
+        Rassemble (Gatherv) les corps de tous les processus sur le processus root, dans l'ordre du fichier d'origine.
+
+        :return: masses, positions et vitesses sur root, None sur les autres processus
+        """
+        rows = np.hstack((self.ids[:, np.newaxis], self.masses[:, np.newaxis], self.positions,
+                          self.velocities)).astype(np.float64)
+        counts = np.array(self.comm.gather(rows.shape[0], root=root))
+        recv = None
+        if self.rank == root:
+            recv = np.empty((int(np.sum(counts)), rows.shape[1]), dtype=np.float64)
+            displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            self.comm.Gatherv(rows, [recv, (counts*rows.shape[1], displs*rows.shape[1]), MPI.DOUBLE], root=root)
+        else:
+            self.comm.Gatherv(rows, None, root=root)
+        if self.rank != root:
+            return None
+        recv = recv[np.argsort(recv[:, 0], kind="stable")]
+        dtype = self.precision.storage
+        return recv[:, 1].astype(dtype), recv[:, 2:5].astype(dtype), recv[:, 5:8].astype(dtype)
+
+def run_simulation(filename, dt, n_steps, ncells_per_dir=(20,20,1), decomposition="sfc",
+                   snapshot_every=0, prefix=None, balancing="prefix", imbalance_threshold=1.1, comm=None):
+    """
+    Simulation sans affichage : n_steps pas de temps, débit et équilibre de charge affichés par le processus 0.
+    """
+    import headless
+    comm = MPI.COMM_WORLD if comm is None else comm
+    system = NBodySystem(filename, ncells_per_dir, decomposition, balancing=balancing,
+                         imbalance_threshold=imbalance_threshold, comm=comm)
+    writer = None
+    if comm.Get_rank() == 0 and snapshot_every > 0 and prefix is not None:
+        writer = headless.SnapshotWriter(prefix)
+    # Premier calcul (compilation des noyaux numba) hors du temps mesuré
+    system.acceleration = system.evaluate_acceleration()
+    comm.Barrier()
+    start = MPI.Wtime()
+    for step in range(1, n_steps + 1):
+        system.update_positions(dt)
+        if snapshot_every > 0 and prefix is not None and step % snapshot_every == 0:
+            state = system.gather_state()
+            if writer is not None:
+                writer.submit(step, step * dt, *state)
+    comm.Barrier()
+    elapsed = MPI.Wtime() - start
+    interactions = system.interaction_count()
+    local_counts = comm.gather(system.positions.shape[0], root=0)
+    ghost_counts = comm.gather(system.n_ghosts, root=0)
+    if writer is not None:
+        writer.close()
+    if comm.Get_rank() == 0:
+        print(f"{system.n_total_bodies} corps sur {comm.Get_size()} processus ({decomposition}), {n_steps} pas en "
+              f"{elapsed:.2f} s : {n_steps/elapsed:.2f} pas/s, {interactions*n_steps/elapsed:.3e} interactions/s")
+        print(f"  - corps par processus : {local_counts} (déséquilibre max/moyenne : "
+              f"{max(local_counts)/np.mean(local_counts):.2f})")
+        print(f"  - {system.grid_report()}")
+        print(f"  - corps fantômes reçus : {ghost_counts}")
+        loads = system.rank_loads()
+        print(f"  - interactions par processus : {loads.astype(np.int64).tolist()} (déséquilibre max/moyenne : "
+              f"{np.max(loads)/np.mean(loads):.2f}, équilibrage {balancing} : {system.n_rebalances} redistribution(s))")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage : mpirun -np 4 python3 nbodies_grid_mpi.py fichier dt n_pas "
+              "[nx ny nz [slab|sfc [K préfixe [prefix|greedy|none [seuil]]]]]")
+        sys.exit(1)
+    filename = sys.argv[1]
+    dt = float(sys.argv[2])
+    n_steps = int(sys.argv[3])
+    n_cells_per_dir = (20, 20, 1)
+    # "auto" à la place de nx (ny et nz sont alors ignorés) : grille choisie par grid_resolution.choose_cell_counts
+    if len(sys.argv) > 4 and sys.argv[4] == "auto":
+        n_cells_per_dir = "auto"
+    elif len(sys.argv) > 6:
+        n_cells_per_dir = (int(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]))
+    decomposition = sys.argv[7] if len(sys.argv) > 7 else "sfc"
+    snapshot_every = int(sys.argv[8]) if len(sys.argv) > 9 else 0
+    prefix = sys.argv[9] if len(sys.argv) > 9 else None
+    balancing = sys.argv[10] if len(sys.argv) > 10 else "prefix"
+    imbalance_threshold = float(sys.argv[11]) if len(sys.argv) > 11 else 1.1
+    run_simulation(filename, dt, n_steps, n_cells_per_dir, decomposition, snapshot_every, prefix,
+                   balancing, imbalance_threshold)
@@ -2,9 +2,15 @@
 #     On crée une classe représentant le système de corps avec la méthode d'intégration basée sur une grille.
 # On utilise numba pour accélérer les calculs.
 import numpy as np
-import visualizer3d
 import sys
-from numba import njit, range
+from numba import njit
+import morton
+import integrators
+import snapshot
+import core_box
+from grid_resolution import choose_cell_counts, is_auto
+from precision import make_precision
+from precision_kernels import accumulate
 
 # Unités:
 # - Distance: année-lumière (ly)
@@ -44,26 +50,47 @@ def generate_star_color(mass : float) -> tuple[int, int, int]:
         return (255, 150, 100)
 
 @njit
-def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+def body_cell_in_box( pos : np.ndarray, grid_min : np.ndarray, grid_max : np.ndarray, cell_size : np.ndarray,
+                      n_cells : np.ndarray ) -> int:
+    """
+    Indice (morse) de la cellule contenant la position pos, ou -1 si pos est hors de la boîte.
+    """
+    for i in range(3):
+        if pos[i] < grid_min[i] or pos[i] > grid_max[i]:
+            return -1
+    cell_idx = np.floor((pos - grid_min) / cell_size).astype(np.int64)
+    # Gère le cas où un corps est exactement sur la borne max
+    for i in range(3):
+        if cell_idx[i] >= n_cells[i]:
+            cell_idx[i] = n_cells[i] - 1
+        elif cell_idx[i] < 0:
+            cell_idx[i] = 0
+    return cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
+
+@njit
+def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.ndarray, body_cells : np.ndarray,
                           cell_masses : np.ndarray, cell_com_positions : np.ndarray,
                           masses: np.ndarray,
                           positions : np.ndarray, grid_min : np.ndarray, grid_max : np.ndarray,
-                          cell_size : np.ndarray, n_cells : np.ndarray):
+                          cell_size : np.ndarray, n_cells : np.ndarray) -> int:
+    """
+    Range chaque corps dans sa cellule (body_cells, -1 pour un corps hors de la boîte, qui n'est rangé dans
+    aucune cellule), construit la grille morse puis la masse et le centre de masse de chaque cellule.
+
+    :return: Nombre de corps hors de la boîte
+    """
     n_bodies = positions.shape[0]
     # Réinitialise les compteurs de début des cellules
     cell_start_indices.fill(-1)
     # Compte le nombre de corps dans chaque cellule
     cell_counts = np.zeros(shape=(np.prod(n_cells),), dtype=np.int64)
+    n_outside = 0
     for ibody in range(n_bodies):
-        cell_idx = np.floor((positions[ibody] - grid_min) / cell_size).astype(np.int64)
-        # Gère le cas où un corps est exactement sur la borne max   
-        for i in range(3):
-            if cell_idx[i] >= n_cells[i]:
-                cell_idx[i] = n_cells[i] - 1
-            elif cell_idx[i] < 0:
-                cell_idx[i] = 0
-        morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
-        cell_counts[morse_idx] += 1
+        body_cells[ibody] = body_cell_in_box(positions[ibody], grid_min, grid_max, cell_size, n_cells)
+        if body_cells[ibody] < 0:
+            n_outside += 1
+        else:
+            cell_counts[body_cells[ibody]] += 1
     # Calcule les indices de début des cellules
     running_index = 0
     for i in range(len(cell_counts)):
@@ -73,20 +100,27 @@ def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.nda
     # Remplit les indices des corps dans les cellules
     current_counts = np.zeros(shape=(np.prod(n_cells),), dtype=np.int64)
     for ibody in range(n_bodies):
-        cell_idx = np.floor((positions[ibody] - grid_min) / cell_size).astype(np.int64)
-        for i in range(3):
-            if cell_idx[i] >= n_cells[i]:
-                cell_idx[i] = n_cells[i] - 1
-            elif cell_idx[i] < 0:
-                cell_idx[i] = 0
-        morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
+        morse_idx = body_cells[ibody]
+        if morse_idx < 0:
+            continue
         index_in_cell = cell_start_indices[morse_idx] + current_counts[morse_idx]
         body_indices[index_in_cell] = ibody
         current_counts[morse_idx] += 1
     # Maintenant, on peut calculer le centre de masse et la masse totale de chaque cellule
-    for i in range(len(cell_counts)):
+    compute_cell_moments(cell_start_indices, body_indices, cell_masses, cell_com_positions, masses, positions)
+    return n_outside
+
+@njit
+def compute_cell_moments( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                          cell_masses : np.ndarray, cell_com_positions : np.ndarray,
+                          masses : np.ndarray, positions : np.ndarray ):
+    """
+    Calcule la masse totale et le centre de masse de chaque cellule à partir de la grille morse
+    (sommes en float64 quelle que soit la précision des corps).
+    """
+    for i in range(cell_masses.shape[0]):
         cell_mass = 0.0
-        com_position = np.zeros(3, dtype=np.float32)
+        com_position = np.zeros(3, dtype=np.float64)
         start_idx = cell_start_indices[i]
         end_idx = cell_start_indices[i+1]
         for j in range(start_idx, end_idx):
@@ -100,15 +134,135 @@ def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.nda
         cell_masses[i] = cell_mass
         cell_com_positions[i] = com_position
 
+@njit
+def compute_cell_quadrupoles( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                              masses : np.ndarray, positions : np.ndarray,
+                              cell_com_positions : np.ndarray, cell_quadrupoles : np.ndarray ):
+    """
+    Calcule le moment quadripolaire (sans trace) de chaque cellule par rapport à son centre de masse :
+    Q = somme_i m_i (3 r_i r_i^T - |r_i|^2 I), stocké sous la forme (xx, xy, xz, yy, yz, zz).
+    """
+    for i in range(cell_quadrupoles.shape[0]):
+        q = np.zeros(6)
+        for j in range(cell_start_indices[i], cell_start_indices[i+1]):
+            ibody = body_indices[j]
+            m = masses[ibody]
+            rx = positions[ibody, 0] - cell_com_positions[i, 0]
+            ry = positions[ibody, 1] - cell_com_positions[i, 1]
+            rz = positions[ibody, 2] - cell_com_positions[i, 2]
+            r2 = rx*rx + ry*ry + rz*rz
+            q[0] += m * (3.*rx*rx - r2)
+            q[1] += m * 3.*rx*ry
+            q[2] += m * 3.*rx*rz
+            q[3] += m * (3.*ry*ry - r2)
+            q[4] += m * 3.*ry*rz
+            q[5] += m * (3.*rz*rz - r2)
+        cell_quadrupoles[i] = q
+
+@njit
+def quadrupole_acceleration( dx : float, dy : float, dz : float, distance : float, q : np.ndarray ):
+    """
+    Correction quadripolaire de l'accélération créée par une cellule de moment q (xx, xy, xz, yy, yz, zz),
+    (dx, dy, dz) étant le vecteur allant de la position cible au centre de masse de la cellule.
+    Avec d = -(dx, dy, dz) et r = |d| : a = G (Q.d / r^5 - 5/2 (d.Q.d) d / r^7)
+    """
+    qx = q[0]*dx + q[1]*dy + q[2]*dz
+    qy = q[1]*dx + q[3]*dy + q[4]*dz
+    qz = q[2]*dx + q[4]*dy + q[5]*dz
+    inv_dist5 = G / distance**5
+    coef = 2.5 * (dx*qx + dy*qy + dz*qz) * inv_dist5 / (distance*distance)
+    return coef*dx - qx*inv_dist5, coef*dy - qy*inv_dist5, coef*dz - qz*inv_dist5
+
+@njit
+def build_interaction_lists( cell_start_indices : np.ndarray, n_cells : np.ndarray ):
+    """
+    Construit pour l'état courant de la grille la liste des cellules occupées et, pour chacune d'elles,
+    la liste de ses cellules proches (distance de Chebyshev <= 2) et de ses cellules lointaines,
+    en ne gardant que des cellules occupées. Les listes sont stockées sous forme morse :
+    les cellules proches de la k-ième cellule occupée sont near_cells[near_start[k]:near_start[k+1]]
+    (même chose pour les cellules lointaines). Ces listes sont partagées par tous les corps d'une même cellule.
+    """
+    n_total = n_cells[0]*n_cells[1]*n_cells[2]
+    # Numérotation des cellules occupées
+    cell_slots = np.full(n_total, -1, dtype=np.int64)
+    n_occupied = 0
+    for i in range(n_total):
+        if cell_start_indices[i+1] > cell_start_indices[i]:
+            cell_slots[i] = n_occupied
+            n_occupied += 1
+    occupied_cells = np.empty(n_occupied, dtype=np.int64)
+    for i in range(n_total):
+        if cell_slots[i] >= 0:
+            occupied_cells[cell_slots[i]] = i
+    # Compte le nombre de cellules proches de chaque cellule occupée
+    near_counts = np.zeros(n_occupied, dtype=np.int64)
+    for k in range(n_occupied):
+        ck = occupied_cells[k]
+        ix = ck % n_cells[0]
+        iy = (ck // n_cells[0]) % n_cells[1]
+        iz = ck // (n_cells[0]*n_cells[1])
+        for l in range(n_occupied):
+            cl = occupied_cells[l]
+            if (abs(cl % n_cells[0] - ix) <= 2 and abs((cl // n_cells[0]) % n_cells[1] - iy) <= 2 and
+                abs(cl // (n_cells[0]*n_cells[1]) - iz) <= 2):
+                near_counts[k] += 1
+    near_start = np.empty(n_occupied+1, dtype=np.int64)
+    far_start  = np.empty(n_occupied+1, dtype=np.int64)
+    near_start[0] = 0
+    far_start[0]  = 0
+    for k in range(n_occupied):
+        near_start[k+1] = near_start[k] + near_counts[k]
+        far_start[k+1]  = far_start[k] + n_occupied - near_counts[k]
+    # Remplit les listes (chaque cellule occupée écrit dans sa propre tranche)
+    near_cells = np.empty(near_start[n_occupied], dtype=np.int64)
+    far_cells  = np.empty(far_start[n_occupied], dtype=np.int64)
+    for k in range(n_occupied):
+        ck = occupied_cells[k]
+        ix = ck % n_cells[0]
+        iy = (ck // n_cells[0]) % n_cells[1]
+        iz = ck // (n_cells[0]*n_cells[1])
+        inear = near_start[k]
+        ifar  = far_start[k]
+        for l in range(n_occupied):
+            cl = occupied_cells[l]
+            if (abs(cl % n_cells[0] - ix) <= 2 and abs((cl // n_cells[0]) % n_cells[1] - iy) <= 2 and
+                abs(cl // (n_cells[0]*n_cells[1]) - iz) <= 2):
+                near_cells[inear] = cl
+                inear += 1
+            else:
+                far_cells[ifar] = cl
+                ifar += 1
+    return occupied_cells, cell_slots, near_start, near_cells, far_start, far_cells
+
+def count_interactions( cell_start_indices : np.ndarray, occupied_cells : np.ndarray,
+                        near_start : np.ndarray, near_cells : np.ndarray, far_start : np.ndarray ) -> int:
+    """
+    Nombre d'interactions calculées par un calcul complet des accélérations : paires de corps du champ proche
+    et couples (corps, cellule lointaine).
+    """
+    counts = np.diff(cell_start_indices)
+    bodies_per_cell = counts[occupied_cells]
+    # Chaque liste de cellules proches contient au moins la cellule elle-même (jamais vide)
+    near_bodies = np.add.reduceat(counts[near_cells], near_start[:-1])
+    near = np.sum(bodies_per_cell * (near_bodies - 1))
+    return int(near + np.sum(bodies_per_cell * np.diff(far_start)))
+
 @njit
 def compute_acceleration( positions : np.ndarray, masses : np.ndarray,
                           cell_start_indices : np.ndarray, body_indices : np.ndarray,
                           cell_masses : np.ndarray, cell_com_positions : np.ndarray,
                           grid_min : np.ndarray, grid_max : np.ndarray,
-                          cell_size : np.ndarray, n_cells : np.ndarray):
-    n_bodies = positions.shape[0]
-    a = np.zeros_like(positions)
-    for ibody in range(n_bodies):
+                          cell_size : np.ndarray, n_cells : np.ndarray,
+                          cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                          far_start : np.ndarray, far_cells : np.ndarray,
+                          cell_quadrupoles : np.ndarray, use_quadrupole : bool, targets : np.ndarray,
+                          accumulator, compensated : bool):
+    # Seuls les corps de targets sont calculés (tous les corps : targets = np.arange(n)). Les sommes sont dans le
+    # type accumulator, compensées si compensated (voir precision.py)
+    a = np.zeros((targets.shape[0], 3), dtype=positions.dtype)
+    g = accumulator(G)
+    for itarget in range(targets.shape[0]):
+        ibody = targets[itarget]
         pos = positions[ibody]
         cell_idx = np.floor((pos - grid_min) / cell_size).astype(np.int64)
         for i in range(3):
@@ -116,41 +270,153 @@ def compute_acceleration( positions : np.ndarray, masses : np.ndarray,
                 cell_idx[i] = n_cells[i] - 1
             elif cell_idx[i] < 0:
                 cell_idx[i] = 0
-        # Parcourt toutes les cellules pour calculer la contribution gravitationnelle
-        for ix in range(n_cells[0]):
-            for iy in range(n_cells[1]):
-                for iz in range(n_cells[2]):
-                    morse_idx = ix + iy*n_cells[0] + iz*n_cells[0]*n_cells[1]
-                    if (abs(ix-cell_idx[0]) > 2) or (abs(iy-cell_idx[1]) > 2) or (abs(iz-cell_idx[2]) > 2):
-                        cell_com = cell_com_positions[morse_idx]    
-                        cell_mass = cell_masses[morse_idx]
-                        if cell_mass > 0.0:
-                            direction = cell_com - pos
-                            distance = np.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
-                            if distance > 1.E-10:
-                                inv_dist3 = 1.0 / (distance ** 3)
-                                a[ibody,:] += G * direction[:] * inv_dist3 * cell_mass
-                    else:
-                        # Parcourt les corps dans cette cellule
-                        start_idx = cell_start_indices[morse_idx]
-                        end_idx = cell_start_indices[morse_idx+1]
-                        for j in range(start_idx, end_idx):
-                            jbody = body_indices[j]
-                            if jbody != ibody:
-                                direction = positions[jbody] - pos
-                                distance = np.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
-                                if distance > 1.E-10:
-                                    inv_dist3 = 1.0 / (distance ** 3)
-                                    a[ibody,:] += G * direction[:] * inv_dist3 * masses[jbody]
+        morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
+        slot = cell_slots[morse_idx]
+        ax = ay = az = accumulator(0.)
+        cx = cy = cz = accumulator(0.)
+        # Contribution des cellules lointaines (centre de masse et masse totale)
+        for k in range(far_start[slot], far_start[slot+1]):
+            cell = far_cells[k]
+            dx = cell_com_positions[cell, 0] - pos[0]
+            dy = cell_com_positions[cell, 1] - pos[1]
+            dz = cell_com_positions[cell, 2] - pos[2]
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if distance > 1.E-10:
+                inv_dist3 = g * cell_masses[cell] / (distance ** 3)
+                ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                    dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+                if use_quadrupole:
+                    qx, qy, qz = quadrupole_acceleration(dx, dy, dz, distance, cell_quadrupoles[cell])
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, accumulator(qx), accumulator(qy),
+                                                        accumulator(qz), compensated)
+        # Contribution des corps contenus dans les cellules proches
+        for k in range(near_start[slot], near_start[slot+1]):
+            cell = near_cells[k]
+            for j in range(cell_start_indices[cell], cell_start_indices[cell+1]):
+                jbody = body_indices[j]
+                if jbody != ibody:
+                    dx = positions[jbody, 0] - pos[0]
+                    dy = positions[jbody, 1] - pos[1]
+                    dz = positions[jbody, 2] - pos[2]
+                    distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                    if distance > 1.E-10:
+                        inv_dist3 = g * masses[jbody] / (distance ** 3)
+                        ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, dx * inv_dist3,
+                                                            dy * inv_dist3, dz * inv_dist3, compensated)
+        a[itarget, 0] = ax
+        a[itarget, 1] = ay
+        a[itarget, 2] = az
+    return a
+
+@njit
+def direct_acceleration( positions : np.ndarray, masses : np.ndarray, targets : np.ndarray, sources : np.ndarray,
+                         accumulator, compensated : bool ):
+    """
+    Accélération exercée sur chaque corps de targets par les corps de sources, par sommation directe
+    (sert aux corps hors de la boîte de la grille).
+    """
+    a = np.zeros((targets.shape[0], 3), dtype=positions.dtype)
+    g = accumulator(G)
+    for itarget in range(targets.shape[0]):
+        ibody = targets[itarget]
+        ax = ay = az = accumulator(0.)
+        cx = cy = cz = accumulator(0.)
+        for jbody in sources:
+            if jbody != ibody:
+                dx = positions[jbody, 0] - positions[ibody, 0]
+                dy = positions[jbody, 1] - positions[ibody, 1]
+                dz = positions[jbody, 2] - positions[ibody, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    inv_dist3 = g * masses[jbody] / (distance ** 3)
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                        dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+        a[itarget, 0] = ax
+        a[itarget, 1] = ay
+        a[itarget, 2] = az
     return a
 
+@njit
+def grid_potential_energy( positions : np.ndarray, masses : np.ndarray,
+                           cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                           cell_masses : np.ndarray, cell_com_positions : np.ndarray, body_cells : np.ndarray,
+                           cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                           far_start : np.ndarray, far_cells : np.ndarray ) -> float:
+    """
+    Énergie potentielle approchée des corps de la grille entre eux, -G/2.Σ_i m_i.φ_i, le potentiel φ_i étant
+    calculé comme l'accélération dans compute_acceleration : corps des cellules proches un par un, cellules
+    lointaines par leur masse et leur centre de masse. Coût d'un calcul des accélérations au lieu de O(N²).
+    Les corps hors de la boîte (body_cells < 0) sont ignorés (voir direct_potential_energy). Sommes en float64.
+    """
+    n_bodies = positions.shape[0]
+    energy = 0.
+    for ibody in range(n_bodies):
+        if body_cells[ibody] < 0:
+            continue
+        slot = cell_slots[body_cells[ibody]]
+        x = np.float64(positions[ibody, 0])
+        y = np.float64(positions[ibody, 1])
+        z = np.float64(positions[ibody, 2])
+        phi = 0.
+        for k in range(near_start[slot], near_start[slot+1]):
+            cell = near_cells[k]
+            for j in range(cell_start_indices[cell], cell_start_indices[cell+1]):
+                jbody = body_indices[j]
+                if jbody != ibody:
+                    dx = positions[jbody, 0] - x
+                    dy = positions[jbody, 1] - y
+                    dz = positions[jbody, 2] - z
+                    distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                    if distance > 1.E-10:
+                        phi += masses[jbody] / distance
+        for k in range(far_start[slot], far_start[slot+1]):
+            cell = far_cells[k]
+            dx = cell_com_positions[cell, 0] - x
+            dy = cell_com_positions[cell, 1] - y
+            dz = cell_com_positions[cell, 2] - z
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if distance > 1.E-10:
+                phi += cell_masses[cell] / distance
+        energy += masses[ibody] * phi
+    return -0.5 * G * energy
+
+@njit
+def direct_potential_energy( positions : np.ndarray, masses : np.ndarray,
+                             targets : np.ndarray, sources : np.ndarray ) -> float:
+    """
+    Somme directe -G.Σ_{i de targets} Σ_{j de sources, j != i} m_i.m_j / r_ij (en float64) : une paire dont les deux
+    corps sont à la fois dans targets et dans sources est comptée deux fois.
+    """
+    energy = 0.
+    for itarget in range(targets.shape[0]):
+        ibody = targets[itarget]
+        phi = 0.
+        for jbody in sources:
+            if jbody != ibody:
+                dx = np.float64(positions[jbody, 0]) - positions[ibody, 0]
+                dy = np.float64(positions[jbody, 1]) - positions[ibody, 1]
+                dz = np.float64(positions[jbody, 2]) - positions[ibody, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    phi += masses[jbody] / distance
+        energy += masses[ibody] * phi
+    return -G * energy
+
 # On crée une grille cartésienne régulière pour diviser l'espace englobant la galaxie en cellules
 class SpatialGrid:
     """_summary_
     """
-    def __init__(self, positions : np.ndarray, nb_cells_per_dim : tuple[int, int, int]):
-        self.min_bounds = np.min(positions, axis=0) - 1.E-6
-        self.max_bounds = np.max(positions, axis=0) + 1.E-6
+    def __init__(self, positions : np.ndarray, nb_cells_per_dim : tuple[int, int, int], use_quadrupole : bool = False,
+                 max_outliers : int = None):
+        """
+        :param max_outliers: La boîte de la grille suit le cœur des positions (core_box.CoreBox) en laissant dehors
+                             au plus max_outliers corps, qui ne sont dans aucune cellule et sont traités par
+                             sommation directe (None : core_box.default_max_outliers, 0 : la boîte contient
+                             tous les corps)
+        """
+        self.core_box = core_box.CoreBox(positions, max_outliers)
+        self.min_bounds = self.core_box.min_bounds
+        self.max_bounds = self.core_box.max_bounds
         self.n_cells = np.array(nb_cells_per_dim)
         self.cell_size = (self.max_bounds - self.min_bounds) / self.n_cells
         # On va stocker les indices des corps dans chaque cellule adéquate
@@ -158,81 +424,253 @@ class SpatialGrid:
         # et on gère deux tableaux : un pour le début des indices de chaque cellule, un autre pour les indices des corps
         self.cell_start_indices = np.full(np.prod(self.n_cells) + 1, -1, dtype=np.int64)
         self.body_indices = np.empty(shape=(positions.shape[0],), dtype=np.int64)
-        # Stockage du centre de masse de chaque cellule et de la masse totale contenue dans chaque cellule
-        self.cell_masses = np.zeros(shape=(np.prod(self.n_cells),), dtype=np.float32)
-        self.cell_com_positions = np.zeros(shape=(np.prod(self.n_cells), 3), dtype=np.float32)
+        # Cellule de chaque corps (-1 hors de la boîte) et corps hors de la boîte à la dernière mise à jour
+        self.body_cells = np.empty(shape=(positions.shape[0],), dtype=np.int64)
+        self.outliers = np.empty(0, dtype=np.int64)
+        # Stockage du centre de masse de chaque cellule et de la masse totale contenue dans chaque cellule (dans la
+        # précision des corps)
+        self.cell_masses = np.zeros(shape=(np.prod(self.n_cells),), dtype=positions.dtype)
+        self.cell_com_positions = np.zeros(shape=(np.prod(self.n_cells), 3), dtype=positions.dtype)
+        # Moments quadripolaires optionnels (xx, xy, xz, yy, yz, zz) de chaque cellule
+        self.use_quadrupole = use_quadrupole
+        self.cell_quadrupoles = np.zeros(shape=(np.prod(self.n_cells), 6), dtype=np.float64)
         
-    def update_bounds(self, positions : np.ndarray):
-        self.min_bounds = np.min(positions, axis=0) - 1.E-6
-        self.max_bounds = np.max(positions, axis=0) + 1.E-6
+    def update_bounds(self, positions : np.ndarray, n_outside : int) -> bool:
+        """
+        Déplace la boîte de la grille si le cœur des positions l'exige (voir core_box.CoreBox).
+
+        :param n_outside: Nombre de corps hors de la boîte courante
+        :return: Vrai si la boîte a changé (toutes les cellules sont à refaire)
+        """
+        if not self.core_box.update(positions, n_outside):
+            return False
+        self.min_bounds = self.core_box.min_bounds
+        self.max_bounds = self.core_box.max_bounds
         self.cell_size = (self.max_bounds - self.min_bounds) / self.n_cells
-        
+        return True
+
+    def fill_ratio(self) -> float:
+        """Proportion de cellules occupées à la dernière mise à jour."""
+        return self.occupied_cells.shape[0] / np.prod(self.n_cells)
+
+    def _fill_cells(self, positions : np.ndarray, masses : np.ndarray) -> int:
+        """Construit la grille dans la boîte courante et retourne le nombre de corps hors de la boîte."""
+        return update_stars_in_grid( self.cell_start_indices, self.body_indices, self.body_cells,
+                                     self.cell_masses, self.cell_com_positions,
+                                     masses,
+                                     positions, self.min_bounds, self.max_bounds,
+                                     self.cell_size, self.n_cells)
+
     def update(self, positions : np.ndarray, masses : np.ndarray):
-        #self.update_bounds(positions)
-        update_stars_in_grid( self.cell_start_indices, self.body_indices,                             
-                              self.cell_masses, self.cell_com_positions,
-                              masses,
-                              positions, self.min_bounds, self.max_bounds,
-                              self.cell_size, self.n_cells)
+        n_outside = self._fill_cells(positions, masses)
+        if self.update_bounds(positions, n_outside):
+            n_outside = self._fill_cells(positions, masses)
+        self.outliers = np.flatnonzero(self.body_cells < 0) if n_outside > 0 else np.empty(0, dtype=np.int64)
+        if self.use_quadrupole:
+            compute_cell_quadrupoles( self.cell_start_indices, self.body_indices, masses, positions,
+                                      self.cell_com_positions, self.cell_quadrupoles )
+        # Listes d'interaction (cellules proches/lointaines) partagées par les corps d'une même cellule
+        (self.occupied_cells, self.cell_slots, self.near_start, self.near_cells,
+         self.far_start, self.far_cells) = build_interaction_lists(self.cell_start_indices, self.n_cells)
 
 class NBodySystem:
-    def __init__(self, filename, ncells_per_dir : tuple[int, int, int] = (10,10,10)):
-        positions = []
-        velocities = []
-        masses    = []
+    def __init__(self, filename, ncells_per_dir : tuple[int, int, int] = (10,10,10), use_quadrupole : bool = False,
+                 reorder_period : int = 0, integrator = "verlet", max_outliers : int = None,
+                 precision = "mixed"):
+        """
+        :param filename: Fichier contenant les données des corps (texte ou binaire .nbs, cf. snapshot.py)
+        :param ncells_per_dir: Nombre de cellules de la grille dans chaque direction, ou "auto" pour le choisir
+                               d'après le nombre de corps et la forme de la boîte (voir tune_grid)
+        :param use_quadrupole: Ajoute le moment quadripolaire des cellules au champ lointain, ce qui permet
+                               d'atteindre la même précision avec une grille plus grossière
+        :param reorder_period: Nombre de pas de temps entre deux renumérotations des corps selon l'ordre de
+                               Morton (0 : jamais). Les corps voisins dans l'espace deviennent voisins en mémoire
+        :param integrator: Schéma d'intégration en temps (nom accepté par integrators.make_integrator ou instance)
+        :param max_outliers: Nombre maximal de corps laissés hors de la boîte de la grille (voir core_box.CoreBox),
+                             traités par sommation directe (None : core_box.default_max_outliers, 0 : la boîte
+                             contient tous les corps)
+        :param precision: Précision du stockage des corps et des sommes des forces : "mixed" (float32 et sommes en
+                          float64), "float32" (sommes compensées) ou "float64", voir precision.py
+        """
+        self.precision = make_precision(precision)
+        masses, positions, velocities = snapshot.load_bodies(filename)
+        self.max_mass = float(np.max(masses))
+        self.box = snapshot.bounding_box(positions) # Contient les coins min et max du système
         
-        self.max_mass = 0.
-        self.box = np.array([[-1.E-6,-1.E-6,-1.E-6],[1.E-6,1.E-6,1.E-6]], dtype=np.float64) # Contient les coins min et max du système
-        with open(filename, "r") as fich:
-            line = fich.readline() # Récupère la masse, la position et la vitesse sous forme de chaîne
-            # Récupère les données numériques pour instancier un corps qu'on rajoute aux corps déjà présents :
-            while line:
-                data = line.split()
-                masses.append(float(data[0]))
-                positions.append([float(data[1]), float(data[2]), float(data[3])])
-                velocities.append([float(data[4]), float(data[5]), float(data[6])])
-                self.max_mass = max(self.max_mass, masses[-1])
-                
-                for i in range(3):
-                    self.box[0][i] = min(self.box[0][i], positions[-1][i]-1.E-6)
-                    self.box[1][i] = max(self.box[1][i], positions[-1][i]+1.E-6)
-                    
-                line = fich.readline()
-        
-        self.positions  = np.array(positions, dtype=np.float32)
-        self.velocities = np.array(velocities, dtype=np.float32)
-        self.masses     = np.array(masses, dtype=np.float32)
+        self.positions  = np.array(positions, dtype=self.precision.storage)
+        self.velocities = np.array(velocities, dtype=self.precision.storage)
+        self.masses     = np.array(masses, dtype=self.precision.storage)
         self.colors = [generate_star_color(m) for m in masses]
-        self.grid = SpatialGrid(self.positions, ncells_per_dir)
+        self.ids = np.arange(self.positions.shape[0])
+        # Accélération calculée pour les positions courantes (et la grille courante) au pas précédent
+        self.acceleration = None
+        self.integrator = integrators.make_integrator(integrator)
+        self.reorder_period = reorder_period
+        self.n_steps = 0
+        # Choix de la grille automatique : nombre de cellules et remplissage utilisés
+        self.grid_tuning = None
+        auto_grid = is_auto(ncells_per_dir)
+        if auto_grid:
+            extent = core_box.CoreBox(self.positions, max_outliers).extent()
+            ncells_per_dir = choose_cell_counts(self.positions.shape[0], extent)
+        self.grid = SpatialGrid(self.positions, ncells_per_dir, use_quadrupole, max_outliers)
+        self.grid.update(self.positions, self.masses)
+        if auto_grid:
+            self.tune_grid()
+
+    def tune_grid(self):
+        """
+        Choisit le nombre de cellules par direction (grid_resolution.choose_cell_counts) pour les positions
+        courantes et le remplissage de la grille courante, puis reconstruit la grille sur leur boîte englobante.
+        Le rapport des coûts d'une interaction proche et d'une interaction lointaine n'est pas mesuré (il vaut 1,
+        voir nbodies_grid_numba_parallel.NBodySystem.tune_grid pour sa mesure).
+        """
+        grid = self.grid
+        max_outliers = grid.core_box.max_outliers
+        extent = core_box.CoreBox(self.positions, max_outliers).extent()
+        fill_ratio = grid.fill_ratio()
+        n_cells = choose_cell_counts(self.positions.shape[0], extent, fill_ratio=fill_ratio)
+        self.grid = SpatialGrid(self.positions, n_cells, grid.use_quadrupole, max_outliers)
         self.grid.update(self.positions, self.masses)
+        self.grid_tuning = {"ncells_per_dir": tuple(int(n) for n in n_cells), "fill_ratio": float(fill_ratio)}
+
+    def grid_report(self) -> str:
+        """Description de la grille utilisée (et de son choix automatique), pour les comptes rendus de temps."""
+        grid = self.grid
+        n_cells = "x".join(str(int(n)) for n in grid.n_cells)
+        if self.grid_tuning is not None:
+            n_cells += f" (automatique : remplissage {self.grid_tuning['fill_ratio']:.2f})"
+        return (f"grille {n_cells}, {grid.outliers.shape[0]} corps hors de la boîte "
+                f"({grid.core_box.n_changes} déplacement(s) de la boîte)")
+
+    def reorder_bodies(self):
+        """
+        Renumérote les corps (positions, vitesses, masses, couleurs) selon leur code de Morton, pour que les corps
+        proches dans l'espace soient aussi proches en mémoire. self.ids garde l'identifiant d'origine de chaque corps.
+        """
+        perm = morton.morton_order(self.positions)
+        self.positions = self.positions[perm]
+        self.velocities = self.velocities[perm]
+        self.masses = self.masses[perm]
+        self.colors = [self.colors[i] for i in perm]
+        self.ids = self.ids[perm]
+        if self.acceleration is not None:
+            self.acceleration = self.acceleration[perm]
+        self.integrator.permute(perm)
+        self.grid.update(self.positions, self.masses)
+
+    def positions_by_id(self):
+        """Positions des corps dans l'ordre du fichier d'origine (ordre attendu par l'affichage)."""
+        if self.reorder_period == 0:
+            return self.positions
+        return morton.in_original_order(self.positions, self.ids)
         
-    def update_positions(self, dt):
-        """Applique la méthode de Verlet vectorisée pour mettre à jour les positions et vitesses des corps."""
-        a = compute_acceleration( self.positions, self.masses,
-                                  self.grid.cell_start_indices, self.grid.body_indices,
-                                  self.grid.cell_masses, self.grid.cell_com_positions,
-                                  self.grid.min_bounds, self.grid.max_bounds,
-                                  self.grid.cell_size, self.grid.n_cells)
-        self.positions += self.velocities * dt + 0.5 * a * dt * dt
+    def compute_acceleration(self, targets : np.ndarray = None):
+        """
+        Calcule l'accélération de chaque corps (ou des seuls corps d'indices targets) à partir de l'état
+        courant de la grille. Les corps hors de la boîte de la grille sont traités par sommation directe : ils
+        subissent l'attraction de tous les autres corps et l'exercent sur les corps de la grille.
+        """
+        if targets is None:
+            targets = np.arange(self.positions.shape[0])
+        outliers = self.grid.outliers
+        if outliers.shape[0] == 0:
+            return self.grid_acceleration(targets)
+        outside = self.grid.body_cells[targets] < 0
+        inside_targets = targets[~outside]
+        a = np.empty((targets.shape[0], 3), dtype=self.positions.dtype)
+        accumulator, compensated = self.precision.accumulator, self.precision.compensated
+        a[~outside] = (self.grid_acceleration(inside_targets) +
+                       direct_acceleration(self.positions, self.masses, inside_targets, outliers,
+                                           accumulator, compensated))
+        a[outside] = direct_acceleration(self.positions, self.masses, targets[outside],
+                                         np.arange(self.positions.shape[0]), accumulator, compensated)
+        return a
+
+    def grid_acceleration(self, targets : np.ndarray):
+        """
+        Accélération exercée par les corps de la grille sur les corps d'indices targets (tous dans la grille).
+        """
+        return compute_acceleration( self.positions, self.masses,
+                                     self.grid.cell_start_indices, self.grid.body_indices,
+                                     self.grid.cell_masses, self.grid.cell_com_positions,
+                                     self.grid.min_bounds, self.grid.max_bounds,
+                                     self.grid.cell_size, self.grid.n_cells,
+                                     self.grid.cell_slots, self.grid.near_start, self.grid.near_cells,
+                                     self.grid.far_start, self.grid.far_cells,
+                                     self.grid.cell_quadrupoles, self.grid.use_quadrupole, targets,
+                                     self.precision.accumulator, self.precision.compensated)
+
+    def evaluate_acceleration(self, targets : np.ndarray = None):
+        """
+        Met à jour la grille pour les positions courantes et calcule l'accélération de chaque corps
+        (ou seulement des corps d'indices targets, dans cet ordre).
+        """
         self.grid.update(self.positions, self.masses)
-        a_new = compute_acceleration( self.positions, self.masses,
-                                      self.grid.cell_start_indices, self.grid.body_indices,
-                                      self.grid.cell_masses, self.grid.cell_com_positions,
-                                      self.grid.min_bounds, self.grid.max_bounds,
-                                      self.grid.cell_size, self.grid.n_cells)
-        self.velocities += 0.5 * (a + a_new) * dt
+        return self.compute_acceleration(targets)
+
+    def interaction_count(self) -> int:
+        """Nombre d'interactions d'un calcul complet des accélérations pour l'état courant de la grille."""
+        grid = self.grid
+        n_bodies = self.positions.shape[0]
+        n_outliers = grid.outliers.shape[0]
+        # Sommation directe : des corps hors de la boîte sur ceux de la grille, de tous les corps sur eux
+        direct = n_outliers * (n_bodies - n_outliers) + n_outliers * (n_bodies - 1)
+        return direct + count_interactions(grid.cell_start_indices, grid.occupied_cells, grid.near_start,
+                                           grid.near_cells, grid.far_start)
+
+    def potential_energy(self, positions : np.ndarray = None) -> float:
+        """
+        Énergie potentielle approchée (voir grid_potential_energy) des corps placés en positions (par défaut les
+        positions courantes), avec le découpage en cellules de la dernière mise à jour de la grille : seuls les
+        centres de masse des cellules sont recalculés. Remplace la somme directe en O(N²) dans
+        integrators.total_energy ; deux énergies calculées avec le même découpage ne diffèrent que par le
+        déplacement des corps (pas de saut quand un corps change de cellule), voir integrators.AdaptiveTimeStep.
+        Les corps hors de la boîte interagissent par sommation directe avec tous les autres.
+        """
+        if positions is None:
+            positions = self.positions
+        grid = self.grid
+        cell_masses = np.empty(grid.cell_masses.shape[0])
+        cell_com_positions = np.empty((grid.cell_masses.shape[0], 3))
+        compute_cell_moments(grid.cell_start_indices, grid.body_indices, cell_masses, cell_com_positions,
+                             self.masses, positions)
+        energy = grid_potential_energy(positions, self.masses, grid.cell_start_indices, grid.body_indices,
+                                       cell_masses, cell_com_positions, grid.body_cells,
+                                       grid.cell_slots, grid.near_start, grid.near_cells,
+                                       grid.far_start, grid.far_cells)
+        outliers = grid.outliers
+        if outliers.shape[0] > 0:
+            # Paires corps hors de la boîte - tous les corps, sans compter deux fois celles entre corps hors de la boîte
+            energy += (direct_potential_energy(positions, self.masses, outliers, np.arange(positions.shape[0])) -
+                       0.5 * direct_potential_energy(positions, self.masses, outliers, outliers))
+        return energy
+
+    def update_positions(self, dt):
+        """
+        Avance le système d'un pas de temps dt avec l'intégrateur choisi (Verlet vitesse par défaut).
+        L'accélération aux nouvelles positions sert aussi d'accélération initiale au pas suivant : elle est
+        conservée dans self.acceleration et on n'a qu'un calcul de forces par pas.
+        """
+        if self.reorder_period > 0 and self.n_steps % self.reorder_period == 0:
+            self.reorder_bodies()
+        self.n_steps += 1
+        self.integrator.step(self, dt)
 
 system : NBodySystem
 
 def update_positions(dt : float):
     global system
     system.update_positions(dt)
-    return system.positions
+    return system.positions_by_id()
 
-def run_simulation(filename, geometry=(800,600), ncells_per_dir : tuple[int, int, int] = (10,10,10), dt=0.001):
+def run_simulation(filename, geometry=(800,600), ncells_per_dir : tuple[int, int, int] = (10,10,10), dt=0.001,
+                   use_quadrupole : bool = False):
+    import visualizer3d
     # Initialise le système de corps :
     global system
-    system = NBodySystem(filename, ncells_per_dir=ncells_per_dir)
+    system = NBodySystem(filename, ncells_per_dir=ncells_per_dir, use_quadrupole=use_quadrupole)
+    print(system.grid_report())
     # Initialise l'affichage graphique :
     pos = system.positions
     col = system.colors
@@ -241,16 +679,22 @@ def run_simulation(filename, geometry=(800,600), ncells_per_dir : tuple[int, int
     visu.run(updater=update_positions, dt = dt)
 
 
-filename = "data/galaxy_1000"
-dt = 0.001
-n_cells_per_dir = (20,20,1)
-if len(sys.argv) > 1:
-    filename = sys.argv[1]
-if len(sys.argv) > 2:
-    dt = float(sys.argv[2])
-if len(sys.argv) > 5:
-    n_cells_per_dir = (int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
-    
-print(f"Simulation de {filename} avec dt = {dt} et grille {n_cells_per_dir}")
-run_simulation(filename, ncells_per_dir=n_cells_per_dir, dt=dt)
-    
+if __name__ == "__main__":
+    filename = "data/galaxy_1000"
+    dt = 0.001
+    n_cells_per_dir = (20,20,1)
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        dt = float(sys.argv[2])
+    # "auto" à la place de nx (ny et nz sont alors ignorés) : grille choisie par NBodySystem.tune_grid
+    if len(sys.argv) > 3 and sys.argv[3] == "auto":
+        n_cells_per_dir = "auto"
+    elif len(sys.argv) > 5:
+        n_cells_per_dir = (int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    use_quadrupole = len(sys.argv) > 6 and sys.argv[6] == "quad"
+
+    print(f"Simulation de {filename} avec dt = {dt} et grille {n_cells_per_dir}")
+    if use_quadrupole:
+        print("Champ lointain corrigé par les moments quadripolaires des cellules")
+    run_simulation(filename, ncells_per_dir=n_cells_per_dir, dt=dt, use_quadrupole=use_quadrupole)
@@ -2,9 +2,16 @@
 #     On crée une classe représentant le système de corps avec la méthode d'intégration basée sur une grille.
 # On utilise numba pour accélérer les calculs.
 import numpy as np
-import visualizer3d
 import sys
-from numba import njit, prange
+import time
+from numba import njit, prange, get_num_threads
+import morton
+import integrators
+import snapshot
+import core_box
+from grid_resolution import choose_cell_counts, is_auto
+from precision import make_precision
+from precision_kernels import accumulate
 
 # Unités:
 # - Distance: année-lumière (ly)
@@ -49,44 +56,91 @@ def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.nda
                           masses: np.ndarray,
                           positions : np.ndarray, grid_min : np.ndarray, grid_max : np.ndarray,
                           cell_size : np.ndarray, n_cells : np.ndarray):
+    """
+    Construit la grille morse (début de chaque cellule et numéros des corps, par numéros croissants dans chaque
+    cellule) puis la masse et le centre de masse de chaque cellule. Un corps hors de la boîte est rangé dans la
+    cellule du bord.
+    """
     n_bodies = positions.shape[0]
-    # Réinitialise les compteurs de début des cellules
-    cell_start_indices.fill(-1)
-    # Compte le nombre de corps dans chaque cellule
-    cell_counts = np.zeros(shape=(np.prod(n_cells),), dtype=np.int64)
+    # Cellule de chaque corps
+    body_cells = np.empty(n_bodies, dtype=np.int64)
     for ibody in prange(n_bodies):
-        cell_idx = np.floor((positions[ibody] - grid_min) / cell_size).astype(np.int64)
-        # Gère le cas où un corps est exactement sur la borne max   
-        for i in range(3):
-            if cell_idx[i] >= n_cells[i]:
-                cell_idx[i] = n_cells[i] - 1
-            elif cell_idx[i] < 0:
-                cell_idx[i] = 0
-        morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
-        cell_counts[morse_idx] += 1
-    # Calcule les indices de début des cellules
-    running_index = 0
-    for i in prange(len(cell_counts)):
-        cell_start_indices[i] = running_index
-        running_index += cell_counts[i]
-    cell_start_indices[len(cell_counts)] = running_index # Fin du dernier corps
-    # Remplit les indices des corps dans les cellules
-    current_counts = np.zeros(shape=(np.prod(n_cells),), dtype=np.int64)
-    for ibody in prange(n_bodies):
-        cell_idx = np.floor((positions[ibody] - grid_min) / cell_size).astype(np.int64)
-        for i in range(3):
-            if cell_idx[i] >= n_cells[i]:
-                cell_idx[i] = n_cells[i] - 1
-            elif cell_idx[i] < 0:
-                cell_idx[i] = 0
-        morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
-        index_in_cell = cell_start_indices[morse_idx] + current_counts[morse_idx]
-        body_indices[index_in_cell] = ibody
-        current_counts[morse_idx] += 1
+        body_cells[ibody] = body_cell(positions[ibody], grid_min, cell_size, n_cells)
+    build_cell_lists(body_cells, cell_start_indices, body_indices)
     # Maintenant, on peut calculer le centre de masse et la masse totale de chaque cellule
-    for i in prange(len(cell_counts)):
+    compute_cell_moments(cell_start_indices, body_indices, cell_masses, cell_com_positions, masses, positions)
+
+@njit(parallel=True)
+def build_cell_lists( body_cells : np.ndarray, cell_start_indices : np.ndarray, body_indices : np.ndarray ) -> int:
+    """
+    Construit la grille morse à partir de la cellule de chaque corps (les corps de cellule négative ne sont
+    rangés dans aucune cellule) : les corps de la cellule c sont body_indices[cell_start_indices[c]:
+    cell_start_indices[c+1]], par numéros croissants.
+
+    Les corps sont répartis en blocs contigus, un par fil d'exécution : chaque bloc compte ses corps par cellule
+    dans son propre histogramme, un parcours préfixe exclusif donne à chaque (cellule, bloc) sa place, puis
+    chaque bloc range ses corps dans l'ordre. Aucun compteur n'est partagé entre fils et le résultat est
+    identique à celui d'une construction séquentielle, quel que soit le nombre de fils. Les histogrammes
+    (n_blocs x n_cellules entiers) ne contiennent pas plus d'entrées qu'il n'y a de corps : quand les cellules
+    sont plus nombreuses que les corps, un seul bloc compte les corps (comptage séquentiel).
+
+    :return: Nombre de corps rangés dans les cellules
+    """
+    n_bodies = body_cells.shape[0]
+    n_total = cell_start_indices.shape[0] - 1
+    n_blocks = max(1, min(get_num_threads(), n_bodies // 1024, n_bodies // max(1, n_total)))
+    # Histogramme de chaque bloc de corps
+    block_counts = np.zeros((n_blocks, n_total), dtype=np.int64)
+    for b in prange(n_blocks):
+        for ibody in range(b * n_bodies // n_blocks, (b+1) * n_bodies // n_blocks):
+            if body_cells[ibody] >= 0:
+                block_counts[b, body_cells[ibody]] += 1
+    # Nombre de corps de chaque cellule, puis rang de début de chaque (cellule, bloc) à l'intérieur de la cellule
+    cell_counts = np.empty(n_total, dtype=np.int64)
+    for i in prange(n_total):
+        count = 0
+        for b in range(n_blocks):
+            block_count = block_counts[b, i]
+            block_counts[b, i] = count
+            count += block_count
+        cell_counts[i] = count
+    # Parcours préfixe exclusif des cellules, par tranches : sommes des tranches, décalage de chaque tranche,
+    # puis parcours de chaque tranche à partir de son décalage
+    n_chunks = max(1, min(get_num_threads(), n_total // 1024))
+    chunk_sums = np.zeros(n_chunks + 1, dtype=np.int64)
+    for c in prange(n_chunks):
+        total = 0
+        for i in range(c * n_total // n_chunks, (c+1) * n_total // n_chunks):
+            total += cell_counts[i]
+        chunk_sums[c+1] = total
+    for c in range(n_chunks):
+        chunk_sums[c+1] += chunk_sums[c]
+    for c in prange(n_chunks):
+        running_index = chunk_sums[c]
+        for i in range(c * n_total // n_chunks, (c+1) * n_total // n_chunks):
+            cell_start_indices[i] = running_index
+            running_index += cell_counts[i]
+    cell_start_indices[n_total] = chunk_sums[n_chunks] # Fin du dernier corps
+    # Chaque bloc range ses corps, dans l'ordre, à partir de sa place dans chaque cellule
+    for b in prange(n_blocks):
+        for ibody in range(b * n_bodies // n_blocks, (b+1) * n_bodies // n_blocks):
+            cell = body_cells[ibody]
+            if cell >= 0:
+                body_indices[cell_start_indices[cell] + block_counts[b, cell]] = ibody
+                block_counts[b, cell] += 1
+    return chunk_sums[n_chunks]
+
+@njit(parallel=True)
+def compute_cell_moments( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                          cell_masses : np.ndarray, cell_com_positions : np.ndarray,
+                          masses : np.ndarray, positions : np.ndarray ):
+    """
+    Calcule la masse totale et le centre de masse de chaque cellule à partir de la grille morse
+    (sommes en float64 quelle que soit la précision des corps).
+    """
+    for i in prange(cell_masses.shape[0]):
         cell_mass = 0.0
-        com_position = np.zeros(3, dtype=np.float32)
+        com_position = np.zeros(3, dtype=np.float64)
         start_idx = cell_start_indices[i]
         end_idx = cell_start_indices[i+1]
         for j in range(start_idx, end_idx):
@@ -100,57 +154,625 @@ def update_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.nda
         cell_masses[i] = cell_mass
         cell_com_positions[i] = com_position
 
+@njit
+def body_cell( pos : np.ndarray, grid_min : np.ndarray, cell_size : np.ndarray, n_cells : np.ndarray ) -> int:
+    """
+    Indice (morse) de la cellule contenant la position pos, calculé comme dans update_stars_in_grid
+    (un corps hors de la boîte est rangé dans la cellule du bord).
+    """
+    morse_idx = 0
+    stride = 1
+    for i in range(3):
+        idx = int(np.floor((pos[i] - grid_min[i]) / cell_size[i]))
+        if idx >= n_cells[i]:
+            idx = n_cells[i] - 1
+        elif idx < 0:
+            idx = 0
+        morse_idx += idx * stride
+        stride *= n_cells[i]
+    return morse_idx
+
+@njit
+def body_cell_in_box( pos : np.ndarray, grid_min : np.ndarray, grid_max : np.ndarray, cell_size : np.ndarray,
+                      n_cells : np.ndarray ) -> int:
+    """
+    Indice (morse) de la cellule contenant la position pos, ou -1 si pos est hors de la boîte.
+    """
+    for i in range(3):
+        if pos[i] < grid_min[i] or pos[i] > grid_max[i]:
+            return -1
+    return body_cell(pos, grid_min, cell_size, n_cells)
+
+@njit(parallel=True)
+def find_body_cells( positions : np.ndarray, grid_min : np.ndarray, grid_max : np.ndarray, cell_size : np.ndarray,
+                     n_cells : np.ndarray, body_cells : np.ndarray, new_cells : np.ndarray ):
+    """
+    Range dans new_cells la cellule de chaque corps (-1 hors de la boîte).
+
+    :return: Nombre de corps dont la cellule n'est plus celle de body_cells (cellules à la mise à jour
+             précédente) et nombre de corps hors de la boîte
+    """
+    n_moved = 0
+    n_outside = 0
+    for ibody in prange(positions.shape[0]):
+        new_cells[ibody] = body_cell_in_box(positions[ibody], grid_min, grid_max, cell_size, n_cells)
+        if new_cells[ibody] != body_cells[ibody]:
+            n_moved += 1
+        if new_cells[ibody] < 0:
+            n_outside += 1
+    return n_moved, n_outside
+
+@njit(parallel=True)
+def move_stars_in_grid( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                        body_cells : np.ndarray, new_cells : np.ndarray,
+                        new_start_indices : np.ndarray, new_body_indices : np.ndarray,
+                        cell_slots : np.ndarray ) -> bool:
+    """
+    Met à jour la grille morse pour les seuls corps qui ont changé de cellule (body_cells -> new_cells) :
+    la nouvelle grille est écrite dans new_start_indices et new_body_indices. Dans chaque cellule, les corps
+    restés en place et les corps arrivés sont fusionnés par numéros croissants, soit exactement l'ordre
+    d'une reconstruction complète par build_cell_lists. Les corps de cellule négative (hors de la boîte) ne
+    sont dans aucune cellule.
+
+    :param cell_slots: Numéro de chaque cellule dans les listes d'interaction (-1 : cellule absente des listes)
+    :return: Vrai si un corps est arrivé dans une cellule absente des listes d'interaction (à refaire)
+    """
+    n_total = cell_start_indices.shape[0] - 1
+    movers = np.flatnonzero(new_cells != body_cells)
+    arrivals_count = np.zeros(n_total, dtype=np.int64)
+    departures_count = np.zeros(n_total, dtype=np.int64)
+    for ibody in movers:
+        if new_cells[ibody] >= 0:
+            arrivals_count[new_cells[ibody]] += 1
+        if body_cells[ibody] >= 0:
+            departures_count[body_cells[ibody]] += 1
+    # Nouveaux débuts des cellules et début des arrivées de chaque cellule
+    arrivals_start = np.empty(n_total + 1, dtype=np.int64)
+    arrivals_start[0] = 0
+    new_start_indices[0] = 0
+    unlisted_arrival = False
+    for i in range(n_total):
+        count = cell_start_indices[i+1] - cell_start_indices[i] + arrivals_count[i] - departures_count[i]
+        new_start_indices[i+1] = new_start_indices[i] + count
+        arrivals_start[i+1] = arrivals_start[i] + arrivals_count[i]
+        if arrivals_count[i] > 0 and cell_slots[i] < 0:
+            unlisted_arrival = True
+    # Corps arrivés, regroupés par cellule et par numéros croissants dans chaque cellule
+    arrivals = np.empty(arrivals_start[n_total], dtype=np.int64)
+    arrivals_fill = arrivals_start[:-1].copy()
+    for ibody in movers:
+        if new_cells[ibody] >= 0:
+            arrivals[arrivals_fill[new_cells[ibody]]] = ibody
+            arrivals_fill[new_cells[ibody]] += 1
+    # Chaque cellule écrit sa propre tranche
+    for i in prange(n_total):
+        j = cell_start_indices[i]
+        k = arrivals_start[i]
+        for index in range(new_start_indices[i], new_start_indices[i+1]):
+            # Prochain corps resté dans la cellule (les partants sont sautés)
+            while j < cell_start_indices[i+1] and new_cells[body_indices[j]] != i:
+                j += 1
+            if k < arrivals_start[i+1] and (j == cell_start_indices[i+1] or arrivals[k] < body_indices[j]):
+                new_body_indices[index] = arrivals[k]
+                k += 1
+            else:
+                new_body_indices[index] = body_indices[j]
+                j += 1
+    return unlisted_arrival
+
+@njit(parallel=True)
+def compute_cell_quadrupoles( cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                              masses : np.ndarray, positions : np.ndarray,
+                              cell_com_positions : np.ndarray, cell_quadrupoles : np.ndarray ):
+    """
+    Calcule le moment quadripolaire (sans trace) de chaque cellule par rapport à son centre de masse :
+    Q = somme_i m_i (3 r_i r_i^T - |r_i|^2 I), stocké sous la forme (xx, xy, xz, yy, yz, zz).
+    """
+    for i in prange(cell_quadrupoles.shape[0]):
+        q = np.zeros(6)
+        for j in range(cell_start_indices[i], cell_start_indices[i+1]):
+            ibody = body_indices[j]
+            m = masses[ibody]
+            rx = positions[ibody, 0] - cell_com_positions[i, 0]
+            ry = positions[ibody, 1] - cell_com_positions[i, 1]
+            rz = positions[ibody, 2] - cell_com_positions[i, 2]
+            r2 = rx*rx + ry*ry + rz*rz
+            q[0] += m * (3.*rx*rx - r2)
+            q[1] += m * 3.*rx*ry
+            q[2] += m * 3.*rx*rz
+            q[3] += m * (3.*ry*ry - r2)
+            q[4] += m * 3.*ry*rz
+            q[5] += m * (3.*rz*rz - r2)
+        cell_quadrupoles[i] = q
+
+@njit
+def quadrupole_acceleration( dx : float, dy : float, dz : float, distance : float, q : np.ndarray ):
+    """
+    Correction quadripolaire de l'accélération créée par une cellule de moment q (xx, xy, xz, yy, yz, zz),
+    (dx, dy, dz) étant le vecteur allant de la position cible au centre de masse de la cellule.
+    Avec d = -(dx, dy, dz) et r = |d| : a = G (Q.d / r^5 - 5/2 (d.Q.d) d / r^7)
+    """
+    qx = q[0]*dx + q[1]*dy + q[2]*dz
+    qy = q[1]*dx + q[3]*dy + q[4]*dz
+    qz = q[2]*dx + q[4]*dy + q[5]*dz
+    inv_dist5 = G / distance**5
+    coef = 2.5 * (dx*qx + dy*qy + dz*qz) * inv_dist5 / (distance*distance)
+    return coef*dx - qx*inv_dist5, coef*dy - qy*inv_dist5, coef*dz - qz*inv_dist5
+
+@njit(parallel=True)
+def build_interaction_lists( cell_start_indices : np.ndarray, n_cells : np.ndarray ):
+    """
+    Construit pour l'état courant de la grille la liste des cellules occupées et, pour chacune d'elles,
+    la liste de ses cellules proches (distance de Chebyshev <= 2) et de ses cellules lointaines,
+    en ne gardant que des cellules occupées. Les listes sont stockées sous forme morse :
+    les cellules proches de la k-ième cellule occupée sont near_cells[near_start[k]:near_start[k+1]]
+    (même chose pour les cellules lointaines). Ces listes sont partagées par tous les corps d'une même cellule.
+    """
+    n_total = n_cells[0]*n_cells[1]*n_cells[2]
+    # Numérotation des cellules occupées
+    cell_slots = np.full(n_total, -1, dtype=np.int64)
+    n_occupied = 0
+    for i in range(n_total):
+        if cell_start_indices[i+1] > cell_start_indices[i]:
+            cell_slots[i] = n_occupied
+            n_occupied += 1
+    occupied_cells = np.empty(n_occupied, dtype=np.int64)
+    for i in range(n_total):
+        if cell_slots[i] >= 0:
+            occupied_cells[cell_slots[i]] = i
+    # Compte le nombre de cellules proches de chaque cellule occupée
+    near_counts = np.zeros(n_occupied, dtype=np.int64)
+    for k in prange(n_occupied):
+        ck = occupied_cells[k]
+        ix = ck % n_cells[0]
+        iy = (ck // n_cells[0]) % n_cells[1]
+        iz = ck // (n_cells[0]*n_cells[1])
+        for l in range(n_occupied):
+            cl = occupied_cells[l]
+            if (abs(cl % n_cells[0] - ix) <= 2 and abs((cl // n_cells[0]) % n_cells[1] - iy) <= 2 and
+                abs(cl // (n_cells[0]*n_cells[1]) - iz) <= 2):
+                near_counts[k] += 1
+    near_start = np.empty(n_occupied+1, dtype=np.int64)
+    far_start  = np.empty(n_occupied+1, dtype=np.int64)
+    near_start[0] = 0
+    far_start[0]  = 0
+    for k in range(n_occupied):
+        near_start[k+1] = near_start[k] + near_counts[k]
+        far_start[k+1]  = far_start[k] + n_occupied - near_counts[k]
+    # Remplit les listes (chaque cellule occupée écrit dans sa propre tranche)
+    near_cells = np.empty(near_start[n_occupied], dtype=np.int64)
+    far_cells  = np.empty(far_start[n_occupied], dtype=np.int64)
+    for k in prange(n_occupied):
+        ck = occupied_cells[k]
+        ix = ck % n_cells[0]
+        iy = (ck // n_cells[0]) % n_cells[1]
+        iz = ck // (n_cells[0]*n_cells[1])
+        inear = near_start[k]
+        ifar  = far_start[k]
+        for l in range(n_occupied):
+            cl = occupied_cells[l]
+            if (abs(cl % n_cells[0] - ix) <= 2 and abs((cl // n_cells[0]) % n_cells[1] - iy) <= 2 and
+                abs(cl // (n_cells[0]*n_cells[1]) - iz) <= 2):
+                near_cells[inear] = cl
+                inear += 1
+            else:
+                far_cells[ifar] = cl
+                ifar += 1
+    return occupied_cells, cell_slots, near_start, near_cells, far_start, far_cells
+
+def near_far_interactions( cell_start_indices : np.ndarray, occupied_cells : np.ndarray,
+                           near_start : np.ndarray, near_cells : np.ndarray,
+                           far_start : np.ndarray ) -> tuple[int, int]:
+    """
+    Nombres d'interactions d'un calcul complet des accélérations (sommation corps par corps du champ lointain) :
+    paires de corps du champ proche et couples (corps, cellule lointaine).
+    """
+    counts = np.diff(cell_start_indices)
+    bodies_per_cell = counts[occupied_cells]
+    # Chaque liste de cellules proches contient au moins la cellule elle-même (jamais vide)
+    near_bodies = np.add.reduceat(counts[near_cells], near_start[:-1])
+    return int(np.sum(bodies_per_cell * (near_bodies - 1))), int(np.sum(bodies_per_cell * np.diff(far_start)))
+
+def count_interactions( cell_start_indices : np.ndarray, occupied_cells : np.ndarray,
+                        near_start : np.ndarray, near_cells : np.ndarray, far_start : np.ndarray,
+                        far_split : np.ndarray = None ) -> int:
+    """
+    Nombre d'interactions calculées par un calcul complet des accélérations : paires de corps du champ proche
+    et couples (corps, cellule lointaine). Avec les développements cellule à cellule
+    (far_split), les cellules bien séparées comptent pour une interaction cellule-cellule.
+    """
+    near, far = near_far_interactions(cell_start_indices, occupied_cells, near_start, near_cells, far_start)
+    if far_split is None:
+        return near + far
+    counts = np.diff(cell_start_indices)
+    bodies_per_cell = counts[occupied_cells]
+    return int(near + np.sum(bodies_per_cell * (far_split - far_start[:-1])) + np.sum(far_start[1:] - far_split))
+
+@njit
+def near_field_acceleration( ibody : int, positions : np.ndarray, masses : np.ndarray,
+                             cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                             near_start : np.ndarray, near_cells : np.ndarray, slot : int,
+                             accumulator, compensated : bool ):
+    """
+    Accélération exercée sur le corps ibody par les corps contenus dans les cellules proches
+    de la cellule occupée numéro slot, sommée dans le type accumulator (voir precision.py).
+
+    :return: Somme (ax, ay, az) et sa compensation (cx, cy, cz), nulle si not compensated
+    """
+    g = accumulator(G)
+    ax = ay = az = accumulator(0.)
+    cx = cy = cz = accumulator(0.)
+    for k in range(near_start[slot], near_start[slot+1]):
+        cell = near_cells[k]
+        for j in range(cell_start_indices[cell], cell_start_indices[cell+1]):
+            jbody = body_indices[j]
+            if jbody != ibody:
+                dx = positions[jbody, 0] - positions[ibody, 0]
+                dy = positions[jbody, 1] - positions[ibody, 1]
+                dz = positions[jbody, 2] - positions[ibody, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    inv_dist3 = g * masses[jbody] / (distance ** 3)
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                        dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+    return ax, ay, az, cx, cy, cz
+
+@njit(parallel=True)
+def direct_acceleration( positions : np.ndarray, masses : np.ndarray, targets : np.ndarray, sources : np.ndarray,
+                         accumulator, compensated : bool ):
+    """
+    Accélération exercée sur chaque corps de targets par les corps de sources, par sommation directe
+    (sert aux corps hors de la boîte de la grille).
+    """
+    a = np.zeros((targets.shape[0], 3), dtype=positions.dtype)
+    g = accumulator(G)
+    for itarget in prange(targets.shape[0]):
+        ibody = targets[itarget]
+        ax = ay = az = accumulator(0.)
+        cx = cy = cz = accumulator(0.)
+        for jbody in sources:
+            if jbody != ibody:
+                dx = positions[jbody, 0] - positions[ibody, 0]
+                dy = positions[jbody, 1] - positions[ibody, 1]
+                dz = positions[jbody, 2] - positions[ibody, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    inv_dist3 = g * masses[jbody] / (distance ** 3)
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                        dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+        a[itarget, 0] = ax
+        a[itarget, 1] = ay
+        a[itarget, 2] = az
+    return a
+
+@njit
+def body_cell_slot( pos : np.ndarray, grid_min : np.ndarray, cell_size : np.ndarray,
+                    n_cells : np.ndarray, cell_slots : np.ndarray ):
+    """
+    Numéro (parmi les cellules occupées) de la cellule contenant la position pos.
+    """
+    cell_idx = np.floor((pos - grid_min) / cell_size).astype(np.int64)
+    for i in range(3):
+        if cell_idx[i] >= n_cells[i]:
+            cell_idx[i] = n_cells[i] - 1
+        elif cell_idx[i] < 0:
+            cell_idx[i] = 0
+    morse_idx = cell_idx[0] + cell_idx[1]*n_cells[0] + cell_idx[2]*n_cells[0]*n_cells[1]
+    return cell_slots[morse_idx]
+
 @njit(parallel=True)
 def compute_acceleration( positions : np.ndarray, masses : np.ndarray,
                           cell_start_indices : np.ndarray, body_indices : np.ndarray,
                           cell_masses : np.ndarray, cell_com_positions : np.ndarray,
                           grid_min : np.ndarray, grid_max : np.ndarray,
-                          cell_size : np.ndarray, n_cells : np.ndarray):
+                          cell_size : np.ndarray, n_cells : np.ndarray,
+                          cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                          far_start : np.ndarray, far_cells : np.ndarray,
+                          cell_quadrupoles : np.ndarray, use_quadrupole : bool, targets : np.ndarray,
+                          accumulator, compensated : bool):
+    # Seuls les corps de targets sont calculés (tous les corps : targets = np.arange(n)). Les sommes sont dans le
+    # type accumulator, compensées si compensated (voir precision.py)
+    a = np.zeros((targets.shape[0], 3), dtype=positions.dtype)
+    g = accumulator(G)
+    for itarget in prange(targets.shape[0]):
+        ibody = targets[itarget]
+        pos = positions[ibody]
+        slot = body_cell_slot(pos, grid_min, cell_size, n_cells, cell_slots)
+        # Contribution des corps contenus dans les cellules proches
+        ax, ay, az, cx, cy, cz = near_field_acceleration(ibody, positions, masses, cell_start_indices, body_indices,
+                                                         near_start, near_cells, slot, accumulator, compensated)
+        # Contribution des cellules lointaines (centre de masse et masse totale)
+        for k in range(far_start[slot], far_start[slot+1]):
+            cell = far_cells[k]
+            dx = cell_com_positions[cell, 0] - pos[0]
+            dy = cell_com_positions[cell, 1] - pos[1]
+            dz = cell_com_positions[cell, 2] - pos[2]
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if distance > 1.E-10:
+                inv_dist3 = g * cell_masses[cell] / (distance ** 3)
+                ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                    dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+                if use_quadrupole:
+                    qx, qy, qz = quadrupole_acceleration(dx, dy, dz, distance, cell_quadrupoles[cell])
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, accumulator(qx), accumulator(qy),
+                                                        accumulator(qz), compensated)
+        a[itarget, 0] = ax
+        a[itarget, 1] = ay
+        a[itarget, 2] = az
+    return a
+
+@njit(parallel=True)
+def grid_potential_energy( positions : np.ndarray, masses : np.ndarray,
+                           cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                           cell_masses : np.ndarray, cell_com_positions : np.ndarray, body_cells : np.ndarray,
+                           cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                           far_start : np.ndarray, far_cells : np.ndarray ) -> float:
+    """
+    Énergie potentielle approchée des corps de la grille entre eux, -G/2.Σ_i m_i.φ_i, le potentiel φ_i étant
+    calculé comme l'accélération dans compute_acceleration : corps des cellules proches un par un, cellules
+    lointaines par leur masse et leur centre de masse. Coût d'un calcul des accélérations au lieu de O(N²).
+    Les corps hors de la boîte (body_cells < 0) sont ignorés (voir direct_potential_energy). Sommes en float64.
+    """
     n_bodies = positions.shape[0]
-    a = np.zeros_like(positions)
+    energy = 0.
     for ibody in prange(n_bodies):
+        if body_cells[ibody] < 0:
+            continue
+        slot = cell_slots[body_cells[ibody]]
+        x = np.float64(positions[ibody, 0])
+        y = np.float64(positions[ibody, 1])
+        z = np.float64(positions[ibody, 2])
+        phi = 0.
+        for k in range(near_start[slot], near_start[slot+1]):
+            cell = near_cells[k]
+            for j in range(cell_start_indices[cell], cell_start_indices[cell+1]):
+                jbody = body_indices[j]
+                if jbody != ibody:
+                    dx = positions[jbody, 0] - x
+                    dy = positions[jbody, 1] - y
+                    dz = positions[jbody, 2] - z
+                    distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                    if distance > 1.E-10:
+                        phi += masses[jbody] / distance
+        for k in range(far_start[slot], far_start[slot+1]):
+            cell = far_cells[k]
+            dx = cell_com_positions[cell, 0] - x
+            dy = cell_com_positions[cell, 1] - y
+            dz = cell_com_positions[cell, 2] - z
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if distance > 1.E-10:
+                phi += cell_masses[cell] / distance
+        energy += masses[ibody] * phi
+    return -0.5 * G * energy
+
+@njit(parallel=True)
+def direct_potential_energy( positions : np.ndarray, masses : np.ndarray,
+                             targets : np.ndarray, sources : np.ndarray ) -> float:
+    """
+    Somme directe -G.Σ_{i de targets} Σ_{j de sources, j != i} m_i.m_j / r_ij (en float64) : une paire dont les deux
+    corps sont à la fois dans targets et dans sources est comptée deux fois.
+    """
+    energy = 0.
+    for itarget in prange(targets.shape[0]):
+        ibody = targets[itarget]
+        phi = 0.
+        for jbody in sources:
+            if jbody != ibody:
+                dx = np.float64(positions[jbody, 0]) - positions[ibody, 0]
+                dy = np.float64(positions[jbody, 1]) - positions[ibody, 1]
+                dz = np.float64(positions[jbody, 2]) - positions[ibody, 2]
+                distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+                if distance > 1.E-10:
+                    phi += masses[jbody] / distance
+        energy += masses[ibody] * phi
+    return -G * energy
+
+@njit(parallel=True)
+def compute_cell_radii( occupied_cells : np.ndarray, cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                        positions : np.ndarray, cell_com_positions : np.ndarray ):
+    """
+    Rayon de chaque cellule occupée : plus grande distance entre un corps de la cellule et son centre de masse.
+    """
+    n_occupied = occupied_cells.shape[0]
+    radii = np.zeros(n_occupied)
+    for k in prange(n_occupied):
+        cell = occupied_cells[k]
+        for j in range(cell_start_indices[cell], cell_start_indices[cell+1]):
+            ibody = body_indices[j]
+            dx = positions[ibody, 0] - cell_com_positions[cell, 0]
+            dy = positions[ibody, 1] - cell_com_positions[cell, 1]
+            dz = positions[ibody, 2] - cell_com_positions[cell, 2]
+            radii[k] = max(radii[k], np.sqrt(dx*dx + dy*dy + dz*dz))
+    return radii
+
+@njit(parallel=True)
+def compute_far_field_expansions( occupied_cells : np.ndarray, cell_slots : np.ndarray,
+                                  far_start : np.ndarray, far_cells : np.ndarray,
+                                  cell_masses : np.ndarray, cell_com_positions : np.ndarray,
+                                  cell_radii : np.ndarray, order : int, theta : float,
+                                  cell_quadrupoles : np.ndarray, use_quadrupole : bool ):
+    """
+    Calcule une seule fois par cellule occupée le champ lointain et son développement de Taylor
+    au centre de masse x_c de la cellule :
+
+        a(x_c + h) ~ a0 + J.h + 1/2 H:(h,h)
+
+    avec J la jacobienne de l'accélération (ordre >= 1) et H sa dérivée seconde (ordre 2).
+    J et H étant symétriques, on ne stocke que leurs composantes indépendantes :
+    far_jac[k] = (xx, xy, xz, yy, yz, zz) et far_hess[k] = (xxx, xxy, xxz, xyy, xyz, xzz, yyy, yyz, yzz, zzz).
+
+    Seules les paires de cellules bien séparées, (r_cible + r_source) < theta * distance, sont développées.
+    Les autres cellules lointaines sont rangées en tête de la liste de la cellule (far_cells est
+    réordonné sur place) et restent traitées corps par corps : far_cells[far_start[k]:far_split[k]].
+    Le coût du champ lointain passe de O(N x cellules) à O(cellules^2).
+    """
+    n_occupied = occupied_cells.shape[0]
+    far_acc  = np.zeros((n_occupied, 3))
+    far_jac  = np.zeros((n_occupied, 6))
+    far_hess = np.zeros((n_occupied, 10))
+    far_split = np.empty(n_occupied, dtype=np.int64)
+    for k in prange(n_occupied):
+        cx = cell_com_positions[occupied_cells[k], 0]
+        cy = cell_com_positions[occupied_cells[k], 1]
+        cz = cell_com_positions[occupied_cells[k], 2]
+        ax = ay = az = 0.
+        jxx = jxy = jxz = jyy = jyz = jzz = 0.
+        hxxx = hxxy = hxxz = hxyy = hxyz = hxzz = hyyy = hyyz = hyzz = hzzz = 0.
+        n_direct = far_start[k]
+        for f in range(far_start[k], far_start[k+1]):
+            cell = far_cells[f]
+            dx = cell_com_positions[cell, 0] - cx
+            dy = cell_com_positions[cell, 1] - cy
+            dz = cell_com_positions[cell, 2] - cz
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if cell_radii[k] + cell_radii[cell_slots[cell]] >= theta * distance:
+                # Paire mal séparée : la cellule reste traitée corps par corps
+                far_cells[f] = far_cells[n_direct]
+                far_cells[n_direct] = cell
+                n_direct += 1
+                continue
+            inv_dist3 = G * cell_masses[cell] / distance**3
+            ax += dx * inv_dist3
+            ay += dy * inv_dist3
+            az += dz * inv_dist3
+            if use_quadrupole:
+                # Le moment quadripolaire de la source n'est pris en compte qu'à l'ordre 0 du développement
+                qx, qy, qz = quadrupole_acceleration(dx, dy, dz, distance, cell_quadrupoles[cell])
+                ax += qx
+                ay += qy
+                az += qz
+            if order >= 1:
+                # J_ij = G m (3 d_i d_j / r^5 - delta_ij / r^3)
+                inv_dist5 = inv_dist3 / (distance*distance)
+                jxx += 3.*dx*dx*inv_dist5 - inv_dist3
+                jxy += 3.*dx*dy*inv_dist5
+                jxz += 3.*dx*dz*inv_dist5
+                jyy += 3.*dy*dy*inv_dist5 - inv_dist3
+                jyz += 3.*dy*dz*inv_dist5
+                jzz += 3.*dz*dz*inv_dist5 - inv_dist3
+            if order >= 2:
+                # H_ijl = G m (15 d_i d_j d_l / r^7 - 3 (delta_ij d_l + delta_il d_j + delta_jl d_i) / r^5)
+                c7 = 15. * inv_dist5 / (distance*distance)
+                c5 = 3. * inv_dist5
+                hxxx += c7*dx*dx*dx - 3.*c5*dx
+                hxxy += c7*dx*dx*dy - c5*dy
+                hxxz += c7*dx*dx*dz - c5*dz
+                hxyy += c7*dx*dy*dy - c5*dx
+                hxyz += c7*dx*dy*dz
+                hxzz += c7*dx*dz*dz - c5*dx
+                hyyy += c7*dy*dy*dy - 3.*c5*dy
+                hyyz += c7*dy*dy*dz - c5*dz
+                hyzz += c7*dy*dz*dz - c5*dy
+                hzzz += c7*dz*dz*dz - 3.*c5*dz
+        far_split[k] = n_direct
+        far_acc[k, 0] = ax
+        far_acc[k, 1] = ay
+        far_acc[k, 2] = az
+        far_jac[k, 0] = jxx
+        far_jac[k, 1] = jxy
+        far_jac[k, 2] = jxz
+        far_jac[k, 3] = jyy
+        far_jac[k, 4] = jyz
+        far_jac[k, 5] = jzz
+        far_hess[k, 0] = hxxx
+        far_hess[k, 1] = hxxy
+        far_hess[k, 2] = hxxz
+        far_hess[k, 3] = hxyy
+        far_hess[k, 4] = hxyz
+        far_hess[k, 5] = hxzz
+        far_hess[k, 6] = hyyy
+        far_hess[k, 7] = hyyz
+        far_hess[k, 8] = hyzz
+        far_hess[k, 9] = hzzz
+    return far_acc, far_jac, far_hess, far_split
+
+@njit(parallel=True)
+def compute_acceleration_cell_to_cell( positions : np.ndarray, masses : np.ndarray,
+                                       cell_start_indices : np.ndarray, body_indices : np.ndarray,
+                                       cell_masses : np.ndarray, cell_com_positions : np.ndarray,
+                                       occupied_cells : np.ndarray,
+                                       grid_min : np.ndarray, cell_size : np.ndarray, n_cells : np.ndarray,
+                                       cell_slots : np.ndarray, near_start : np.ndarray, near_cells : np.ndarray,
+                                       far_start : np.ndarray, far_cells : np.ndarray, far_split : np.ndarray,
+                                       far_acc : np.ndarray, far_jac : np.ndarray, far_hess : np.ndarray,
+                                       order : int, cell_quadrupoles : np.ndarray, use_quadrupole : bool,
+                                       targets : np.ndarray, accumulator, compensated : bool ):
+    """
+    Variante de compute_acceleration où le champ lointain des paires de cellules bien séparées est
+    interpolé à partir des développements calculés par compute_far_field_expansions (en float64).
+    """
+    # Seuls les corps de targets sont calculés (tous les corps : targets = np.arange(n))
+    a = np.zeros((targets.shape[0], 3), dtype=positions.dtype)
+    g = accumulator(G)
+    for itarget in prange(targets.shape[0]):
+        ibody = targets[itarget]
         pos = positions[ibody]
-        cell_idx = np.floor((pos - grid_min) / cell_size).astype(np.int64)
-        for i in range(3):
-            if cell_idx[i] >= n_cells[i]:
-                cell_idx[i] = n_cells[i] - 1
-            elif cell_idx[i] < 0:
-                cell_idx[i] = 0
-        # Parcourt toutes les cellules pour calculer la contribution gravitationnelle
-        for ix in range(n_cells[0]):
-            for iy in range(n_cells[1]):
-                for iz in range(n_cells[2]):
-                    morse_idx = ix + iy*n_cells[0] + iz*n_cells[0]*n_cells[1]
-                    if (abs(ix-cell_idx[0]) > 2) or (abs(iy-cell_idx[1]) > 2) or (abs(iz-cell_idx[2]) > 2):
-                        cell_com = cell_com_positions[morse_idx]    
-                        cell_mass = cell_masses[morse_idx]
-                        if cell_mass > 0.0:
-                            direction = cell_com - pos
-                            distance = np.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
-                            if distance > 1.E-10:
-                                inv_dist3 = 1.0 / (distance ** 3)
-                                a[ibody,:] += G * direction[:] * inv_dist3 * cell_mass
-                    else:
-                        # Parcourt les corps dans cette cellule
-                        start_idx = cell_start_indices[morse_idx]
-                        end_idx = cell_start_indices[morse_idx+1]
-                        for j in range(start_idx, end_idx):
-                            jbody = body_indices[j]
-                            if jbody != ibody:
-                                direction = positions[jbody] - pos
-                                distance = np.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
-                                if distance > 1.E-10:
-                                    inv_dist3 = 1.0 / (distance ** 3)
-                                    a[ibody,:] += G * direction[:] * inv_dist3 * masses[jbody]
+        slot = body_cell_slot(pos, grid_min, cell_size, n_cells, cell_slots)
+        ax, ay, az, cx, cy, cz = near_field_acceleration(ibody, positions, masses, cell_start_indices, body_indices,
+                                                         near_start, near_cells, slot, accumulator, compensated)
+        # Cellules lointaines mal séparées : centre de masse et masse totale, corps par corps
+        for k in range(far_start[slot], far_split[slot]):
+            cell = far_cells[k]
+            dx = cell_com_positions[cell, 0] - pos[0]
+            dy = cell_com_positions[cell, 1] - pos[1]
+            dz = cell_com_positions[cell, 2] - pos[2]
+            distance = np.sqrt(dx*dx + dy*dy + dz*dz)
+            if distance > 1.E-10:
+                inv_dist3 = g * cell_masses[cell] / (distance ** 3)
+                ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz,
+                                                    dx * inv_dist3, dy * inv_dist3, dz * inv_dist3, compensated)
+                if use_quadrupole:
+                    qx, qy, qz = quadrupole_acceleration(dx, dy, dz, distance, cell_quadrupoles[cell])
+                    ax, ay, az, cx, cy, cz = accumulate(ax, ay, az, cx, cy, cz, accumulator(qx), accumulator(qy),
+                                                        accumulator(qz), compensated)
+        # Écart au centre de masse de la cellule (point de développement)
+        center = occupied_cells[slot]
+        hx = pos[0] - cell_com_positions[center, 0]
+        hy = pos[1] - cell_com_positions[center, 1]
+        hz = pos[2] - cell_com_positions[center, 2]
+        fx = far_acc[slot, 0]
+        fy = far_acc[slot, 1]
+        fz = far_acc[slot, 2]
+        if order >= 1:
+            J = far_jac[slot]
+            fx += J[0]*hx + J[1]*hy + J[2]*hz
+            fy += J[1]*hx + J[3]*hy + J[4]*hz
+            fz += J[2]*hx + J[4]*hy + J[5]*hz
+        if order >= 2:
+            H = far_hess[slot]
+            fx += 0.5*(H[0]*hx*hx + H[3]*hy*hy + H[5]*hz*hz) + H[1]*hx*hy + H[2]*hx*hz + H[4]*hy*hz
+            fy += 0.5*(H[1]*hx*hx + H[6]*hy*hy + H[8]*hz*hz) + H[3]*hx*hy + H[4]*hx*hz + H[7]*hy*hz
+            fz += 0.5*(H[2]*hx*hx + H[7]*hy*hy + H[9]*hz*hz) + H[4]*hx*hy + H[5]*hx*hz + H[8]*hy*hz
+        a[itarget, 0] = ax + fx
+        a[itarget, 1] = ay + fy
+        a[itarget, 2] = az + fz
     return a
 
 # On crée une grille cartésienne régulière pour diviser l'espace englobant la galaxie en cellules
 class SpatialGrid:
     """_summary_
     """
-    def __init__(self, positions : np.ndarray, nb_cells_per_dim : tuple[int, int, int]):
-        self.min_bounds = np.min(positions, axis=0) - 1.E-6
-        self.max_bounds = np.max(positions, axis=0) + 1.E-6
+    def __init__(self, positions : np.ndarray, nb_cells_per_dim : tuple[int, int, int], use_quadrupole : bool = False,
+                 incremental : bool = True, max_moved_fraction : float = 0.25, rebuild_period : int = 50,
+                 max_outliers : int = None):
+        """
+        :param incremental: Met à jour la grille en ne déplaçant que les corps qui ont changé de cellule depuis
+                            la mise à jour précédente (move_stars_in_grid). Les listes d'interaction ne sont
+                            refaites que si un corps arrive dans une cellule qui n'y figure pas : une cellule
+                            qui se vide y reste, avec une masse nulle
+        :param max_moved_fraction: Au-delà de cette proportion de corps ayant changé de cellule, la grille est
+                                   reconstruite complètement (update_stars_in_grid)
+        :param rebuild_period: Nombre de mises à jour entre deux reconstructions complètes, qui retirent aussi
+                               des listes d'interaction les cellules vidées entre-temps (0 : jamais)
+        :param max_outliers: La boîte de la grille suit le cœur des positions (core_box.CoreBox) en laissant dehors
+                             au plus max_outliers corps, qui ne sont dans aucune cellule et sont traités par
+                             sommation directe (None : core_box.default_max_outliers, 0 : la boîte contient
+                             tous les corps)
+        """
+        self.max_outliers = max_outliers
+        self.core_box = core_box.CoreBox(positions, max_outliers)
+        self.min_bounds = self.core_box.min_bounds
+        self.max_bounds = self.core_box.max_bounds
         self.n_cells = np.array(nb_cells_per_dim)
         self.cell_size = (self.max_bounds - self.min_bounds) / self.n_cells
         # On va stocker les indices des corps dans chaque cellule adéquate
@@ -158,99 +780,450 @@ class SpatialGrid:
         # et on gère deux tableaux : un pour le début des indices de chaque cellule, un autre pour les indices des corps
         self.cell_start_indices = np.full(np.prod(self.n_cells) + 1, -1, dtype=np.int64)
         self.body_indices = np.empty(shape=(positions.shape[0],), dtype=np.int64)
-        # Stockage du centre de masse de chaque cellule et de la masse totale contenue dans chaque cellule
-        self.cell_masses = np.zeros(shape=(np.prod(self.n_cells),), dtype=np.float32)
-        self.cell_com_positions = np.zeros(shape=(np.prod(self.n_cells), 3), dtype=np.float32)
+        # Stockage du centre de masse de chaque cellule et de la masse totale contenue dans chaque cellule (dans la
+        # précision des corps)
+        self.cell_masses = np.zeros(shape=(np.prod(self.n_cells),), dtype=positions.dtype)
+        self.cell_com_positions = np.zeros(shape=(np.prod(self.n_cells), 3), dtype=positions.dtype)
+        # Moments quadripolaires optionnels (xx, xy, xz, yy, yz, zz) de chaque cellule
+        self.use_quadrupole = use_quadrupole
+        self.cell_quadrupoles = np.zeros(shape=(np.prod(self.n_cells), 6), dtype=np.float64)
+        # Cellules des listes d'interaction (occupées, ou vidées depuis la dernière construction des listes)
+        self.occupied_cells = None
+        # Mise à jour incrémentale : cellule de chaque corps à la dernière mise à jour (None : inconnue) et
+        # tableaux de travail pour la grille suivante
+        self.incremental = incremental
+        self.max_moved_fraction = max_moved_fraction
+        self.rebuild_period = rebuild_period
+        self.body_cells = None
+        # Corps hors de la boîte (cellule -1) à la dernière mise à jour
+        self.outliers = np.empty(0, dtype=np.int64)
+        self.new_cells = np.empty(positions.shape[0], dtype=np.int64)
+        self.new_start_indices = np.empty_like(self.cell_start_indices)
+        self.new_body_indices = np.empty_like(self.body_indices)
+        # Statistiques : mises à jour, reconstructions complètes, corps ayant changé de cellule (sur les mises à
+        # jour où la cellule précédente des corps était connue)
+        self.n_updates = 0
+        self.n_full_updates = 0
+        self.n_checked = 0
+        self.n_moved = 0
         
-    def update_bounds(self, positions : np.ndarray):
-        self.min_bounds = np.min(positions, axis=0) - 1.E-6
-        self.max_bounds = np.max(positions, axis=0) + 1.E-6
+    def update_bounds(self, positions : np.ndarray, n_outside : int) -> bool:
+        """
+        Déplace la boîte de la grille si le cœur des positions l'exige (voir core_box.CoreBox).
+
+        :param n_outside: Nombre de corps hors de la boîte courante
+        :return: Vrai si la boîte a changé (toutes les cellules sont à refaire)
+        """
+        if not self.core_box.update(positions, n_outside):
+            return False
+        self.min_bounds = self.core_box.min_bounds
+        self.max_bounds = self.core_box.max_bounds
         self.cell_size = (self.max_bounds - self.min_bounds) / self.n_cells
+        return True
+
+    def set_cell_counts(self, positions : np.ndarray, nb_cells_per_dim):
+        """
+        Change le nombre de cellules par direction (la boîte est recalculée pour les positions courantes).
+        La grille est à reconstruire par update.
+        """
+        self.__init__(positions, nb_cells_per_dim, self.use_quadrupole, self.incremental, self.max_moved_fraction,
+                      self.rebuild_period, self.max_outliers)
+
+    def invalidate(self):
+        """
+        Oublie la cellule des corps (après une renumérotation des corps) : la prochaine mise à jour est complète.
+        """
+        self.body_cells = None
+
+    def fill_ratio(self) -> float:
+        """Proportion de cellules occupées à la dernière construction."""
+        return np.count_nonzero(np.diff(self.cell_start_indices)) / np.prod(self.n_cells)
+
+    def moved_fraction(self) -> float:
+        """Proportion moyenne des corps qui changent de cellule d'une mise à jour à la suivante."""
+        return self.n_moved / self.n_checked if self.n_checked > 0 else 0.
         
     def update(self, positions : np.ndarray, masses : np.ndarray):
-        #self.update_bounds(positions)
-        update_stars_in_grid( self.cell_start_indices, self.body_indices,                             
-                              self.cell_masses, self.cell_com_positions,
-                              masses,
-                              positions, self.min_bounds, self.max_bounds,
-                              self.cell_size, self.n_cells)
+        n_bodies = positions.shape[0]
+        rebuild = self.rebuild_period > 0 and self.n_updates % self.rebuild_period == 0
+        self.n_updates += 1
+        if self.body_cells is not None and self.body_cells.shape[0] != n_bodies:
+            self.body_cells = None
+        if self.new_cells.shape[0] != n_bodies:
+            self.body_indices = np.empty(n_bodies, dtype=np.int64)
+            self.new_body_indices = np.empty(n_bodies, dtype=np.int64)
+            self.new_cells = np.empty(n_bodies, dtype=np.int64)
+        # Cellule de chaque corps (-1 hors de la boîte) et corps qui ont changé de cellule
+        known = self.body_cells is not None
+        n_moved, n_outside = find_body_cells(positions, self.min_bounds, self.max_bounds, self.cell_size, self.n_cells,
+                                             self.body_cells if known else self.new_cells, self.new_cells)
+        if self.update_bounds(positions, n_outside):
+            known = False
+            n_moved, n_outside = find_body_cells(positions, self.min_bounds, self.max_bounds, self.cell_size,
+                                                 self.n_cells, self.new_cells, self.new_cells)
+        checked = self.incremental and not rebuild and known
+        if checked:
+            self.n_checked += n_bodies
+            self.n_moved += n_moved
+        if checked and n_moved <= self.max_moved_fraction * n_bodies:
+            lists_outdated = False
+            if n_moved > 0:
+                lists_outdated = move_stars_in_grid(self.cell_start_indices, self.body_indices,
+                                                    self.body_cells, self.new_cells,
+                                                    self.new_start_indices, self.new_body_indices, self.cell_slots)
+                self.cell_start_indices, self.new_start_indices = self.new_start_indices, self.cell_start_indices
+                self.body_indices, self.new_body_indices = self.new_body_indices, self.body_indices
+                self.body_cells, self.new_cells = self.new_cells, self.body_cells
+        else:
+            build_cell_lists(self.new_cells, self.cell_start_indices, self.body_indices)
+            # Les listes sont refaites si l'ensemble des cellules occupées n'est plus exactement celui des listes
+            lists_outdated = (self.occupied_cells is None or
+                              not np.array_equal(self.cell_slots >= 0, np.diff(self.cell_start_indices) > 0))
+            previous_cells = self.body_cells if self.body_cells is not None else np.empty_like(self.new_cells)
+            self.body_cells, self.new_cells = self.new_cells, previous_cells
+            self.n_full_updates += 1
+        compute_cell_moments( self.cell_start_indices, self.body_indices, self.cell_masses,
+                              self.cell_com_positions, masses, positions )
+        self.outliers = np.flatnonzero(self.body_cells < 0) if n_outside > 0 else np.empty(0, dtype=np.int64)
+        if self.use_quadrupole:
+            compute_cell_quadrupoles( self.cell_start_indices, self.body_indices, masses, positions,
+                                      self.cell_com_positions, self.cell_quadrupoles )
+        if not lists_outdated:
+            return
+        # Listes d'interaction (cellules proches/lointaines) partagées par les corps d'une même cellule
+        (self.occupied_cells, self.cell_slots, self.near_start, self.near_cells,
+         self.far_start, self.far_cells) = build_interaction_lists(self.cell_start_indices, self.n_cells)
 
 class NBodySystem:
-    def __init__(self, filename, ncells_per_dir : tuple[int, int, int] = (10,10,10)):
-        positions = []
-        velocities = []
-        masses    = []
-        
-        self.max_mass = 0.
-        self.box = np.array([[-1.E-6,-1.E-6,-1.E-6],[1.E-6,1.E-6,1.E-6]], dtype=np.float64) # Contient les coins min et max du système
-        with open(filename, "r") as fich:
-            line = fich.readline() # Récupère la masse, la position et la vitesse sous forme de chaîne
-            # Récupère les données numériques pour instancier un corps qu'on rajoute aux corps déjà présents :
-            while line:
-                data = line.split()
-                masses.append(float(data[0]))
-                positions.append([float(data[1]), float(data[2]), float(data[3])])
-                velocities.append([float(data[4]), float(data[5]), float(data[6])])
-                self.max_mass = max(self.max_mass, masses[-1])
-                
-                for i in range(3):
-                    self.box[0][i] = min(self.box[0][i], positions[-1][i]-1.E-6)
-                    self.box[1][i] = max(self.box[1][i], positions[-1][i]+1.E-6)
-                    
-                line = fich.readline()
+    def __init__(self, filename, ncells_per_dir : tuple[int, int, int] = (10,10,10), far_field_order : int = -1,
+                 far_field_theta : float = 0.25, use_quadrupole : bool = False, reorder_period : int = 0,
+                 integrator = "verlet", grid_retune_period : int = 0, incremental_grid : bool = True,
+                 max_outliers : int = None, precision = "mixed"):
+        """
+        :param filename: Fichier contenant les données des corps (texte ou binaire .nbs, cf. snapshot.py)
+        :param ncells_per_dir: Nombre de cellules de la grille dans chaque direction, ou "auto" pour le choisir
+                               d'après le nombre de corps, la forme de la boîte et le coût mesuré des
+                               interactions (voir tune_grid)
+        :param far_field_order: -1 pour sommer le champ lointain corps par corps (méthode d'origine),
+                                0, 1 ou 2 pour le calculer une fois par cellule (cellule à cellule) et
+                                l'interpoler aux corps par un développement de Taylor de cet ordre
+        :param far_field_theta: Critère de séparation du mode cellule à cellule : une cellule lointaine n'est
+                                développée que si (r_cible + r_source) < theta * distance. Plus theta est petit,
+                                plus le calcul est précis (theta = 0 redonne la sommation corps par corps).
+                                Erreur relative par rapport à la somme directe (90e centile / maximum) sur une
+                                galaxie de 50 000 corps, grille 50x50x1 : 1e-5 / 4e-5 corps par corps ; à
+                                l'ordre 2, 5e-3 / 0.11 pour theta = 0.5, 1e-5 / 9e-3 pour 0.25 (défaut),
+                                1e-5 / 3e-3 pour 0.2 (ordre 0 : 0.16 / 0.46 à theta = 0.5). Le gain de temps reste
+                                faible (interactions réduites de 13 % à theta = 0.25, de 36 % à 0.5)
+        :param use_quadrupole: Ajoute le moment quadripolaire des cellules au champ lointain, ce qui permet
+                               d'atteindre la même précision avec une grille plus grossière
+        :param reorder_period: Nombre de pas de temps entre deux renumérotations des corps selon l'ordre de
+                               Morton (0 : jamais). Les corps voisins dans l'espace deviennent voisins en mémoire
+        :param integrator: Schéma d'intégration en temps (nom accepté par integrators.make_integrator ou instance)
+        :param grid_retune_period: Avec ncells_per_dir = "auto", nombre de pas de temps entre deux nouveaux choix
+                                   de la grille (et de sa boîte) pour suivre l'étalement de la galaxie (0 : jamais)
+        :param incremental_grid: Ne déplace d'une mise à jour de la grille à la suivante que les corps qui ont
+                                 changé de cellule (voir SpatialGrid)
+        :param max_outliers: Nombre maximal de corps laissés hors de la boîte de la grille (voir core_box.CoreBox),
+                             traités par sommation directe. None (par défaut) : 0,1 % des corps
+                             (core_box.default_max_outliers) ; 0 : la boîte contient tous les corps et se déplace
+                             dès qu'un corps en sort
+        :param precision: Précision du stockage des corps et des sommes des forces : "mixed" (float32 et sommes en
+                          float64), "float32" (sommes compensées) ou "float64", voir precision.py
+        """
+        self.precision = make_precision(precision)
+        self.far_field_order = far_field_order
+        self.far_field_theta = far_field_theta
+        # Découpage des listes de cellules lointaines du dernier calcul cellule à cellule
+        self.far_split = None
+        masses, positions, velocities = snapshot.load_bodies(filename)
+        self.max_mass = float(np.max(masses))
+        self.box = snapshot.bounding_box(positions) # Contient les coins min et max du système
         
-        self.positions  = np.array(positions, dtype=np.float32)
-        self.velocities = np.array(velocities, dtype=np.float32)
-        self.masses     = np.array(masses, dtype=np.float32)
+        self.positions  = np.array(positions, dtype=self.precision.storage)
+        self.velocities = np.array(velocities, dtype=self.precision.storage)
+        self.masses     = np.array(masses, dtype=self.precision.storage)
         self.colors = [generate_star_color(m) for m in masses]
-        self.grid = SpatialGrid(self.positions, ncells_per_dir)
+        self.ids = np.arange(self.positions.shape[0])
+        # Accélération calculée pour les positions courantes (et la grille courante) au pas précédent
+        self.acceleration = None
+        self.integrator = integrators.make_integrator(integrator)
+        self.reorder_period = reorder_period
+        self.n_steps = 0
+        self.auto_grid = is_auto(ncells_per_dir)
+        self.grid_retune_period = grid_retune_period
+        # Choix de la grille automatique : nombre de cellules, rapport des coûts et remplissage utilisés
+        self.grid_tuning = None
+        if self.auto_grid:
+            extent = core_box.CoreBox(self.positions, max_outliers).extent()
+            ncells_per_dir = choose_cell_counts(self.positions.shape[0], extent)
+        self.grid = SpatialGrid(self.positions, ncells_per_dir, use_quadrupole, incremental_grid,
+                                max_outliers=max_outliers)
+        self.grid.update(self.positions, self.masses)
+        if self.auto_grid:
+            self.tune_grid()
+
+    def tune_grid(self, measure : bool = True):
+        """
+        Choisit le nombre de cellules par direction (choose_cell_counts) pour les positions courantes et
+        reconstruit la grille sur leur boîte englobante.
+
+        Avec measure, le rapport des coûts d'une interaction proche et d'une interaction lointaine est mesuré :
+        on chronomètre le calcul des accélérations d'un échantillon de corps sur deux grilles, l'une à grosses
+        cellules (surtout du champ proche), l'autre à petites cellules (surtout du champ lointain), et on
+        ajuste temps = a.proches + b.lointaines. Sinon, on garde le rapport de la dernière mesure.
+        """
+        n_bodies = self.positions.shape[0]
+        extent = core_box.CoreBox(self.positions, self.grid.max_outliers).extent()
+        ratio = 1. if self.grid_tuning is None else self.grid_tuning["near_far_cost_ratio"]
+        if measure:
+            rng = np.random.default_rng(0)
+            # Échantillon de corps de la grille courante
+            inside = np.flatnonzero(self.grid.body_cells >= 0)
+            sample = np.sort(rng.choice(inside, size=min(inside.shape[0], 4096), replace=False))
+            rows = []
+            times = []
+            for trial_ratio in (4., 0.25):
+                self.grid.set_cell_counts(self.positions, choose_cell_counts(n_bodies, extent, trial_ratio))
+                self.grid.update(self.positions, self.masses)
+                grid = self.grid
+                # set_cell_counts peut déplacer la boîte : seuls les corps de l'échantillon restés dans la boîte de
+                # la grille d'essai sont chronométrés et comptés (un corps dehors a la cellule -1)
+                targets = sample[grid.body_cells[sample] >= 0]
+                self.compute_acceleration(targets)
+                elapsed = np.inf
+                for _ in range(3):
+                    start = time.perf_counter()
+                    self.compute_acceleration(targets)
+                    elapsed = min(elapsed, time.perf_counter() - start)
+                # Interactions proches et lointaines des seuls corps de l'échantillon
+                counts = np.diff(grid.cell_start_indices)
+                slots = grid.cell_slots[grid.body_cells[targets]]
+                near_bodies = np.add.reduceat(counts[grid.near_cells], grid.near_start[:-1])
+                rows.append([np.sum(near_bodies[slots] - 1), np.sum(np.diff(grid.far_start)[slots])])
+                times.append(elapsed)
+            (near_cost, far_cost), *_ = np.linalg.lstsq(np.array(rows, dtype=np.float64), np.array(times), rcond=None)
+            if near_cost > 0. and far_cost > 0.:
+                ratio = float(np.clip(near_cost / far_cost, 0.1, 10.))
+        fill_ratio = self.grid.fill_ratio()
+        n_cells = choose_cell_counts(n_bodies, extent, ratio, fill_ratio)
+        self.grid.set_cell_counts(self.positions, n_cells)
+        self.grid.update(self.positions, self.masses)
+        self.grid_tuning = {"ncells_per_dir": tuple(int(n) for n in n_cells), "near_far_cost_ratio": ratio,
+                            "fill_ratio": float(fill_ratio),
+                            "retunes": 0 if self.grid_tuning is None else self.grid_tuning["retunes"] + 1}
+
+    def grid_report(self) -> str:
+        """Description de la grille utilisée (et de son choix automatique), pour les comptes rendus de temps."""
+        grid = self.grid
+        n_cells = "x".join(str(int(n)) for n in grid.n_cells)
+        if self.grid_tuning is not None:
+            n_cells += (f" (automatique : rapport de coût proche/lointain {self.grid_tuning['near_far_cost_ratio']:.2f}, "
+                        f"remplissage {self.grid_tuning['fill_ratio']:.2f}, {self.grid_tuning['retunes']} nouveau(x) choix)")
+        return (f"grille {n_cells}, {100. * grid.moved_fraction():.2f} % des corps changent de cellule par mise à jour, "
+                f"{grid.n_full_updates} reconstruction(s) complète(s) sur {grid.n_updates}, "
+                f"{grid.outliers.shape[0]} corps hors de la boîte ({grid.core_box.n_changes} déplacement(s) de la boîte)")
+
+    def reorder_bodies(self):
+        """
+        Renumérote les corps (positions, vitesses, masses, couleurs) selon leur code de Morton, pour que les corps
+        proches dans l'espace soient aussi proches en mémoire. self.ids garde l'identifiant d'origine de chaque corps.
+        """
+        perm = morton.morton_order(self.positions)
+        self.positions = self.positions[perm]
+        self.velocities = self.velocities[perm]
+        self.masses = self.masses[perm]
+        self.colors = [self.colors[i] for i in perm]
+        self.ids = self.ids[perm]
+        if self.acceleration is not None:
+            self.acceleration = self.acceleration[perm]
+        self.integrator.permute(perm)
+        self.grid.invalidate()
         self.grid.update(self.positions, self.masses)
+
+    def positions_by_id(self):
+        """Positions des corps dans l'ordre du fichier d'origine (ordre attendu par l'affichage)."""
+        if self.reorder_period == 0:
+            return self.positions
+        return morton.in_original_order(self.positions, self.ids)
         
-    def update_positions(self, dt):
-        """Applique la méthode de Verlet vectorisée pour mettre à jour les positions et vitesses des corps."""
-        a = compute_acceleration( self.positions, self.masses,
-                                  self.grid.cell_start_indices, self.grid.body_indices,
-                                  self.grid.cell_masses, self.grid.cell_com_positions,
-                                  self.grid.min_bounds, self.grid.max_bounds,
-                                  self.grid.cell_size, self.grid.n_cells)
-        self.positions += self.velocities * dt + 0.5 * a * dt * dt
+    def compute_acceleration(self, targets : np.ndarray = None):
+        """
+        Calcule l'accélération de chaque corps (ou des seuls corps d'indices targets) à partir de l'état
+        courant de la grille. Les corps hors de la boîte de la grille sont traités par sommation directe : ils
+        subissent l'attraction de tous les autres corps et l'exercent sur les corps de la grille.
+        """
+        if targets is None:
+            targets = np.arange(self.positions.shape[0])
+        outliers = self.grid.outliers
+        if outliers.shape[0] == 0:
+            return self.grid_acceleration(targets)
+        outside = self.grid.body_cells[targets] < 0
+        inside_targets = targets[~outside]
+        a = np.empty((targets.shape[0], 3), dtype=self.positions.dtype)
+        accumulator, compensated = self.precision.accumulator, self.precision.compensated
+        a[~outside] = (self.grid_acceleration(inside_targets) +
+                       direct_acceleration(self.positions, self.masses, inside_targets, outliers,
+                                           accumulator, compensated))
+        a[outside] = direct_acceleration(self.positions, self.masses, targets[outside],
+                                         np.arange(self.positions.shape[0]), accumulator, compensated)
+        return a
+
+    def grid_acceleration(self, targets : np.ndarray):
+        """
+        Accélération exercée par les corps de la grille sur les corps d'indices targets (tous dans la grille).
+        """
+        grid = self.grid
+        if self.far_field_order < 0:
+            return compute_acceleration( self.positions, self.masses,
+                                         grid.cell_start_indices, grid.body_indices,
+                                         grid.cell_masses, grid.cell_com_positions,
+                                         grid.min_bounds, grid.max_bounds,
+                                         grid.cell_size, grid.n_cells,
+                                         grid.cell_slots, grid.near_start, grid.near_cells,
+                                         grid.far_start, grid.far_cells,
+                                         grid.cell_quadrupoles, grid.use_quadrupole, targets,
+                                         self.precision.accumulator, self.precision.compensated)
+        cell_radii = compute_cell_radii( grid.occupied_cells, grid.cell_start_indices, grid.body_indices,
+                                         self.positions, grid.cell_com_positions )
+        far_acc, far_jac, far_hess, self.far_split = compute_far_field_expansions( grid.occupied_cells, grid.cell_slots,
+                                                                                   grid.far_start, grid.far_cells,
+                                                                                   grid.cell_masses, grid.cell_com_positions,
+                                                                                   cell_radii, self.far_field_order,
+                                                                                   self.far_field_theta,
+                                                                                   grid.cell_quadrupoles, grid.use_quadrupole )
+        return compute_acceleration_cell_to_cell( self.positions, self.masses,
+                                                  grid.cell_start_indices, grid.body_indices,
+                                                  grid.cell_masses, grid.cell_com_positions, grid.occupied_cells,
+                                                  grid.min_bounds, grid.cell_size, grid.n_cells,
+                                                  grid.cell_slots, grid.near_start, grid.near_cells,
+                                                  grid.far_start, grid.far_cells, self.far_split,
+                                                  far_acc, far_jac, far_hess, self.far_field_order,
+                                                  grid.cell_quadrupoles, grid.use_quadrupole, targets,
+                                                  self.precision.accumulator, self.precision.compensated )
+
+    def evaluate_acceleration(self, targets : np.ndarray = None):
+        """
+        Met à jour la grille pour les positions courantes et calcule l'accélération de chaque corps
+        (ou seulement des corps d'indices targets, dans cet ordre).
+        """
         self.grid.update(self.positions, self.masses)
-        a_new = compute_acceleration( self.positions, self.masses,
-                                      self.grid.cell_start_indices, self.grid.body_indices,
-                                      self.grid.cell_masses, self.grid.cell_com_positions,
-                                      self.grid.min_bounds, self.grid.max_bounds,
-                                      self.grid.cell_size, self.grid.n_cells)
-        self.velocities += 0.5 * (a + a_new) * dt
+        return self.compute_acceleration(targets)
+
+    def interaction_count(self) -> int:
+        """
+        Nombre d'interactions d'un calcul complet des accélérations pour l'état courant de la grille
+        (et le dernier découpage des cellules lointaines en mode cellule à cellule).
+        """
+        grid = self.grid
+        n_bodies = self.positions.shape[0]
+        n_outliers = grid.outliers.shape[0]
+        # Sommation directe : des corps hors de la boîte sur ceux de la grille, de tous les corps sur eux
+        direct = n_outliers * (n_bodies - n_outliers) + n_outliers * (n_bodies - 1)
+        return direct + count_interactions(grid.cell_start_indices, grid.occupied_cells, grid.near_start,
+                                           grid.near_cells, grid.far_start,
+                                           self.far_split if self.far_field_order >= 0 else None)
+
+    def potential_energy(self, positions : np.ndarray = None) -> float:
+        """
+        Énergie potentielle approchée (voir grid_potential_energy) des corps placés en positions (par défaut les
+        positions courantes), avec le découpage en cellules de la dernière mise à jour de la grille : seuls les
+        centres de masse des cellules sont recalculés. Remplace la somme directe en O(N²) dans
+        integrators.total_energy ; deux énergies calculées avec le même découpage ne diffèrent que par le
+        déplacement des corps (pas de saut quand un corps change de cellule), voir integrators.AdaptiveTimeStep.
+        Les corps hors de la boîte interagissent par sommation directe avec tous les autres.
+        """
+        if positions is None:
+            positions = self.positions
+        grid = self.grid
+        cell_masses = np.empty(grid.cell_masses.shape[0])
+        cell_com_positions = np.empty((grid.cell_masses.shape[0], 3))
+        compute_cell_moments(grid.cell_start_indices, grid.body_indices, cell_masses, cell_com_positions,
+                             self.masses, positions)
+        energy = grid_potential_energy(positions, self.masses, grid.cell_start_indices, grid.body_indices,
+                                       cell_masses, cell_com_positions, grid.body_cells,
+                                       grid.cell_slots, grid.near_start, grid.near_cells,
+                                       grid.far_start, grid.far_cells)
+        outliers = grid.outliers
+        if outliers.shape[0] > 0:
+            # Paires corps hors de la boîte - tous les corps, sans compter deux fois celles entre corps hors de la boîte
+            energy += (direct_potential_energy(positions, self.masses, outliers, np.arange(positions.shape[0])) -
+                       0.5 * direct_potential_energy(positions, self.masses, outliers, outliers))
+        return energy
+
+    def display_cells(self):
+        """
+        Grille du dernier calcul des accélérations, pour les niveaux de détail de l'affichage
+        (visualizer3d.LevelOfDetail) : cellule de chaque corps (dans l'ordre d'origine des corps, -1 pour les
+        corps hors de la boîte), centre de masse de chaque cellule et taille d'une cellule.
+        """
+        grid = self.grid
+        return morton.in_original_order(grid.body_cells, self.ids), grid.cell_com_positions, grid.cell_size
+
+    def update_positions(self, dt):
+        """
+        Avance le système d'un pas de temps dt avec l'intégrateur choisi (Verlet vitesse par défaut).
+        L'accélération aux nouvelles positions sert aussi d'accélération initiale au pas suivant : elle est
+        conservée dans self.acceleration et on n'a qu'un calcul de forces par pas.
+        """
+        if self.reorder_period > 0 and self.n_steps % self.reorder_period == 0:
+            self.reorder_bodies()
+        if (self.auto_grid and self.grid_retune_period > 0 and self.n_steps > 0 and
+            self.n_steps % self.grid_retune_period == 0):
+            self.tune_grid(measure=False)
+        self.n_steps += 1
+        self.integrator.step(self, dt)
 
 system : NBodySystem
 
 def update_positions(dt : float):
     global system
     system.update_positions(dt)
-    return system.positions
+    return system.positions_by_id()
 
-def run_simulation(filename, geometry=(800,600), ncells_per_dir : tuple[int, int, int] = (10,10,10), dt=0.001):
+def run_simulation(filename, geometry=(800,600), ncells_per_dir : tuple[int, int, int] = (10,10,10), dt=0.001,
+                   far_field_order : int = -1, use_quadrupole : bool = False):
+    import visualizer3d
     # Initialise le système de corps :
     global system
-    system = NBodySystem(filename, ncells_per_dir=ncells_per_dir)
+    system = NBodySystem(filename, ncells_per_dir=ncells_per_dir, far_field_order=far_field_order,
+                          use_quadrupole=use_quadrupole, grid_retune_period=200)
+    print(system.grid_report())
     # Initialise l'affichage graphique :
     pos = system.positions
     col = system.colors
     intensity = np.clip(system.masses / system.max_mass, 0.5, 1.0)
-    visu = visualizer3d.Visualizer3D(pos, col, intensity,  [[system.box[0][0], system.box[1][0]], [system.box[0][1], system.box[1][1]], [system.box[0][2], system.box[1][2]]])
+    bounds = [[system.box[0][0], system.box[1][0]], [system.box[0][1], system.box[1][1]], [system.box[0][2], system.box[1][2]]]
+    # Niveaux de détail (actifs au-delà de 200 000 corps) : la grille du calcul est réutilisée si elle est assez fine
+    # pour l'affichage, sinon le visualiseur utilise sa propre grille
+    lod = visualizer3d.LevelOfDetail(bounds, cell_provider=system.display_cells if np.prod(system.grid.n_cells) >= 4096 else None)
+    visu = visualizer3d.Visualizer3D(pos, col, intensity, bounds, lod=lod)
     visu.run(updater=update_positions, dt = dt)
 
 
-filename = "data/galaxy_1000"
-dt = 0.001
-n_cells_per_dir = (20,20,1)
-if len(sys.argv) > 1:
-    filename = sys.argv[1]
-if len(sys.argv) > 2:
-    dt = float(sys.argv[2])
-if len(sys.argv) > 5:
-    n_cells_per_dir = (int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
-    
-print(f"Simulation de {filename} avec dt = {dt} et grille {n_cells_per_dir}")
-run_simulation(filename, ncells_per_dir=n_cells_per_dir, dt=dt)
-    
+if __name__ == "__main__":
+    filename = "data/galaxy_1000"
+    dt = 0.001
+    n_cells_per_dir = (20,20,1)
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        dt = float(sys.argv[2])
+    # "auto" à la place de nx (ny et nz sont alors ignorés) : grille choisie par NBodySystem.tune_grid
+    if len(sys.argv) > 3 and sys.argv[3] == "auto":
+        n_cells_per_dir = "auto"
+    elif len(sys.argv) > 5:
+        n_cells_per_dir = (int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    far_field_order = -1
+    if len(sys.argv) > 6:
+        far_field_order = int(sys.argv[6])
+    use_quadrupole = len(sys.argv) > 7 and sys.argv[7] == "quad"
+
+    print(f"Simulation de {filename} avec dt = {dt} et grille {n_cells_per_dir}")
+    if far_field_order >= 0:
+        print(f"Champ lointain calculé cellule à cellule (développement d'ordre {far_field_order})")
+    if use_quadrupole:
+        print("Champ lointain corrigé par les moments quadripolaires des cellules")
+    run_simulation(filename, ncells_per_dir=n_cells_per_dir, dt=dt, far_field_order=far_field_order,
+                   use_quadrupole=use_quadrupole)
+
@@ -0,0 +1,53 @@
+# Politique de précision des moteurs N corps (grille numpy, grilles numba séquentielle, parallèle et de l'affichage
+# séparé, grille MPI, Barnes-Hut) :
+#     - "mixed"   : positions, vitesses et masses stockées en float32 (deux fois moins de mémoire à parcourir),
+#                   chaque interaction calculée à partir de ces float32, mais les sommes des forces (et le produit
+#                   par G) en float64
+#     - "float32" : tout en float32, sommes des forces compensées (sommation de Kahan : l'erreur d'arrondi de
+#                   chaque addition est gardée et réinjectée dans la suivante, d'où une erreur de la somme
+#                   indépendante du nombre de termes)
+#     - "float64" : tout en float64
+# Les moments des cellules et des nœuds (masse, centre de masse, quadripôle) sont toujours accumulés en float64 :
+# ils ne coûtent qu'un parcours des corps, dont le prix est la lecture des corps et non l'arithmétique.
+#
+# Les noyaux numba reçoivent le type des sommes (accumulator) et le drapeau compensated ; leurs fonctions de sommation
+# sont dans precision_kernels.py, ce module ne dépend que de numpy (la grille numpy s'en sert sans numba).
+import numpy as np
+
+PRECISIONS = ("mixed", "float32", "float64")
+
+class Precision:
+    """
+    Types utilisés par un moteur pour un mode de PRECISIONS :
+        - storage : type des positions, vitesses, masses et accélérations des corps
+        - accumulator : type des sommes des forces
+        - compensated : sommes compensées (Kahan)
+    """
+    def __init__(self, name : str):
+        if name not in PRECISIONS:
+            raise ValueError(f"Précision inconnue : {name} (choix possibles : {', '.join(PRECISIONS)})")
+        self.name = name
+        self.storage = np.float64 if name == "float64" else np.float32
+        self.accumulator = np.float32 if name == "float32" else np.float64
+        self.compensated = name == "float32"
+
+    def __repr__(self):
+        return f"Precision({self.name!r})"
+
+def make_precision(precision) -> Precision:
+    """
+    Mode de précision à partir de son nom (ou d'une instance de Precision, retournée telle quelle).
+    """
+    if isinstance(precision, Precision):
+        return precision
+    return Precision(precision)
+
+def add_compensated(total : np.ndarray, compensation : np.ndarray, index : np.ndarray, term : np.ndarray):
+    """
+    Version numpy de precision_kernels.compensated_add : ajoute term aux lignes index (sans doublon) de la somme compensée
+    (total, compensation).
+    """
+    y = term - compensation[index]
+    t = total[index] + y
+    compensation[index] = (t - total[index]) - y
+    total[index] = t
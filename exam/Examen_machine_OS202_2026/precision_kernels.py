@@ -0,0 +1,33 @@
+# Sommation des forces dans les noyaux numba selon le mode de précision (voir precision.py) : sommes simples, ou
+# compensées (sommation de Kahan) dans le mode "float32".
+#
+# Les noyaux ne doivent pas être compilés avec l'option fastmath complète, dont la réassociation des additions
+# supprime la compensation (voir FASTMATH_FLAGS).
+from numba import njit
+
+# Options fastmath de numba sans "reassoc" (réassociation), compatibles avec la sommation de Kahan
+FASTMATH_FLAGS = {"nnan", "ninf", "nsz", "arcp", "contract", "afn"}
+
+@njit(inline="always")
+def compensated_add(total, compensation, term):
+    """
+    Ajoute term à la somme compensée (total, compensation) et retourne la nouvelle somme et sa compensation.
+    """
+    y = term - compensation
+    t = total + y
+    return t, (t - total) - y
+
+@njit(inline="always")
+def accumulate(ax, ay, az, cx, cy, cz, tx, ty, tz, compensated : bool):
+    """
+    Ajoute le vecteur (tx, ty, tz) à la somme (ax, ay, az), de compensation (cx, cy, cz) si compensated.
+    """
+    if compensated:
+        ax, cx = compensated_add(ax, cx, tx)
+        ay, cy = compensated_add(ay, cy, ty)
+        az, cz = compensated_add(az, cz, tz)
+    else:
+        ax += tx
+        ay += ty
+        az += tz
+    return ax, ay, az, cx, cy, cz
@@ -0,0 +1,349 @@
+# Générateur de scénarios de conditions initiales pour les bancs d'essai (répartitions spatiales variées) :
+#     - "disk"       : un disque d'étoiles autour d'un trou noir central (cf. galaxy_generator.py)
+#     - "collision"  : deux galaxies en disque inclinées l'une par rapport à l'autre, en approche
+#     - "plummer"    : sphère de Plummer à l'équilibre (densité très piquée au centre)
+#     - "uniform"    : cube uniforme (cas sans déséquilibre de charge)
+#     - "clustered"  : amas gaussiens de tailles et populations très différentes (cellules vides / surchargées)
+#
+# Les corps sont tirés par blocs de galaxy_generator.SEED_BLOCK_SIZE, chaque bloc avec son propre générateur
+# aléatoire : les blocs sont répartis sur un ensemble de processus et le résultat ne dépend que de la graine.
+# Pour un fichier binaire (.nbs), chaque processus écrit directement ses blocs dans la projection mémoire du
+# fichier, sans renvoyer les données au processus principal.
+#
+# Usage : python3 scenarios.py scénario nombre_corps fichier [graine [processus]] [paramètre=valeur ...]
+#     Exemple : python3 scenarios.py collision 1000000 data/collision_1M.nbs 42 8 separation=6.
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import snapshot
+from galaxy_generator import G, SEED_BLOCK_SIZE, generate_stable_orbits
+
+def rotation_matrix(inclination : float, position_angle : float) -> np.ndarray:
+    """
+    Rotation d'angle inclination autour de l'axe x, suivie d'une rotation d'angle position_angle autour de z.
+    """
+    ci, si = np.cos(inclination), np.sin(inclination)
+    cp, sp = np.cos(position_angle), np.sin(position_angle)
+    rx = np.array([[1., 0., 0.], [0., ci, -si], [0., si, ci]])
+    rz = np.array([[cp, -sp, 0.], [sp, cp, 0.], [0., 0., 1.]])
+    return rz @ rx
+
+class Scenario:
+    """
+    Classe de base des scénarios. Les corps sont numérotés de 0 à n_bodies - 1 ; setup tire (dans le processus
+    principal) les paramètres globaux du scénario, puis bodies génère indépendamment n'importe quelle tranche
+    de corps à partir des seuls paramètres globaux.
+    """
+    def __init__(self, star_mass_range : tuple[float, float] = (0.5, 10.0)):
+        self.star_mass_range = star_mass_range
+        self.n_bodies = 0
+
+    def setup(self, rng : np.random.Generator, n_bodies : int):
+        """
+        Tire les paramètres globaux du scénario pour n_bodies corps.
+        """
+        self.n_bodies = n_bodies
+
+    def bodies(self, rng : np.random.Generator, first : int, count : int):
+        """
+        Génère les corps first à first + count - 1.
+
+        :return: masses (count,), positions (count, 3) et vitesses (count, 3)
+        """
+        raise NotImplementedError
+
+    def star_masses(self, rng : np.random.Generator, count : int) -> np.ndarray:
+        return rng.uniform(self.star_mass_range[0], self.star_mass_range[1], count)
+
+class DiskGalaxy(Scenario):
+    """
+    Disque d'étoiles en orbite autour d'un trou noir central (le corps 0), comme galaxy_generator.py.
+    """
+    def __init__(self, black_hole_mass : float = None, min_radius : float = 0.001, max_radius : float = 1.0,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.black_hole_mass = black_hole_mass
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+
+    def setup(self, rng, n_bodies):
+        super().setup(rng, n_bodies)
+        if self.black_hole_mass is None:
+            self.black_hole_mass = rng.uniform(1e5, 1e10)
+
+    def bodies(self, rng, first, count):
+        n_stars = count - (1 if first == 0 else 0)
+        masses = self.star_masses(rng, n_stars)
+        positions, velocities = generate_stable_orbits(rng, self.black_hole_mass, n_stars,
+                                                       self.min_radius, self.max_radius)
+        if first == 0:
+            masses = np.concatenate(([self.black_hole_mass], masses))
+            positions = np.concatenate((np.zeros((1, 3)), positions))
+            velocities = np.concatenate((np.zeros((1, 3)), velocities))
+        return masses, positions, velocities
+
+class CollidingGalaxies(Scenario):
+    """
+    Deux galaxies en disque (trous noirs = corps 0 et 1) séparées de separation années-lumière selon x, avec un
+    paramètre d'impact selon y, en approche à la vitesse approach_factor * vitesse de libération. Le second disque
+    est incliné de inclination radians. Les étoiles sont réparties entre les galaxies selon leur masse centrale.
+    """
+    def __init__(self, black_hole_masses : tuple[float, float] = None, separation : float = 4.0,
+                 impact_parameter : float = 1.0, approach_factor : float = 0.5, inclination : float = np.pi/3,
+                 min_radius : float = 0.001, max_radius : float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.black_hole_masses = black_hole_masses
+        self.separation = separation
+        self.impact_parameter = impact_parameter
+        self.approach_factor = approach_factor
+        self.inclination = inclination
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+
+    def setup(self, rng, n_bodies):
+        super().setup(rng, n_bodies)
+        if self.black_hole_masses is None:
+            self.black_hole_masses = tuple(rng.uniform(1e8, 1e10, 2))
+        m1, m2 = self.black_hole_masses
+        total = m1 + m2
+        distance = np.hypot(self.separation, self.impact_parameter)
+        v_rel = self.approach_factor * np.sqrt(2 * G * total / distance)
+        # Galaxies placées dans le repère du centre de masse, la seconde arrivant selon -x
+        relative = np.array([self.separation, self.impact_parameter, 0.])
+        self.centers = np.array([-m2/total * relative, m1/total * relative])
+        self.bulk_velocities = np.array([[m2/total * v_rel, 0., 0.], [-m1/total * v_rel, 0., 0.]])
+        self.rotations = [np.eye(3), rotation_matrix(self.inclination, 0.)]
+        # Nombre d'étoiles de la première galaxie
+        self.n_stars_first = int(round((n_bodies - 2) * m1 / total))
+
+    def bodies(self, rng, first, count):
+        index = np.arange(first, first + count)
+        galaxy = np.where(index - 2 < self.n_stars_first, 0, 1)
+        masses = np.empty(count)
+        positions = np.empty((count, 3))
+        velocities = np.empty((count, 3))
+        for g in (0, 1):
+            stars = (galaxy == g) & (index >= 2)
+            n_stars = int(np.count_nonzero(stars))
+            pos, vel = generate_stable_orbits(rng, self.black_hole_masses[g], n_stars,
+                                              self.min_radius, self.max_radius)
+            masses[stars] = self.star_masses(rng, n_stars)
+            positions[stars] = pos @ self.rotations[g].T + self.centers[g]
+            velocities[stars] = vel @ self.rotations[g].T + self.bulk_velocities[g]
+            hole = index == g
+            masses[hole] = self.black_hole_masses[g]
+            positions[hole] = self.centers[g]
+            velocities[hole] = self.bulk_velocities[g]
+        return masses, positions, velocities
+
+class PlummerSphere(Scenario):
+    """
+    Sphère de Plummer de masse totale total_mass et de rayon caractéristique scale_radius, tronquée à
+    max_radius * scale_radius, avec des vitesses tirées dans la fonction de distribution d'équilibre
+    (Aarseth, Hénon et Wielen 1974). Tous les corps ont la même masse.
+    """
+    def __init__(self, total_mass : float = 1e9, scale_radius : float = 0.3, max_radius : float = 10.0,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.total_mass = total_mass
+        self.scale_radius = scale_radius
+        self.max_radius = max_radius
+
+    def bodies(self, rng, first, count):
+        a = self.scale_radius
+        # Rayon par inversion de la masse cumulée M(r)/M = (1 + a²/r²)^(-3/2)
+        max_fraction = (1 + 1/self.max_radius**2)**(-1.5)
+        fraction = rng.uniform(0, max_fraction, count)
+        radius = a / np.sqrt(np.maximum(fraction, 1.E-300)**(-2/3) - 1)
+        positions = radius[:, None] * random_directions(rng, count)
+        # Vitesse v = q * v_esc(r), q de densité proportionnelle à q²(1 - q²)^(7/2) (tirage par rejet)
+        q = np.empty(count)
+        todo = np.arange(count)
+        while todo.shape[0] > 0:
+            x = rng.uniform(0, 1, todo.shape[0])
+            y = rng.uniform(0, 0.1, todo.shape[0])
+            accepted = y < x*x * (1 - x*x)**3.5
+            q[todo[accepted]] = x[accepted]
+            todo = todo[~accepted]
+        escape = np.sqrt(2 * G * self.total_mass / a) * (1 + (radius/a)**2)**(-0.25)
+        velocities = (q * escape)[:, None] * random_directions(rng, count)
+        masses = np.full(count, self.total_mass / self.n_bodies)
+        return masses, positions, velocities
+
+class UniformCube(Scenario):
+    """
+    Corps répartis uniformément dans un cube d'arête side centré à l'origine, vitesses gaussiennes d'écart-type
+    velocity_dispersion (nulles par défaut : effondrement froid).
+    """
+    def __init__(self, side : float = 2.0, velocity_dispersion : float = 0., **kwargs):
+        super().__init__(**kwargs)
+        self.side = side
+        self.velocity_dispersion = velocity_dispersion
+
+    def bodies(self, rng, first, count):
+        positions = rng.uniform(-0.5*self.side, 0.5*self.side, (count, 3))
+        velocities = rng.normal(0, 1, (count, 3)) * self.velocity_dispersion
+        return self.star_masses(rng, count), positions, velocities
+
+class ClusteredDistribution(Scenario):
+    """
+    Amas gaussiens placés uniformément dans un cube d'arête side. Les populations des amas suivent une loi de
+    puissance (quelques amas très peuplés, beaucoup de petits) et leurs rayons une loi log-normale ; les vitesses
+    sont gaussiennes, de dispersion viriale sqrt(G M_amas / (2 r_amas)) augmentée de cluster_mass.
+    """
+    def __init__(self, n_clusters : int = 32, side : float = 2.0, mean_cluster_radius : float = 0.05,
+                 population_exponent : float = 1.5, cluster_mass : float = 1e7, **kwargs):
+        super().__init__(**kwargs)
+        self.n_clusters = n_clusters
+        self.side = side
+        self.mean_cluster_radius = mean_cluster_radius
+        self.population_exponent = population_exponent
+        self.cluster_mass = cluster_mass
+
+    def setup(self, rng, n_bodies):
+        super().setup(rng, n_bodies)
+        self.centers = rng.uniform(-0.5*self.side, 0.5*self.side, (self.n_clusters, 3))
+        self.radii = self.mean_cluster_radius * rng.lognormal(0., 0.5, self.n_clusters)
+        weights = rng.pareto(self.population_exponent, self.n_clusters) + 1.
+        self.cumulative_weights = np.cumsum(weights) / np.sum(weights)
+        self.cumulative_weights[-1] = 1.
+        self.dispersions = np.sqrt(G * (self.cluster_mass + n_bodies * weights/np.sum(weights)
+                                        * np.mean(self.star_mass_range)) / (2 * self.radii))
+
+    def bodies(self, rng, first, count):
+        cluster = np.searchsorted(self.cumulative_weights, rng.uniform(0, 1, count), side="right")
+        cluster = np.minimum(cluster, self.n_clusters - 1)
+        positions = self.centers[cluster] + rng.normal(0, 1, (count, 3)) * self.radii[cluster, None]
+        velocities = rng.normal(0, 1, (count, 3)) * self.dispersions[cluster, None]
+        return self.star_masses(rng, count), positions, velocities
+
+def random_directions(rng : np.random.Generator, count : int) -> np.ndarray:
+    """
+    Vecteurs unitaires uniformément répartis sur la sphère.
+    """
+    cos_theta = rng.uniform(-1, 1, count)
+    phi = rng.uniform(0, 2*np.pi, count)
+    sin_theta = np.sqrt(1 - cos_theta*cos_theta)
+    return np.column_stack((sin_theta*np.cos(phi), sin_theta*np.sin(phi), cos_theta))
+
+SCENARIOS = {
+    "disk": DiskGalaxy,
+    "collision": CollidingGalaxies,
+    "plummer": PlummerSphere,
+    "uniform": UniformCube,
+    "clustered": ClusteredDistribution,
+}
+
+def make_scenario(name : str, **params) -> Scenario:
+    """
+    Construit un scénario à partir de son nom (clé de SCENARIOS) et de ses paramètres.
+    """
+    if name not in SCENARIOS:
+        raise ValueError(f"Scénario inconnu : {name} (choix : {', '.join(SCENARIOS)})")
+    return SCENARIOS[name](**params)
+
+def generate_block(scenario : Scenario, entropy, block : int):
+    """
+    Génère le bloc numéro block du scénario (déjà initialisé par setup) avec le générateur propre à ce bloc.
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(block,)))
+    first = block * SEED_BLOCK_SIZE
+    return scenario.bodies(rng, first, min(SEED_BLOCK_SIZE, scenario.n_bodies - first))
+
+def write_block(scenario : Scenario, entropy, block : int, filename : str) -> np.ndarray:
+    """
+    Génère le bloc numéro block et l'écrit à sa place dans le fichier binaire filename.
+
+    :return: Boîte englobante du bloc
+    """
+    masses, positions, velocities = generate_block(scenario, entropy, block)
+    _, records = snapshot.open_snapshot(filename, mode="r+")
+    first = block * SEED_BLOCK_SIZE
+    chunk = records[first:first + masses.shape[0]]
+    chunk["mass"] = masses
+    chunk["position"] = positions
+    chunk["velocity"] = velocities
+    records.flush()
+    return snapshot.bounding_box(positions)
+
+def prepare(scenario, n_bodies : int, seed = None):
+    """
+    Construit le scénario si besoin, tire ses paramètres globaux et retourne (scénario, entropie, nombre de blocs).
+    """
+    if isinstance(scenario, str):
+        scenario = make_scenario(scenario)
+    seed_sequence = np.random.SeedSequence(seed)
+    scenario.setup(np.random.default_rng(seed_sequence), n_bodies)
+    n_blocks = -(-n_bodies // SEED_BLOCK_SIZE)
+    return scenario, seed_sequence.entropy, n_blocks
+
+def generate(scenario, n_bodies : int, seed = None, n_workers : int = None):
+    """
+    Génère en mémoire les n_bodies corps d'un scénario, les blocs étant répartis sur n_workers processus
+    (par défaut, autant que de cœurs). Le résultat ne dépend pas de n_workers.
+
+    :param scenario: Nom du scénario (paramètres par défaut) ou instance de Scenario
+    :return: masses (n,), positions (n, 3) et vitesses (n, 3)
+    """
+    scenario, entropy, n_blocks = prepare(scenario, n_bodies, seed)
+    n_workers = n_workers or os.cpu_count()
+    blocks = range(n_blocks)
+    if n_workers == 1 or n_blocks == 1:
+        results = [generate_block(scenario, entropy, block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(generate_block, [scenario]*n_blocks, [entropy]*n_blocks, blocks))
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+def write(scenario, n_bodies : int, output_file : str, seed = None, n_workers : int = None):
+    """
+    Génère un scénario et l'écrit dans output_file. Au format binaire (.nbs), chaque processus écrit ses blocs
+    directement dans le fichier ; au format texte, les corps sont générés en mémoire puis écrits.
+    """
+    if not output_file.endswith(snapshot.BINARY_SUFFIX):
+        snapshot.save_bodies(output_file, *generate(scenario, n_bodies, seed, n_workers))
+        return
+    scenario, entropy, n_blocks = prepare(scenario, n_bodies, seed)
+    n_workers = n_workers or os.cpu_count()
+    records = snapshot.create_snapshot(output_file, n_bodies)
+    del records
+    blocks = range(n_blocks)
+    args = ([scenario]*n_blocks, [entropy]*n_blocks, blocks, [output_file]*n_blocks)
+    if n_workers == 1 or n_blocks == 1:
+        boxes = list(map(write_block, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            boxes = list(pool.map(write_block, *args))
+    boxes = np.array(boxes)
+    snapshot.set_box(output_file, np.array([np.min(boxes[:, 0], axis=0), np.max(boxes[:, 1], axis=0)]))
+
+def parse_value(text : str):
+    """
+    Convertit la valeur d'un paramètre de la ligne de commande (entier, réel, ou n-uplet séparé par des virgules).
+    """
+    if "," in text:
+        return tuple(parse_value(item) for item in text.split(",") if item)
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+if __name__ == "__main__":
+    positional = [arg for arg in sys.argv[1:] if "=" not in arg]
+    if len(positional) < 3:
+        print("Usage : python3 scenarios.py scénario nombre_corps fichier [graine [processus]] [paramètre=valeur ...]")
+        print(f"Scénarios : {', '.join(SCENARIOS)}")
+        sys.exit(1)
+    name, n_bodies, output_file = positional[0], int(positional[1]), positional[2]
+    seed = int(positional[3]) if len(positional) > 3 else None
+    n_workers = int(positional[4]) if len(positional) > 4 else None
+    params = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    scenario = make_scenario(name, **{key: parse_value(value) for key, value in params.items()})
+    start = time.perf_counter()
+    write(scenario, n_bodies, output_file, seed, n_workers)
+    print(f"Scénario {name} : {n_bodies} corps écrits dans '{output_file}' en {time.perf_counter() - start:.2f} s")
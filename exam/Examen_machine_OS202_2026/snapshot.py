@@ -0,0 +1,175 @@
+# Lecture et écriture des fichiers de corps (masse, position, vitesse).
+#     - Format texte d'origine : une ligne "masse px py pz vx vy vz" par corps
+#     - Format binaire (extension .nbs) : un en-tête puis un tableau structuré numpy, ouvert par np.memmap sans
+#       aucune analyse syntaxique (le système d'exploitation ne charge que les pages effectivement lues)
+#
+# Structure d'un fichier binaire :
+#     octets 0-7   : MAGIC
+#     octets 8-15  : position du début des données (entier 64 bits petit-boutiste, multiple de DATA_ALIGNMENT)
+#     octets 16-   : en-tête JSON (utf-8) complété par des espaces : nombre de corps, type des réels, boîte
+#                    englobante, constante de gravitation et unités
+#     puis         : n_bodies enregistrements (mass, position[3], velocity[3])
+#
+# Usage (conversion) : python3 snapshot.py source destination [float32|float64]
+#     Le sens de la conversion est déduit de la source : un fichier binaire est converti en texte, un fichier texte
+#     en binaire (float64 par défaut, ce qui conserve exactement les valeurs lues dans le fichier texte).
+import sys
+import json
+import numpy as np
+
+MAGIC = b"NBODYSNP"
+VERSION = 1
+# Alignement du début des données (taille d'une ligne de cache)
+DATA_ALIGNMENT = 64
+BINARY_SUFFIX = ".nbs"
+# Constante gravitationnelle en unités [ly^3 / (M_sun * an^2)] (cf. galaxy_generator.py)
+G = 1.560339e-13
+UNITS = {"length": "ly", "mass": "M_sun", "time": "yr"}
+
+def record_dtype(dtype = np.float64) -> np.dtype:
+    """
+    Type d'un enregistrement (un corps) du format binaire.
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    return np.dtype([("mass", dtype), ("position", dtype, (3,)), ("velocity", dtype, (3,))])
+
+def bounding_box(positions : np.ndarray) -> np.ndarray:
+    """
+    Coins min et max (légèrement élargis) de la boîte contenant les positions et l'origine, comme le calculaient
+    les constructeurs des NBodySystem.
+    """
+    box = np.array([[-1.E-6,-1.E-6,-1.E-6],[1.E-6,1.E-6,1.E-6]], dtype=np.float64)
+    if positions.shape[0] > 0:
+        box[0] = np.minimum(box[0], np.min(positions, axis=0) - 1.E-6)
+        box[1] = np.maximum(box[1], np.max(positions, axis=0) + 1.E-6)
+    return box
+
+def is_binary(filename : str) -> bool:
+    """
+    Teste si le fichier commence par l'identifiant du format binaire.
+    """
+    with open(filename, "rb") as fich:
+        return fich.read(len(MAGIC)) == MAGIC
+
+def read_header(filename : str) -> tuple[dict, int]:
+    """
+    Lit l'en-tête d'un fichier binaire.
+
+    :return: Dictionnaire de l'en-tête et position (en octets) du début des données
+    """
+    with open(filename, "rb") as fich:
+        if fich.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} n'est pas un fichier de corps binaire")
+        offset = int(np.frombuffer(fich.read(8), dtype="<u8")[0])
+        header = json.loads(fich.read(offset - len(MAGIC) - 8).decode("utf-8"))
+    if header["version"] > VERSION:
+        raise ValueError(f"{filename} : version {header['version']} du format non prise en charge")
+    return header, offset
+
+def open_snapshot(filename : str, mode : str = "r") -> tuple[dict, np.memmap]:
+    """
+    Ouvre un fichier binaire par projection mémoire.
+
+    :param mode: "r" (lecture seule) ou "r+" (lecture/écriture)
+    :return: En-tête et tableau structuré (champs "mass", "position", "velocity") projeté en mémoire
+    """
+    header, offset = read_header(filename)
+    records = np.memmap(filename, dtype=record_dtype(header["dtype"]), mode=mode, offset=offset,
+                        shape=(header["n_bodies"],))
+    return header, records
+
+def create_snapshot(filename : str, n_bodies : int, dtype = np.float64, box : np.ndarray = None,
+                    gravitational_constant : float = G, units : dict = UNITS, metadata : dict = None) -> np.memmap:
+    """
+    Crée un fichier binaire de n_bodies corps et retourne son tableau structuré projeté en mémoire (en écriture),
+    à remplir par l'appelant (par exemple morceau par morceau) puis à valider par flush().
+
+    :param box: Boîte englobante à inscrire dans l'en-tête (à mettre à jour avec set_box si elle n'est pas
+                connue à la création)
+    :param metadata: Entrées supplémentaires de l'en-tête (par exemple le numéro du pas et le temps simulé)
+    """
+    header = {"version": VERSION, "n_bodies": int(n_bodies), "dtype": np.dtype(dtype).newbyteorder("<").str,
+              "box": None if box is None else np.asarray(box, dtype=np.float64).tolist(),
+              "G": gravitational_constant, "units": units}
+    if metadata is not None:
+        header.update(metadata)
+    text = json.dumps(header).encode("utf-8")
+    # Place réservée pour pouvoir réécrire la boîte plus tard sans déplacer les données
+    text += b" " * 128
+    offset = -(-(len(MAGIC) + 8 + len(text)) // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    with open(filename, "wb") as fich:
+        fich.write(MAGIC)
+        fich.write(np.array(offset, dtype="<u8").tobytes())
+        fich.write(text.ljust(offset - len(MAGIC) - 8))
+    return np.memmap(filename, dtype=record_dtype(dtype), mode="r+", offset=offset, shape=(int(n_bodies),))
+
+def set_box(filename : str, box : np.ndarray):
+    """
+    Réécrit la boîte englobante dans l'en-tête d'un fichier binaire existant.
+    """
+    header, offset = read_header(filename)
+    header["box"] = np.asarray(box, dtype=np.float64).tolist()
+    text = json.dumps(header).encode("utf-8")
+    if len(MAGIC) + 8 + len(text) > offset:
+        raise ValueError(f"{filename} : en-tête trop grand pour la place réservée")
+    with open(filename, "r+b") as fich:
+        fich.seek(len(MAGIC) + 8)
+        fich.write(text.ljust(offset - len(MAGIC) - 8))
+
+def write_binary(filename : str, masses, positions, velocities, dtype = np.float64, metadata : dict = None):
+    """
+    Écrit les corps dans un fichier binaire.
+    """
+    positions = np.asarray(positions)
+    records = create_snapshot(filename, positions.shape[0], dtype, bounding_box(positions), metadata=metadata)
+    records["mass"] = masses
+    records["position"] = positions
+    records["velocity"] = velocities
+    records.flush()
+
+def write_text(filename : str, masses, positions, velocities):
+    """
+    Écrit les corps au format texte d'origine "masse px py pz vx vy vz".
+    """
+    data = np.column_stack((np.asarray(masses, dtype=np.float64), np.asarray(positions, dtype=np.float64),
+                            np.asarray(velocities, dtype=np.float64)))
+    np.savetxt(filename, data, fmt="%.6e", delimiter=" ")
+
+def save_bodies(filename : str, masses, positions, velocities, dtype = np.float64):
+    """
+    Écrit les corps au format binaire si le nom du fichier se termine par BINARY_SUFFIX, au format texte sinon.
+    """
+    if filename.endswith(BINARY_SUFFIX):
+        write_binary(filename, masses, positions, velocities, dtype)
+    else:
+        write_text(filename, masses, positions, velocities)
+
+def load_bodies(filename : str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Lit les corps d'un fichier binaire ou texte (le format est reconnu à l'identifiant en tête de fichier).
+    Pour un fichier binaire, les tableaux retournés sont des vues en lecture seule sur la projection mémoire :
+    l'appelant les copie dans le type de réels qu'il utilise.
+
+    :return: masses (n,), positions (n, 3) et vitesses (n, 3)
+    """
+    if is_binary(filename):
+        _, records = open_snapshot(filename)
+        return records["mass"], records["position"], records["velocity"]
+    data = np.loadtxt(filename, dtype=np.float64, ndmin=2)
+    return data[:, 0], data[:, 1:4], data[:, 4:7]
+
+def convert(source : str, destination : str, dtype = np.float64):
+    """
+    Convertit un fichier binaire en texte, ou un fichier texte en binaire (réels de type dtype).
+    """
+    masses, positions, velocities = load_bodies(source)
+    if is_binary(source):
+        write_text(destination, masses, positions, velocities)
+    else:
+        write_binary(destination, masses, positions, velocities, dtype)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage : python3 snapshot.py source destination [float32|float64]")
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else np.float64)
@@ -17,15 +17,184 @@ Utilisation :
     
     # Pour mettre à jour les points :
     visualizer.update_points(new_points, new_colors, new_luminosities)
+
+Les VBO sont alloués une seule fois (et réalloués seulement si le nombre de points change) : à chaque image,
+seules les positions sont transmises (glBufferSubData après "orphelinage" du tampon, pour ne pas attendre que
+le GPU ait fini de lire l'image précédente) ; les couleurs ne sont recalculées et transmises que lorsqu'elles
+changent. À la fermeture, un histogramme des temps de rendu par image est affiché.
+
+Pour un très grand nombre de points, un objet LevelOfDetail regroupe les points des cellules lointaines
+(vues sous un petit angle depuis la caméra) en un seul point agrandi par cellule ; seuls les points des
+cellules proches de la caméra sont dessinés individuellement.
 """
 
+import time
 import numpy as np
+from numba import njit
 import sdl2
 import sdl2.ext
 from OpenGL.GL import *
 from OpenGL.GLU import *
 import ctypes
 
+# Bornes (en ms) des classes de l'histogramme des temps de rendu
+FRAME_TIME_BINS = (0., 1., 2., 4., 8., 16., 33., 66., 133., np.inf)
+
+
+def frame_time_histogram(frame_times):
+    """
+    Met en forme l'histogramme des temps de rendu par image.
+
+    Args:
+        frame_times (sequence): Temps de rendu de chaque image, en secondes
+
+    Returns:
+        str: Histogramme (une ligne par classe) et percentiles 50, 95 et 99
+    """
+    times_ms = 1000. * np.asarray(frame_times, dtype=np.float64)
+    if times_ms.shape[0] == 0:
+        return "Aucune image rendue"
+    counts, _ = np.histogram(times_ms, bins=FRAME_TIME_BINS)
+    lines = [f"Temps de rendu ({times_ms.shape[0]} images) : médiane {np.percentile(times_ms, 50):.2f} ms, "
+             f"p95 {np.percentile(times_ms, 95):.2f} ms, p99 {np.percentile(times_ms, 99):.2f} ms"]
+    width = 50. / max(np.max(counts), 1)
+    for low, high, count in zip(FRAME_TIME_BINS[:-1], FRAME_TIME_BINS[1:], counts):
+        label = f"{low:g}-{high:g} ms" if np.isfinite(high) else f"> {low:g} ms"
+        lines.append(f"  {label:>12} : {'#' * int(round(count * width)):<50} {count}")
+    return "\n".join(lines)
+
+
+@njit
+def bin_points_in_cells(points, colors, min_bounds, inv_cell_size, n_cells, body_cells, counts, sums):
+    """
+    En un seul passage : cellule de chaque point (body_cells), nombre de points (counts) et sommes des
+    positions et des couleurs (sums[:, 0:3] et sums[:, 3:6]) de chaque cellule.
+    """
+    nx, ny, nz = n_cells[0], n_cells[1], n_cells[2]
+    for ibody in range(points.shape[0]):
+        # int() tronque vers zéro : les indices négatifs deviennent 0 ou moins, ramenés à 0 ensuite
+        ix = min(max(int((points[ibody, 0] - min_bounds[0]) * inv_cell_size[0]), 0), nx - 1)
+        iy = min(max(int((points[ibody, 1] - min_bounds[1]) * inv_cell_size[1]), 0), ny - 1)
+        iz = min(max(int((points[ibody, 2] - min_bounds[2]) * inv_cell_size[2]), 0), nz - 1)
+        cell = ix + nx * (iy + ny * iz)
+        body_cells[ibody] = cell
+        counts[cell] += 1
+        for i in range(3):
+            sums[cell, i] += points[ibody, i]
+            sums[cell, 3 + i] += colors[ibody, i]
+
+
+@njit
+def accumulate_colors(body_cells, colors, sums):
+    for ibody in range(body_cells.shape[0]):
+        if body_cells[ibody] >= 0:
+            for i in range(3):
+                sums[body_cells[ibody], i] += colors[ibody, i]
+
+
+class LevelOfDetail:
+    """
+    Niveaux de détail : les points sont répartis dans les cellules d'une grille ; une cellule vue depuis la
+    caméra sous un angle (taille / distance) inférieur à theta est dessinée comme un seul point, placé au
+    centre de ses points, de leur couleur moyenne et de taille croissante avec leur nombre. Les autres
+    cellules sont dessinées point par point.
+
+    Si cell_provider est donné, la grille est celle du calcul : cell_provider() retourne la cellule de chaque
+    point (dans l'ordre des points affichés), la position de chaque cellule (par exemple son centre de masse)
+    et la taille d'une cellule, ce qui évite de recalculer la répartition et les positions des cellules.
+    Un point de cellule négative (hors de la grille du calcul) est toujours dessiné individuellement.
+    """
+    
+    def __init__(self, bounds, n_cells=(64, 64, 16), theta=0.05, min_points=200_000, max_sprite_size=16.0,
+                 cell_provider=None):
+        """
+        Args:
+            bounds (tuple): Limites de l'espace ((xmin, xmax), (ymin, ymax), (zmin, zmax))
+            n_cells (tuple): Nombre de cellules de la grille d'affichage dans chaque direction
+            theta (float): Angle (en radians) sous lequel une cellule est encore regroupée
+            min_points (int): Nombre de points en dessous duquel tous les points sont dessinés
+            max_sprite_size (float): Taille maximale (en pixels) du point d'une cellule regroupée
+            cell_provider (callable): Grille du calcul à réutiliser (voir la description de la classe)
+        """
+        self.min_bounds = np.array([bounds[0][0], bounds[1][0], bounds[2][0]], dtype=np.float32)
+        max_bounds = np.array([bounds[0][1], bounds[1][1], bounds[2][1]], dtype=np.float32)
+        self.n_cells = np.array(n_cells, dtype=np.int64)
+        self.cell_size = (max_bounds - self.min_bounds) / self.n_cells
+        self.theta = theta
+        self.min_points = min_points
+        self.max_sprite_size = max_sprite_size
+        self.cell_provider = cell_provider
+        # Répartition courante : cellule de chaque point, cellules occupées et leurs points regroupés
+        self.body_cells = None
+        self.occupied = None
+        self.cell_positions = None
+        self.cell_colors = None
+        self.cell_sizes = None
+        self.cell_extent = 0.
+        # Points regroupés à dessiner, par taille : liste de (taille, positions, couleurs)
+        self.sprites = []
+    
+    def is_active(self, n_points):
+        return n_points > self.min_points
+    
+    def bin_points(self, points, colors):
+        """
+        Répartit les points dans les cellules et calcule le point regroupé de chaque cellule occupée.
+        
+        Args:
+            points (np.ndarray): Positions des points, shape (N, 3)
+            colors (np.ndarray): Couleurs (luminosité comprise) des points, shape (N, 3)
+        """
+        if self.cell_provider is not None:
+            body_cells, cell_positions, cell_size = self.cell_provider()
+            n_total = cell_positions.shape[0]
+            counts = np.bincount(body_cells[body_cells >= 0], minlength=n_total)
+            sums = np.zeros((n_total, 3), dtype=np.float64)
+            accumulate_colors(body_cells, colors, sums)
+            occupied = np.flatnonzero(counts)
+            positions = np.asarray(cell_positions, dtype=np.float32)[occupied]
+            color_sums = sums[occupied]
+        else:
+            n_total = int(np.prod(self.n_cells))
+            cell_size = self.cell_size
+            body_cells = np.empty(points.shape[0], dtype=np.int64)
+            counts = np.zeros(n_total, dtype=np.int64)
+            sums = np.zeros((n_total, 6), dtype=np.float64)
+            bin_points_in_cells(points, colors, self.min_bounds, (1.0 / self.cell_size).astype(np.float32),
+                                self.n_cells, body_cells, counts, sums)
+            occupied = np.flatnonzero(counts)
+            positions = (sums[occupied, 0:3] / counts[occupied, np.newaxis]).astype(np.float32)
+            color_sums = sums[occupied, 3:6]
+        self.cell_colors = (color_sums / counts[occupied, np.newaxis]).astype(np.float32)
+        self.body_cells = body_cells
+        self.occupied = occupied
+        self.cell_positions = positions
+        self.cell_mask = np.zeros(n_total, dtype=np.bool_)
+        self.cell_extent = float(np.linalg.norm(cell_size))
+        # Taille (entière, pour regrouper les appels à glPointSize) du point de chaque cellule
+        self.cell_sizes = np.minimum(np.round(3.0 * (1.0 + 0.5 * np.log2(counts[occupied]))), self.max_sprite_size)
+    
+    def select(self, camera_position):
+        """
+        Choisit les cellules dessinées point par point pour la position de caméra donnée et prépare les
+        points regroupés des autres cellules (self.sprites).
+        
+        Returns:
+            np.ndarray: Indices des points à dessiner individuellement
+        """
+        distances = np.linalg.norm(self.cell_positions - camera_position, axis=1)
+        near = self.cell_extent > self.theta * distances
+        self.cell_mask[:] = False
+        self.cell_mask[self.occupied[near]] = True
+        far = np.flatnonzero(~near)
+        far = far[np.argsort(self.cell_sizes[far], kind="stable")]
+        sizes = self.cell_sizes[far]
+        bounds = np.flatnonzero(np.diff(sizes)) + 1
+        self.sprites = [(float(self.cell_sizes[group[0]]), np.ascontiguousarray(self.cell_positions[group]),
+                         np.ascontiguousarray(self.cell_colors[group]))
+                        for group in np.split(far, bounds) if group.shape[0] > 0] if far.shape[0] > 0 else []
+        return np.flatnonzero(self.cell_mask[self.body_cells] | (self.body_cells < 0))
+
 
 class Visualizer3D:
     """
@@ -38,7 +207,7 @@ class Visualizer3D:
         bounds (tuple): ((xmin, xmax), (ymin, ymax), (zmin, zmax))
     """
     
-    def __init__(self, points, colors, luminosities, bounds):
+    def __init__(self, points, colors, luminosities, bounds, lod=None):
         """
         Initialise le visualiseur 3D.
         
@@ -47,6 +216,7 @@ class Visualizer3D:
             colors (np.ndarray): Couleurs RGB des points, shape (N, 3), valeurs entre 0 et 1
             luminosities (np.ndarray): Luminosités des points, shape (N,), valeurs entre 0 et 1
             bounds (tuple): Limites de l'espace ((xmin, xmax), (ymin, ymax), (zmin, zmax))
+            lod (LevelOfDetail, optional): Niveaux de détail pour les très grands nombres de points
         """
         # Stockage des données des points
         self.points = np.array(points, dtype=np.float32)
@@ -78,7 +248,19 @@ class Visualizer3D:
         # Vertex Buffer Objects pour optimisation GPU
         self.vbo_vertices = None
         self.vbo_colors = None
+        # Nombre de points pour lequel les VBO sont alloués
+        self.vbo_capacity = 0
+        # Positions et couleurs à transmettre au prochain rendu
         self.vbo_needs_update = True
+        self.colors_need_update = True
+        # Temps de rendu de chaque image (secondes)
+        self.frame_times = []
+        # Couleurs avec luminosité (copie CPU, pour les niveaux de détail)
+        self.colors_with_luminosity = None
+        # Niveaux de détail : nombre de points du VBO à dessiner, position de caméra de la dernière sélection
+        self.lod = lod
+        self.n_drawn = len(self.points)
+        self.lod_camera = None
         
         # Calcul du centre de la scène (pour centrer la visualisation)
         self.center = np.array([
@@ -177,26 +359,96 @@ class Visualizer3D:
         # Initialisation des buffers avec les données
         self._update_vbo()
     
-    def _update_vbo(self):
+    def _allocate_vbo(self, n_points):
         """
-        Met à jour les données dans les VBO (vertices et couleurs).
+        Alloue la mémoire GPU des VBO pour n_points points (sans les remplir).
         """
-        # Calcul des couleurs avec luminosité (vectorisé)
-        colors_with_luminosity = (self.colors * self.luminosities[:, np.newaxis] / 255.0).astype(np.float32)
-        
-        # Upload des vertices dans le VBO
+        nbytes = n_points * 3 * np.dtype(np.float32).itemsize
         glBindBuffer(GL_ARRAY_BUFFER, self.vbo_vertices)
-        glBufferData(GL_ARRAY_BUFFER, self.points.nbytes, self.points, GL_DYNAMIC_DRAW)
-        
-        # Upload des couleurs dans le VBO
+        glBufferData(GL_ARRAY_BUFFER, nbytes, None, GL_STREAM_DRAW)
         glBindBuffer(GL_ARRAY_BUFFER, self.vbo_colors)
-        glBufferData(GL_ARRAY_BUFFER, colors_with_luminosity.nbytes, colors_with_luminosity, GL_DYNAMIC_DRAW)
+        glBufferData(GL_ARRAY_BUFFER, nbytes, None, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.vbo_capacity = n_points
+        self.colors_need_update = True
+    
+    def _update_vbo(self):
+        """
+        Met à jour les données dans les VBO : les positions, et les couleurs seulement si elles ont changé.
+        """
+        if self.vbo_capacity != len(self.points):
+            self._allocate_vbo(len(self.points))
+        
+        if self.colors_need_update:
+            # Calcul des couleurs avec luminosité (vectorisé)
+            self.colors_with_luminosity = (self.colors * self.luminosities[:, np.newaxis] / 255.0).astype(np.float32)
+        
+        if self._lod_active():
+            self._update_lod()
+        else:
+            # Upload des vertices : le tampon est d'abord "orphelin" (même taille, pas de données), ce qui
+            # permet au pilote de fournir une nouvelle zone sans attendre la fin du rendu de l'image précédente
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo_vertices)
+            glBufferData(GL_ARRAY_BUFFER, self.points.nbytes, None, GL_STREAM_DRAW)
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.points.nbytes, self.points)
+            # Les couleurs sont aussi à retransmettre après un rendu avec niveaux de détail (sous-ensemble)
+            if self.colors_need_update or self.lod_camera is not None:
+                glBindBuffer(GL_ARRAY_BUFFER, self.vbo_colors)
+                glBufferSubData(GL_ARRAY_BUFFER, 0, self.colors_with_luminosity.nbytes, self.colors_with_luminosity)
+            self.n_drawn = len(self.points)
+            self.lod_camera = None
         
         # Unbind
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         
+        self.colors_need_update = False
         self.vbo_needs_update = False
     
+    def _lod_active(self):
+        return self.lod is not None and self.lod.is_active(len(self.points))
+    
+    def _update_lod(self):
+        """
+        Niveaux de détail : répartit les points dans les cellules s'ils ont changé, puis transmet au VBO les
+        seuls points des cellules proches de la caméra (les couleurs changent avec la sélection).
+        """
+        camera = self._camera_position()
+        if self.vbo_needs_update or self.colors_need_update:
+            self.lod.bin_points(self.points, self.colors_with_luminosity)
+        near_bodies = self.lod.select(camera)
+        near_points = self.points[near_bodies]
+        near_colors = self.colors_with_luminosity[near_bodies]
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo_vertices)
+        glBufferData(GL_ARRAY_BUFFER, self.points.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, near_points.nbytes, near_points)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo_colors)
+        glBufferData(GL_ARRAY_BUFFER, self.points.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, near_colors.nbytes, near_colors)
+        self.n_drawn = near_bodies.shape[0]
+        self.lod_camera = camera
+    
+    def _camera_position(self):
+        """
+        Position de la caméra dans le repère de la scène (inverse des transformations de _setup_camera).
+        """
+        ax = np.radians(self.camera_rotation_x)
+        ay = np.radians(self.camera_rotation_y)
+        rotation_x = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(ax), -np.sin(ax)], [0.0, np.sin(ax), np.cos(ax)]])
+        rotation_y = np.array([[np.cos(ay), 0.0, np.sin(ay)], [0.0, 1.0, 0.0], [-np.sin(ay), 0.0, np.cos(ay)]])
+        eye = np.array([0.0, 0.0, self.camera_distance / self.zoom_factor])
+        return self.center + (rotation_x @ rotation_y).T @ eye
+    
+    def _draw_sprites(self):
+        """
+        Dessine les points regroupés des cellules lointaines (tableaux côté CPU, quelques milliers de points).
+        """
+        for size, positions, colors in self.lod.sprites:
+            glPointSize(size)
+            glVertexPointer(3, GL_FLOAT, 0, positions)
+            glColorPointer(3, GL_FLOAT, 0, colors)
+            glDrawArrays(GL_POINTS, 0, len(positions))
+        glPointSize(3.0)
+    
     def _setup_camera(self):
         """
         Configure la position et l'orientation de la caméra.
@@ -220,14 +472,16 @@ class Visualizer3D:
         Effectue le rendu de la scène 3D.
         Dessine tous les points avec leur couleur et luminosité.
         """
+        start = time.perf_counter()
         # Effacement des buffers de couleur et de profondeur
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         
         # Configuration de la caméra
         self._setup_camera()
         
-        # Mise à jour des VBO si nécessaire
-        if self.vbo_needs_update:
+        # Mise à jour des VBO si nécessaire (avec les niveaux de détail, aussi quand la caméra a bougé)
+        if self.vbo_needs_update or (self._lod_active() and
+                                     not np.array_equal(self._camera_position(), self.lod_camera)):
             self._update_vbo()
         
         # Dessin des points avec VBO (rendu GPU optimisé)
@@ -243,15 +497,19 @@ class Visualizer3D:
         glColorPointer(3, GL_FLOAT, 0, None)
         
         # Rendu en une seule opération GPU
-        glDrawArrays(GL_POINTS, 0, len(self.points))
+        glDrawArrays(GL_POINTS, 0, self.n_drawn)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        
+        if self._lod_active():
+            self._draw_sprites()
         
         # Désactivation des états
         glDisableClientState(GL_COLOR_ARRAY)
         glDisableClientState(GL_VERTEX_ARRAY)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
         
         # Échange des buffers (double buffering)
         sdl2.SDL_GL_SwapWindow(self.window)
+        self.frame_times.append(time.perf_counter() - start)
     
     def _handle_events(self):
         """
@@ -328,13 +586,16 @@ class Visualizer3D:
             colors (np.ndarray, optional): Nouvelles couleurs, shape (N, 3)
             luminosities (np.ndarray, optional): Nouvelles luminosités, shape (N,)
         """
-        self.points = np.array(points, dtype=np.float32)
+        # Pas de copie si le tableau est déjà en float32 contigu : il est lu au prochain rendu
+        self.points = np.ascontiguousarray(points, dtype=np.float32)
         
         if colors is not None:
             self.colors = np.array(colors, dtype=np.float32)
+            self.colors_need_update = True
         
         if luminosities is not None:
             self.luminosities = np.array(luminosities, dtype=np.float32)
+            self.colors_need_update = True
         
         # Marquer les VBO pour mise à jour au prochain rendu
         self.vbo_needs_update = True
@@ -373,6 +634,8 @@ class Visualizer3D:
             t2 = sdl2.SDL_GetTicks()
             print(f"Render time: {t3 - t1} ms, Update time: {t2 - t3} ms", end='\r')
             t1 = t2
+        print()
+        print(frame_time_histogram(self.frame_times))
         # Nettoyage
         self.cleanup()
     
@@ -28,6 +28,118 @@ from mpi4py import MPI
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+# Étiquettes des messages du mode pipeline (run_pipelined)
+FRAME_TAG = 11
+STOP_TAG = 99
+DONE_TAG = 98
+
+
+class SharedFrames:
+    """
+    Triple tampon de positions dans une fenêtre MPI partagée (MPI.Win.Allocate_shared) entre les processus
+    d'un même nœud : le calculateur écrit les images, l'affichage les lit sur place, sans message ni copie.
+
+    L'en-tête (entiers 64 bits) contient le dernier tampon publié, le tampon en cours de lecture, un
+    drapeau d'arrêt et un compteur de séquence par tampon (seqlock : impair pendant une écriture).
+    L'écrivain choisit un tampon qui n'est ni le dernier publié ni celui que lit l'affichage, donc ne bloque
+    jamais. Le lecteur relit le dernier tampon publié après l'avoir réservé (l'écrivain a pu publier entre-temps)
+    et vérifie après lecture que le compteur du tampon n'a pas changé. Cette dernière vérification est la seule
+    garantie : même sur x86, l'écriture de la réservation peut être réordonnée avec les lectures qui la suivent,
+    et l'écrivain peut alors reprendre le tampon en cours de lecture. Une image ainsi déchirée est relue
+    (acquire(force=True)) avant d'être affichée.
+    """
+
+    N_SLOTS = 3
+    HEADER_SIZE = 64
+    LATEST, READING, STOP, SEQUENCE = 0, 1, 2, 3
+
+    def __init__(self, node_communicator, shape, owner=0):
+        """
+        Args:
+            node_communicator: Communicateur des processus d'un même nœud (appel collectif)
+            shape (tuple): Forme du tableau de positions (N, 3), en float32
+            owner (int): Rang (dans node_communicator) du processus qui alloue la mémoire
+        """
+        self.node_communicator = node_communicator
+        size = self.HEADER_SIZE + self.N_SLOTS * int(np.prod(shape)) * 4
+        self.window = MPI.Win.Allocate_shared(
+            size if node_communicator.Get_rank() == owner else 0,
+            1,
+            comm=node_communicator,
+        )
+        buffer, _ = self.window.Shared_query(owner)
+        self.header = np.ndarray((8,), dtype=np.int64, buffer=buffer)
+        self.slots = np.ndarray(
+            (self.N_SLOTS,) + tuple(shape),
+            dtype=np.float32,
+            buffer=buffer,
+            offset=self.HEADER_SIZE,
+        )
+        if node_communicator.Get_rank() == owner:
+            self.header[:] = 0
+            self.header[self.LATEST] = -1
+            self.header[self.READING] = -1
+        node_communicator.Barrier()
+        # Dernière image lue par l'affichage : (tampon, séquence)
+        self.displayed = (-1, -1)
+
+    def write(self, positions):
+        """
+        Écrit et publie une image (côté calcul).
+        """
+        busy = (self.header[self.LATEST], self.header[self.READING])
+        slot = next(i for i in range(self.N_SLOTS) if i not in busy)
+        self.header[self.SEQUENCE + slot] += 1
+        np.copyto(self.slots[slot], positions)
+        self.header[self.SEQUENCE + slot] += 1
+        self.header[self.LATEST] = slot
+
+    def acquire(self, force=False):
+        """
+        Réserve la dernière image publiée si elle n'a pas encore été lue (côté affichage).
+
+        Args:
+            force (bool): Réserve la dernière image publiée même si elle a déjà été lue (relecture après une
+                image déchirée)
+
+        Returns:
+            tuple: (tampon, séquence) à passer à is_valid après lecture, ou None
+        """
+        while True:
+            slot = int(self.header[self.LATEST])
+            if slot < 0:
+                return None
+            self.header[self.READING] = slot
+            # Publication d'une autre image avant que l'écrivain ait vu la réservation : on recommence
+            if int(self.header[self.LATEST]) != slot:
+                continue
+            sequence = int(self.header[self.SEQUENCE + slot])
+            # Tampon en cours de réécriture (réservation vue trop tard) : on attend la publication suivante
+            if sequence % 2 == 1:
+                continue
+            if not force and (slot, sequence) == self.displayed:
+                return None
+            return slot, sequence
+
+    def is_valid(self, slot, sequence):
+        """
+        Teste après lecture que le tampon n'a pas été réécrit pendant la lecture.
+        """
+        return self.header[self.SEQUENCE + slot] == sequence
+
+    def request_stop(self):
+        self.header[self.STOP] = 1
+
+    def stop_requested(self):
+        return bool(self.header[self.STOP])
+
+    def free(self):
+        """
+        Libère la fenêtre partagée (appel collectif sur le communicateur du nœud).
+        """
+        self.header = self.slots = None
+        self.window.Free()
+
 
 class Visualizer3D:
     """
@@ -209,6 +321,15 @@ class Visualizer3D:
 
         self.vbo_needs_update = False
 
+    def _upload_positions(self, points):
+        """
+        Remplace les positions dans le VBO déjà alloué (même nombre de points), sans toucher aux couleurs.
+        Le tableau est passé tel quel à OpenGL : il peut être une vue sur une mémoire partagée.
+        """
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo_vertices)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, points.nbytes, points)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
     def _setup_camera(self):
         """
         Configure la position et l'orientation de la caméra.
@@ -392,6 +513,221 @@ class Visualizer3D:
                     result = updater(dt)
                     communicator.send(result, dest=0, tag=11)
 
+    def run_pipelined(
+        self,
+        communicator,
+        rank,
+        compute_communicator=None,
+        stepper=None,
+        frame=None,
+        dt=0.001,
+        max_fps=30.0,
+    ):
+        """
+        Boucle principale en mode pipeline : le processus 0 affiche, les processus 1 à P-1 calculent.
+
+        Les calculateurs avancent la simulation sans jamais attendre l'affichage. Au plus max_fps fois par
+        seconde, et seulement si l'image précédente est partie, le premier calculateur envoie les positions
+        (tableau float32 de la forme de self.points) par un Isend sans sérialisation. Le processus 0 reçoit
+        par Irecv dans un double tampon préalloué : dès qu'une image est arrivée, la réception suivante est
+        lancée dans l'autre tampon, et l'image reçue est affichée sans copie.
+
+        Args:
+            communicator: Communicateur contenant l'affichage (rang 0) et les calculateurs
+            rank (int): Rang dans communicator
+            compute_communicator: Communicateur des seuls calculateurs (rang 0 = processus 1 de communicator)
+            stepper (callable): stepper(dt) avance la simulation d'un pas (appel collectif sur les calculateurs)
+            frame (callable): frame() retourne les positions à afficher sur le premier calculateur, None sur
+                les autres (appel collectif sur les calculateurs)
+            dt (float): Pas de temps
+            max_fps (float): Nombre maximal d'images envoyées par seconde
+        """
+        if rank == 0:
+            print("Contrôles :")
+            print("  - Clic gauche + déplacement souris : rotation de la caméra")
+            print("  - Molette de la souris : zoom")
+            print("  - ESC ou fermeture de fenêtre : quitter")
+
+            buffers = [np.empty_like(self.points), np.empty_like(self.points)]
+            receiving = 0
+            request = communicator.Irecv(
+                [buffers[receiving], MPI.FLOAT], source=1, tag=FRAME_TAG
+            )
+            n_frames = 0
+            n_renders = 0
+            start = MPI.Wtime()
+            self.running = True
+            while self.running:
+                self.running = self._handle_events()
+                if request.Test():
+                    # Réception suivante dans l'autre tampon ; celui qui vient d'être rempli n'est réécrit
+                    # qu'après l'arrivée de l'image suivante, qui le remplace à l'affichage
+                    displayed = receiving
+                    receiving = 1 - receiving
+                    request = communicator.Irecv(
+                        [buffers[receiving], MPI.FLOAT], source=1, tag=FRAME_TAG
+                    )
+                    self.points = buffers[displayed]
+                    self.vbo_needs_update = True
+                    n_frames += 1
+                self._render()
+                n_renders += 1
+            elapsed = MPI.Wtime() - start
+
+            # Arrêt : le premier calculateur termine son dernier envoi (la réception est encore postée), puis
+            # confirme ; la réception restée sans message est ensuite annulée
+            communicator.send(None, dest=1, tag=STOP_TAG)
+            while not communicator.Iprobe(source=1, tag=DONE_TAG):
+                if request.Test():
+                    receiving = 1 - receiving
+                    request = communicator.Irecv(
+                        [buffers[receiving], MPI.FLOAT], source=1, tag=FRAME_TAG
+                    )
+            communicator.recv(source=1, tag=DONE_TAG)
+            request.Cancel()
+            request.Wait()
+            print(
+                f"Affichage : {n_renders / elapsed:.1f} images/s, "
+                f"{n_frames / elapsed:.1f} images reçues/s"
+            )
+            self.cleanup()
+        else:
+            is_root = compute_communicator.Get_rank() == 0
+            send_buffer = np.empty_like(self.points) if is_root else None
+            send_request = MPI.REQUEST_NULL
+            min_interval = 1.0 / max_fps
+            last_send = -np.inf
+            n_steps = 0
+            n_sent = 0
+            # Décisions du premier calculateur (arrêt, envoi d'une image), partagées par tous les calculateurs
+            flags = np.zeros(2, dtype=np.int8)
+            start = MPI.Wtime()
+            while True:
+                if is_root:
+                    flags[0] = communicator.Iprobe(source=0, tag=STOP_TAG)
+                    flags[1] = (
+                        MPI.Wtime() - last_send >= min_interval and send_request.Test()
+                    )
+                compute_communicator.Bcast(flags, root=0)
+                if flags[0]:
+                    break
+                if flags[1]:
+                    positions = frame()
+                    if is_root:
+                        np.copyto(send_buffer, positions)
+                        send_request = communicator.Isend(
+                            [send_buffer, MPI.FLOAT], dest=0, tag=FRAME_TAG
+                        )
+                        last_send = MPI.Wtime()
+                        n_sent += 1
+                stepper(dt)
+                n_steps += 1
+            if is_root:
+                elapsed = MPI.Wtime() - start
+                communicator.recv(source=0, tag=STOP_TAG)
+                send_request.Wait()
+                communicator.send(None, dest=0, tag=DONE_TAG)
+                print(
+                    f"Calcul ({compute_communicator.Get_size()} processus) : {n_steps / elapsed:.2f} pas/s, "
+                    f"{n_sent / elapsed:.1f} images envoyées/s"
+                )
+
+    def run_shared(
+        self,
+        communicator,
+        rank,
+        compute_communicator=None,
+        stepper=None,
+        frame=None,
+        dt=0.001,
+        max_fps=30.0,
+    ):
+        """
+        Variante de run_pipelined où les images passent par une mémoire partagée (SharedFrames) quand
+        l'affichage (rang 0) et le premier calculateur (rang 1) sont sur le même nœud : pas de message, pas
+        de sérialisation, et l'affichage envoie directement le tampon partagé à glBufferSubData. Sinon, on
+        se replie sur run_pipelined. Mêmes arguments que run_pipelined.
+        """
+        node_communicator = communicator.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+        node_ranks = node_communicator.allgather(rank)
+        same_node = communicator.bcast(1 in node_ranks if rank == 0 else None, root=0)
+        if not same_node:
+            node_communicator.Free()
+            return self.run_pipelined(
+                communicator, rank, compute_communicator, stepper, frame, dt, max_fps
+            )
+        # Seuls les processus du nœud de l'affichage partagent la fenêtre (rang 0 du nœud : l'affichage)
+        frames = (
+            SharedFrames(node_communicator, self.points.shape)
+            if 0 in node_ranks
+            else None
+        )
+
+        if rank == 0:
+            print("Contrôles :")
+            print("  - Clic gauche + déplacement souris : rotation de la caméra")
+            print("  - Molette de la souris : zoom")
+            print("  - ESC ou fermeture de fenêtre : quitter")
+
+            n_frames = 0
+            n_renders = 0
+            start = MPI.Wtime()
+            self.running = True
+            while self.running:
+                self.running = self._handle_events()
+                acquired = frames.acquire()
+                while acquired is not None:
+                    slot, sequence = acquired
+                    self._upload_positions(frames.slots[slot])
+                    if frames.is_valid(slot, sequence):
+                        frames.displayed = acquired
+                        n_frames += 1
+                        break
+                    # Image réécrite pendant l'envoi : le tampon graphique est incohérent, on renvoie la
+                    # dernière image publiée avant de l'afficher
+                    acquired = frames.acquire(force=True)
+                self._render()
+                n_renders += 1
+            elapsed = MPI.Wtime() - start
+            frames.request_stop()
+            print(
+                f"Affichage : {n_renders / elapsed:.1f} images/s, "
+                f"{n_frames / elapsed:.1f} images lues/s"
+            )
+            self.cleanup()
+        else:
+            is_root = compute_communicator.Get_rank() == 0
+            min_interval = 1.0 / max_fps
+            last_send = -np.inf
+            n_steps = 0
+            n_sent = 0
+            flags = np.zeros(2, dtype=np.int8)
+            start = MPI.Wtime()
+            while True:
+                if is_root:
+                    flags[0] = frames.stop_requested()
+                    flags[1] = MPI.Wtime() - last_send >= min_interval
+                compute_communicator.Bcast(flags, root=0)
+                if flags[0]:
+                    break
+                if flags[1]:
+                    positions = frame()
+                    if is_root:
+                        frames.write(positions)
+                        last_send = MPI.Wtime()
+                        n_sent += 1
+                stepper(dt)
+                n_steps += 1
+            if is_root:
+                elapsed = MPI.Wtime() - start
+                print(
+                    f"Calcul ({compute_communicator.Get_size()} processus) : {n_steps / elapsed:.2f} pas/s, "
+                    f"{n_sent / elapsed:.1f} images publiées/s"
+                )
+        if frames is not None:
+            frames.free()
+        node_communicator.Free()
+
     def cleanup(self):
         """
         Libère les ressources SDL et OpenGL.